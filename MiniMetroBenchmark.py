@@ -0,0 +1,542 @@
+###################################################################################################
+#
+# MiniMetroBenchmark.py
+# Times the simulation classes of Mini Metro on scripted worlds of different sizes, and compares
+# the results of two runs to see if a change made the game faster or slower
+#
+# Kevin Qiao - January 20, 2019
+#
+###################################################################################################
+
+import random
+import math
+import itertools
+import gc
+import json
+import timeit
+import platform
+import argparse
+import collections
+import sys
+import StringIO
+import numpy
+import pygame
+import MiniMetroClasses as Game
+import MiniMetroSimulation as Sim
+import MiniMetroSave as Save
+import TimeClass as Time
+
+# scripted worlds to time everything on, from an early game to one
+# much bigger than a real game ever gets
+SCENARIOS = collections.OrderedDict([
+    ("small", {"stops": 10, "lines": 7, "stopsPerLine": 5,
+               "trainsPerLine": 1, "carriagesPerTrain": 1}),
+    ("medium", {"stops": 100, "lines": 20, "stopsPerLine": 10,
+                "trainsPerLine": 2, "carriagesPerTrain": 1}),
+    ("large", {"stops": 1000, "lines": 50, "stopsPerLine": 16,
+               "trainsPerLine": 3, "carriagesPerTrain": 2})
+])
+STOP_SPACING = Game.STOP_DISTANCE+20  # world pixels between stops placed on the grid
+PASSENGERS_PER_STOP = 3  # passengers waiting at every stop at the start of each batch
+UNIQUE_STOP_RATE = 50    # one in this many stops gets a unique shape
+STEP_TIME = 1.0/60       # seconds of game time per step when timing whole minutes
+SIMULATED_TIME = 60      # seconds of game time per sample of the whole simulation
+# nothing should end the game or pause it for a resource while being timed
+FIXTURE_PARAMETERS = {"loseDuration": 1e9,
+                      "resourceGainDelay": 1e9}
+# two-sided 95% values of the t distribution by degrees of freedom,
+# for the noise bounds of a small number of samples
+T_VALUES = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26,
+            2.23, 2.20, 2.18, 2.16, 2.14, 2.13, 2.12, 2.11, 2.10, 2.09]
+MIN_SAMPLES = 5          # fewest samples of each run for a benchmark to count as faster or slower
+SIGNIFICANCE = 0.05      # largest p-value of a change that counts
+EXACT_TEST_LIMIT = 5000  # most splits of the samples that the exact test goes through
+
+timer = timeit.default_timer
+
+
+def buildFixture(scenario, seed):
+    """ (dict, int) -> Simulation
+        Creates a simulation with the stops of "scenario" spread over
+        a grid on a map with no river, and its lines, trains and
+        carriages already placed. The same seed always builds the same
+        world, no matter what else has used the random module.
+    """
+    # the layout has its own generator, and the simulation gets its
+    # own streams made from the same seed
+    layoutStream = random.Random(seed)
+    columns = int(math.ceil(math.sqrt(scenario["stops"]*4/3.0)))
+    rows = int(math.ceil(scenario["stops"]/float(columns)))
+    width = max(Sim.WORLD_WIDTH, (columns+1)*STOP_SPACING)
+    height = max(Sim.WORLD_HEIGHT, (rows+1)*STOP_SPACING)
+    simulation = Sim.Simulation(pygame.Surface((width, height)),
+                                clock=Time.VirtualClock(),
+                                parameters=FIXTURE_PARAMETERS,
+                                randomStreams=Game.RandomStreams(seed))
+    world = simulation.world
+    # replace the stops the simulation started with, and let stops
+    # spawn anywhere like at the end of a game
+    world.stops = []
+    world.stopGrid.clear()
+    world.validStopDistanceX = width/2
+    world.validStopDistanceY = height/2
+    simulation.offset = Sim.calculateCameraOffset(simulation.viewWidth,
+                                                  simulation.viewHeight,
+                                                  world)
+
+    left = (width-(columns-1)*STOP_SPACING)/2
+    top = (height-(rows-1)*STOP_SPACING)/2
+    for i in range(scenario["stops"]):
+        # same odds of each shape as Simulation.step()
+        shape = layoutStream.randint(0, 99)
+        if shape < 55:
+            shape = Game.CIRCLE
+        elif shape < 90:
+            shape = Game.TRIANGLE
+        else:
+            shape = Game.SQUARE
+        world.addStop(left+(i % columns)*STOP_SPACING+layoutStream.randint(-10, 10),
+                      top+(i/columns)*STOP_SPACING+layoutStream.randint(-10, 10),
+                      shape,
+                      None)
+    for i in range(scenario["stops"]/UNIQUE_STOP_RATE):
+        newShape = world.switchRandomStop(range(Game.SQUARE+1, Game.STAR+1), simulation.validStops)
+        if newShape != -1 and newShape not in simulation.validStops:
+            simulation.validStops.append(newShape)
+
+    for i in range(scenario["lines"]):
+        # wander from a random stop through its neighbours
+        stops = [layoutStream.choice(world.stops)]
+        while len(stops) < scenario["stopsPerLine"]:
+            candidates = []
+            for stop in world.getStopsNear(stops[-1].X, stops[-1].Y, STOP_SPACING*1.5):
+                if stop not in stops:
+                    candidates.append(stop)
+            if len(candidates) == 0:
+                break
+            stops.append(layoutStream.choice(candidates))
+        # like Simulation.addLine(), but without the limit of one line
+        # per colour so that there can be more than 7 lines
+        line = Game.Line(i % len(Game.COLOURS["lines"]))
+        for j in range(len(stops)-1):
+            segment = Game.Segment(stops[j], stops[j+1], j)
+            segment.checkOverWater(world.riverMask)
+            line.tempSegments.append(segment)
+        world.lines.append(line)
+        world.commitLine(line)
+
+        world.resources[Game.TRAIN] = scenario["trainsPerLine"]
+        for j in range(scenario["trainsPerLine"]):
+            train = simulation.addTrain(line, j*len(line.segments)/scenario["trainsPerLine"])
+            for k in range(scenario["carriagesPerTrain"]):
+                # start the carriage on the train so that it
+                # attaches to that one instead of the first on the line
+                carriage = Game.Carriage(*train.getPosition(), speed=world.trainSpeed)
+                carriage.snapToLine(line)
+                carriage.placeOnLine(True, simulation.offset, world.passengerSize)
+                world.carriages.append(carriage)
+    resetFixture(simulation)
+    return simulation
+
+
+def resetFixture(simulation):
+    """ (Simulation) -> None
+        Puts the passengers and trains of a fixture back to the same
+        kind of state before each batch, so that a benchmark does not
+        slowly change what it is timing. The passengers come from a
+        generator seeded the same way every time, so every batch starts
+        with exactly the same passengers.
+    """
+    world = simulation.world
+    passengerStream = random.Random(simulation.randomStreams.seed)
+    for stop in world.stops:
+        stop.trains.clear()
+        stop.passengers.clear()
+        for i in range(PASSENGERS_PER_STOP):
+            stop.addRandomPassenger(simulation.validStops, passengerStream)
+    for vehicle in list(world.trains)+list(world.carriages):
+        vehicle.passengers.clear()
+        vehicle.canMove = True
+
+
+def benchTrainMove(simulation):
+    # one tick of movement for every train, which also moves its carriages
+    world = simulation.world
+    trains = list(world.trains)
+    startTime = timer()
+    for train in trains:
+        if train.canMove:
+            train.move(simulation.offset, world.passengerSize)
+    return timer()-startTime, len(trains)
+
+
+def _stopEveryTrain(simulation):
+    # stops every train at the first stop of the segment it is on
+    pairs = []
+    for train in simulation.world.trains:
+        stop = train.line.segments[train.segmentNum].firstPoint
+        stop.trains.append(train)
+        pairs.append((stop, train))
+    return pairs
+
+
+def benchProcessTrain(simulation):
+    pairs = _stopEveryTrain(simulation)
+    trainsToMove = simulation.trainsToMove
+    startTime = timer()
+    for stop, train in pairs:
+        stop.processTrain(train, trainsToMove)
+    return timer()-startTime, len(pairs)
+
+
+def benchFindValidPassenger(simulation):
+    pairs = _stopEveryTrain(simulation)
+    startTime = timer()
+    for stop, train in pairs:
+        stop.findValidPassenger(train)
+    return timer()-startTime, len(pairs)
+
+
+def _getMiddle(segment):
+    return [(segment.firstPoint.X+segment.lastPoint.X)/2.0,
+            (segment.firstPoint.Y+segment.lastPoint.Y)/2.0]
+
+
+def _findLineEdit(world, line):
+    # a segment of the line in the middle of it with no train or
+    # carriage on it, and a stop near it that is not on the line, to
+    # drag the segment through. returns None if there is none
+    occupied = set()
+    for train in line.trains:
+        occupied.add(train.segmentNum)
+        for carriage in train.carriages:
+            occupied.add(carriage.segmentNum)
+    for segmentNum in range(1, len(line.segments)-1):
+        if segmentNum in occupied:
+            continue
+        segment = line.segments[segmentNum]
+        middle = _getMiddle(segment)
+        for stop in world.getStopsNear(middle[0], middle[1], STOP_SPACING*1.5):
+            if not line.contains(stop):
+                return segmentNum, stop
+    return None
+
+
+def benchLineEdit(simulation):
+    # dragging the middle of a segment of each line through a stop
+    # and letting go, like the game does. each edit is undone
+    # (untimed) so that the lines are the same for every batch
+    world = simulation.world
+    seconds = 0
+    edits = 0
+    for line in world.lines:
+        edit = _findLineEdit(world, line)
+        if edit is None:
+            continue
+        segmentNum, stop = edit
+        segments = list(line.segments)
+        segment = segments[segmentNum]
+        middle = _getMiddle(segment)
+        mouseObject = Game.MousePosition(Game.getViewCoords(middle[0], middle[1], simulation.offset),
+                                         simulation.offset)
+        vehicles = []
+        for train in line.trains:
+            vehicles.append([train, train.segmentNum])
+            for carriage in train.carriages:
+                vehicles.append([carriage, carriage.segmentNum])
+
+        startTime = timer()
+        line.isMoving = True
+        line.createMouseSegments(segmentNum, mouseObject, segment.firstPoint, segment.lastPoint)
+        line._insertSegment(line.mouseSegments[0], stop, world.riverMask)
+        line.isMoving = False
+        line.tempSegments.insert(line.mouseSegments[0].index+1,
+                                 Game.Segment(line.mouseSegments[0].firstPoint,
+                                              line.mouseSegments[1].firstPoint,
+                                              line.mouseSegments[1].index))
+        world.commitLine(line)
+        seconds = seconds+timer()-startTime
+        edits = edits+1
+
+        # put the segment back where it was
+        segment.isAbandoned = False
+        line.tempSegments = segments
+        line.indexTempSegments()
+        world.commitLine(line)
+        for vehicle, vehicleSegmentNum in vehicles:
+            vehicle.segmentNum = vehicleSegmentNum
+    return seconds, edits
+
+
+def benchAddRandomStop(simulation):
+    # each new stop is taken out again (untimed) so that the world
+    # does not fill up while it is being timed
+    world = simulation.world
+    seconds = 0
+    for i in range(10):
+        count = len(world.stops)
+        startTime = timer()
+        world.addRandomStop(Game.CIRCLE, None)
+        seconds = seconds+timer()-startTime
+        if len(world.stops) > count:
+            stop = world.stops.pop()
+            world.stopGrid.remove(stop, stop.X, stop.Y, stop.X, stop.Y)
+    return seconds, 10
+
+
+# name, function and unit of every benchmark that times single operations
+MICRO_BENCHMARKS = [("Train.move", benchTrainMove, "seconds per train"),
+                    ("Stop.processTrain", benchProcessTrain, "seconds per train"),
+                    ("Stop.findValidPassenger", benchFindValidPassenger, "seconds per train"),
+                    ("Line.edit", benchLineEdit, "seconds per edit"),
+                    ("World.addRandomStop", benchAddRandomStop, "seconds per stop")]
+
+
+def measure(benchmark, simulation, samples, minTime):
+    """ (function, Simulation, int, num) -> list
+        Returns "samples" measurements of the seconds per operation of
+        a benchmark, each timing batches until at least "minTime"
+        seconds were spent in the benchmark.
+    """
+    resetFixture(simulation)
+    benchmark(simulation)  # warm up
+    measurements = []
+    gcWasEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(samples):
+            seconds = 0
+            operations = 0
+            while seconds < minTime:
+                resetFixture(simulation)
+                batchSeconds, batchOperations = benchmark(simulation)
+                seconds = seconds+batchSeconds
+                operations = operations+batchOperations
+            measurements.append(seconds/operations)
+    finally:
+        if gcWasEnabled:
+            gc.enable()
+    return measurements
+
+
+def measureSimulation(scenario, samples, seed):
+    """ (dict, int, int) -> list
+        Runs SIMULATED_TIME seconds of the same fixture "samples"
+        times. Returns the seconds each run took.
+    """
+    # build the fixture once, and restore it (with its random state)
+    # before each run so that every run does the same work
+    fixture = buildFixture(scenario, seed)
+    savedFixture = StringIO.StringIO()
+    Save.saveSimulation(fixture, savedFixture, False)
+    runs = []
+    for i in range(samples):
+        simulation = Save.loadSimulation(StringIO.StringIO(savedFixture.getvalue()),
+                                         worldSurface=fixture.worldSurface)
+        startTime = timer()
+        simulation.run(SIMULATED_TIME, STEP_TIME)
+        runs.append(timer()-startTime)
+    return runs
+
+
+def summarizeSamples(samples, unit):
+    """ (list, str) -> dict
+        Returns the samples of a benchmark with their mean, standard
+        deviation, median and the noise bound: half the width of the
+        95% confidence interval of the mean, relative to the mean.
+    """
+    values = numpy.array(samples, dtype=float)
+    mean = float(values.mean())
+    std = 0.0
+    noise = 0.0
+    if len(values) > 1:
+        std = float(values.std(ddof=1))
+        tValue = T_VALUES[min(len(values)-2, len(T_VALUES)-1)]
+        noise = tValue*std/math.sqrt(len(values))/mean
+    return {"unit": unit,
+            "samples": [float(value) for value in values],
+            "mean": mean,
+            "std": std,
+            "median": float(numpy.median(values)),
+            "min": float(values.min()),
+            "noise": noise}
+
+
+def runBenchmarks(scenarioNames, samples=5, minTime=0.1, seed=0, log=None):
+    """ (list, int, num, int, file) -> dict
+        Runs every benchmark on the named scenarios. Returns the
+        results keyed by "scenario/benchmark", with a description of
+        the machine and settings that can be saved as JSON. Progress is
+        written to "log" if it is given.
+    """
+    results = collections.OrderedDict()
+    fixtures = {}
+    for name in scenarioNames:
+        scenario = SCENARIOS[name]
+        simulation = buildFixture(scenario, seed)
+        world = simulation.world
+        fixtures[name] = {"stops": len(world.stops),
+                          "lines": len(world.lines),
+                          "trains": len(world.trains),
+                          "carriages": len(world.carriages)}
+        for benchmark, function, unit in MICRO_BENCHMARKS:
+            results[name+"/"+benchmark] = summarizeSamples(measure(function, simulation,
+                                                                   samples, minTime),
+                                                           unit)
+            if log is not None:
+                log.write("%-32s %s\n" % (name+"/"+benchmark,
+                                          formatResult(results[name+"/"+benchmark])))
+        runs = measureSimulation(scenario, samples, seed)
+        results[name+"/Simulation.minute"] = summarizeSamples(runs, "seconds per simulated minute")
+        if log is not None:
+            log.write("%-32s %s\n" % (name+"/Simulation.minute",
+                                      formatResult(results[name+"/Simulation.minute"])))
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "samples": samples,
+            "minTime": minTime,
+            "seed": seed,
+            "fixtures": fixtures,
+            "results": results}
+
+
+def formatTime(seconds):
+    if seconds >= 0.1:
+        return "%9.3f s " % seconds
+    elif seconds >= 1e-4:
+        return "%9.3f ms" % (seconds*1e3)
+    return "%9.3f us" % (seconds*1e6)
+
+
+def formatResult(result):
+    return "%s  +- %4.1f%%  (%s)" % (formatTime(result["mean"]),
+                                     result["noise"]*100,
+                                     result["unit"])
+
+
+def _getRanks(values):
+    # the rank of each value from 1 up, with tied values sharing the
+    # average of their ranks
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0.0]*len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while end+1 < len(order) and values[order[end+1]] == values[order[start]]:
+            end = end+1
+        for i in range(start, end+1):
+            ranks[order[i]] = (start+end)/2.0+1
+        start = end+1
+    return ranks
+
+
+def mannWhitneyTest(old, new):
+    """ (list, list) -> float
+        Returns the two-sided p-value of the Mann-Whitney U test on two
+        lists of samples: the chance of the samples of "new" ranking at
+        least this far above or below those of "old" if both came from
+        the same distribution. Small samples are tested exactly, by
+        going through every way of splitting the ranks between the
+        two, and bigger ones with the normal approximation.
+    """
+    ranks = _getRanks(list(old)+list(new))
+    count = len(ranks)
+    expected = len(new)*(count+1)/2.0
+    difference = abs(sum(ranks[len(old):])-expected)
+    splits = 1
+    for i in range(len(new)):
+        splits = splits*(count-i)/(i+1)
+    if splits <= EXACT_TEST_LIMIT:
+        extreme = 0
+        for newRanks in itertools.combinations(ranks, len(new)):
+            if abs(sum(newRanks)-expected) >= difference-1e-9:
+                extreme = extreme+1
+        return extreme/float(splits)
+    # ties make the ranks spread less
+    ties = 0
+    for tied in collections.Counter(ranks).values():
+        ties = ties+tied**3-tied
+    variance = len(old)*len(new)/12.0*(count+1-ties/float(count*(count-1)))
+    if variance == 0:
+        return 1.0
+    return math.erfc(difference/math.sqrt(2*variance))
+
+
+def compareResults(old, new, threshold=0.02):
+    """ (dict, dict, float) -> list
+        Compares two sets of results from runBenchmarks(). A benchmark
+        only counts as faster or slower if both runs have at least
+        MIN_SAMPLES samples of it, the Mann-Whitney U test finds that
+        they differ (a p-value below SIGNIFICANCE), and its median
+        changed by more than "threshold" (as a fraction) to ignore tiny
+        changes.
+        Returns [name, old median, new median, change, p-value,
+        verdict] for every benchmark in both, where verdict is
+        "faster", "slower" or "same". The p-value is None if there are
+        too few samples to test.
+    """
+    comparisons = []
+    for name in new["results"]:
+        if name not in old["results"]:
+            continue
+        oldResult = old["results"][name]
+        newResult = new["results"][name]
+        change = newResult["median"]/oldResult["median"]-1
+        pValue = None
+        verdict = "same"
+        if min(len(oldResult["samples"]), len(newResult["samples"])) >= MIN_SAMPLES:
+            pValue = mannWhitneyTest(oldResult["samples"], newResult["samples"])
+            if pValue < SIGNIFICANCE and change > threshold:
+                verdict = "slower"
+            elif pValue < SIGNIFICANCE and change < -threshold:
+                verdict = "faster"
+        comparisons.append([name, oldResult["median"], newResult["median"],
+                            change, pValue, verdict])
+    return comparisons
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the Mini Metro simulation on scripted "
+                                                 "worlds and optionally compare with an "
+                                                 "earlier run.")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS),
+                        help="scenarios to run (one of: "+", ".join(SCENARIOS)+")")
+    parser.add_argument("--samples", type=int, default=5,
+                        help="samples per benchmark (at least %d to find changes)" % MIN_SAMPLES)
+    parser.add_argument("--min-time", type=float, default=0.1,
+                        help="least seconds spent timing each sample of an operation")
+    parser.add_argument("--seed", type=int, default=0, help="seed the fixtures are built with")
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.02,
+                        help="smallest change (as a fraction) that is reported")
+    arguments = parser.parse_args()
+
+    for name in arguments.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: "+name)
+    report = runBenchmarks(arguments.scenarios, arguments.samples, arguments.min_time,
+                           arguments.seed, sys.stdout)
+    if arguments.output is not None:
+        with open(arguments.output, "w") as resultsFile:
+            json.dump(report, resultsFile, indent=2)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as resultsFile:
+            baseline = json.load(resultsFile)
+        print
+        slower = 0
+        for name, oldMedian, newMedian, change, pValue, verdict in compareResults(
+                baseline, report, arguments.threshold):
+            if pValue is None:
+                test = "too few samples"
+            else:
+                test = "p = %.3f" % pValue
+            print "%-32s %s -> %s  %+6.1f%% (%s)  %s" % (
+                name, formatTime(oldMedian), formatTime(newMedian), change*100, test, verdict)
+            if verdict == "slower":
+                slower = slower+1
+        # let scripts notice when something got slower
+        if slower > 0:
+            sys.exit(1)
@@ -10,10 +10,13 @@
 import random
 import copy
 import math
+import collections
+import itertools
+import numpy
 import pygame
 import pygame.gfxdraw
+import pygame.surfarray
 import TimeClass as Time
-pygame.init()
 
 COLOURS = {"background": (48, 48, 48),
            "river": (83, 124, 144),
@@ -36,6 +39,10 @@ PARLLELOGRAM = 5
 PENTAGON = 6
 HEXAGON = 7
 STAR = 8
+SHAPE_COUNT = 9
+# the shapes with their bit set in each bitmask of shapes
+MASK_SHAPES = [[shape for shape in range(SHAPE_COUNT) if mask & (1 << shape)]
+               for mask in range(1 << SHAPE_COUNT)]
 
 CARRIAGE = 0
 LINE = 1
@@ -46,19 +53,35 @@ TUNNEL = 3
 STOP_REMOVAL_DISTANCE = 10  # distance mouse must be to a stop to remove it from a line
 STOP_ADDITION_DISTANCE = 5  # distance mouse must be to a stop to add it to a line
 ENDPOINT_SEGMENT_DISTANCE = 60  # distance mouse must be to grab an endpoint segment
+SEGMENT_CLICK_DISTANCE = 15  # distance mouse must be to a segment to click on it
 STOP_DISTANCE = 100  # minimum spacing between any two given stops
+WATER_CHECK_INTERVAL = 20  # distance between the points checked for water along a segment
 
 LOSE_DURATION = 45  # amount of time stop has to overcrowd to cause the game to be over
+GAUGE_LEVELS = 90  # number of different fill levels an overcrowding gauge can be drawn with
+GAUGE_CACHE_SIZE = 32  # number of stop shape and size combinations to keep gauges for
+TRAIN_ANGLE_BUCKETS = 360  # number of different angles a train can be drawn at
+TRAIN_SPRITE_CACHE_SIZE = 512  # number of rotated train sprites to keep
 
 RESOURCE_GAIN_DELAY = 90  # time between each resource gain event
 
+# every stop, passenger, segment, train and carriage gets the next number
+# from here as its ID. copies of an entity (moving clones and snapshots)
+# keep its ID
+_entityIds = itertools.count()
+_UNSET = object()  # stands for a slot that has not been set
+_REMOVED = object()  # stands for an entity taken out of an EntityList
 
-def _isValidSpawn(x, y, stops, mapSurface):
+# parts of the game that each get their own random number generator
+RANDOM_STREAMS = ["map", "stops", "switches", "passengers", "resources", "music"]
+
+
+def _isValidSpawn(x, y, stopGrid, riverMask):
     # Returns True or False depending on whether or not the given
     # point (x, y) is a valid stop location on the given map
-    if tuple(mapSurface.get_at((x, y))[:3]) == COLOURS.get("river"):
+    if riverMask.isWater(x, y):
         return False
-    for stop in stops:
+    for stop in stopGrid.queryRadius(x, y, STOP_DISTANCE):
         if stop.withinRadius(x, y, STOP_DISTANCE):
             return False
     return True
@@ -83,14 +106,412 @@ def getViewCoords(x, y, offset):
     return [(x-offset[1][0])*offset[0][0], (y-offset[1][1])*offset[0][1]]
 
 
+def getPassengerSlots(vehicles, points, offset):
+    """ (list, list, list) -> numpy.ndarray
+        Returns the view coordinates of the passenger slots of every
+        train or carriage in "vehicles" as an array indexed as
+        [vehicle, slot, 0 for x or 1 for y].
+        "points" are the slots of a train centered around the origin,
+        which get rotated and translated for all vehicles at once.
+    """
+    points = numpy.array(points, dtype=float)
+    angles = numpy.array([vehicle._angle for vehicle in vehicles], dtype=float)
+    positions = numpy.array([vehicle.getPosition() for vehicle in vehicles], dtype=float).reshape(-1, 2)
+    cos = numpy.cos(angles)[:, None]
+    sin = numpy.sin(angles)[:, None]
+    centerXs = ((positions[:, 0]-offset[1][0])*offset[0][0])[:, None]
+    centerYs = ((positions[:, 1]-offset[1][1])*offset[0][1])[:, None]
+    xs = points[:, 0]*cos - points[:, 1]*sin + centerXs
+    ys = points[:, 0]*sin + points[:, 1]*cos + centerYs
+    return numpy.dstack((xs, ys))
+
+
+def reserveEntityIds(lastId):
+    """ (int) -> None
+        Makes every entity created from now on get an ID above
+        "lastId", so that entities loaded with their old IDs keep
+        them unique.
+    """
+    global _entityIds
+    _entityIds = itertools.count(max(next(_entityIds), lastId+1))
+
+
+def _copySlots(entity, slots):
+    # copy.copy() of an object with slots goes through __reduce_ex__,
+    # copying the slots that are set directly is much faster
+    clone = object.__new__(entity.__class__)
+    for name in slots:
+        value = getattr(entity, name, _UNSET)
+        if value is not _UNSET:
+            setattr(clone, name, value)
+    return clone
+
+
+def _isTransferAhead(train, segmentNum):
+    # Returns if the train reaches a transfer at the end of the
+    # segment "segmentNum" of its line without reversing
+    if train.direction == 1:
+        return segmentNum > train.segmentNum
+    return segmentNum <= train.segmentNum
+
+
+class SpatialGrid(object):
+    # uniform grid that buckets items by the cells their bounding
+    # boxes cover, so that items near a point can be found by only
+    # looking at a few cells instead of every item
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self._cells = {}
+
+    def _getCells(self, x1, y1, x2, y2):
+        # get the keys of all the cells that the box covers
+        cells = []
+        for i in range(int(math.floor(x1/self.cellSize)),
+                       int(math.floor(x2/self.cellSize))+1):
+            for j in range(int(math.floor(y1/self.cellSize)),
+                           int(math.floor(y2/self.cellSize))+1):
+                cells.append((i, j))
+        return cells
+
+    def insert(self, item, x1, y1, x2, y2):
+        """ (object, num, num, num, num) -> None
+            Adds "item" to every cell covered by the box with the
+            corners (x1, y1) and (x2, y2).
+        """
+        for cell in self._getCells(x1, y1, x2, y2):
+            if cell in self._cells:
+                self._cells[cell].append(item)
+            else:
+                self._cells[cell] = [item]
+
+    def remove(self, item, x1, y1, x2, y2):
+        """ (object, num, num, num, num) -> None
+            Removes "item" from the cells covered by the box it was
+            inserted with.
+        """
+        for cell in self._getCells(x1, y1, x2, y2):
+            if cell in self._cells:
+                bucket = self._cells[cell]
+                for i in range(len(bucket)):
+                    if bucket[i] is item:
+                        bucket.pop(i)
+                        break
+                if len(bucket) == 0:
+                    del self._cells[cell]
+
+    def clear(self):
+        self._cells = {}
+
+    def query(self, x1, y1, x2, y2):
+        """ (num, num, num, num) -> list
+            Returns every item in the cells covered by the box with the
+            corners (x1, y1) and (x2, y2), each item only once. Items
+            may be outside the box itself, so callers still have to do
+            their own exact check.
+        """
+        found = []
+        seen = set()
+        for cell in self._getCells(x1, y1, x2, y2):
+            if cell in self._cells:
+                for item in self._cells[cell]:
+                    if id(item) not in seen:
+                        seen.add(id(item))
+                        found.append(item)
+        return found
+
+    def queryRadius(self, x, y, radius):
+        # get the items in the cells around a circle
+        return self.query(x-radius, y-radius, x+radius, y+radius)
+
+
+class RiverMask(object):
+    # boolean array of which pixels of the map are river, so that water
+    # can be looked up for many points at once instead of reading
+    # pixels from the map surface one at a time
+    def __init__(self, mapSurface, mask=None):
+        # a mask that was already found for the map can be given
+        # instead, since reading every pixel of a big map is slow
+        if mask is None:
+            pixels = pygame.surfarray.array3d(mapSurface)
+            river = COLOURS.get("river")
+            # indexed as mask[x, y], like the surface
+            mask = ((pixels[:, :, 0] == river[0])
+                    & (pixels[:, :, 1] == river[1])
+                    & (pixels[:, :, 2] == river[2]))
+        self.mask = mask
+        self.width, self.height = self.mask.shape
+
+    def isWater(self, x, y):
+        """ (num, num) -> bool
+            Returns if the world pixel at (x, y) is river. Points off
+            the map are not river.
+        """
+        x = int(x)
+        y = int(y)
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        return bool(self.mask[x, y])
+
+    def getWater(self, xs, ys):
+        """ (numpy.ndarray, numpy.ndarray) -> numpy.ndarray
+            Vectorized version of isWater for arrays of x and y
+            coordinates. Returns a boolean array.
+        """
+        xs = xs.astype(int)
+        ys = ys.astype(int)
+        isInside = (xs >= 0) & (ys >= 0) & (xs < self.width) & (ys < self.height)
+        water = numpy.zeros(len(xs), dtype=bool)
+        water[isInside] = self.mask[xs[isInside], ys[isInside]]
+        return water
+
+    def getWaterIntervals(self, x, y, angle, length):
+        """ (num, num, float, num) -> list
+            Follows the line that starts at (x, y) and goes "length"
+            world pixels away in the direction of "angle", checking
+            every pixel.
+            Returns a list of [start, end] distances from (x, y) for
+            each stretch of the line that is over water.
+        """
+        distances = numpy.arange(0, length, 1.0)
+        water = self.getWater(x+distances*math.cos(angle),
+                              y+distances*math.sin(angle))
+        # pad with dry points on both ends so that every stretch
+        # of water has both a start and an end
+        changes = numpy.diff(numpy.concatenate(([0], water.astype(numpy.int8), [0])))
+        starts = numpy.flatnonzero(changes == 1)
+        ends = numpy.flatnonzero(changes == -1)-1
+        intervals = []
+        for i in range(len(starts)):
+            intervals.append([distances[starts[i]], distances[ends[i]]])
+        return intervals
+
+
+class SpriteCache(object):
+    # keeps lists of smoothscaled copies of source images, keyed by
+    # the pixel size they were scaled to, so that zooming the camera
+    # back and forth does not smoothscale the same sprites every frame.
+    # once "capacity" sizes are stored, the least recently used
+    # size is thrown away
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._sources = {}
+        self._sprites = collections.OrderedDict()
+
+    def addSources(self, name, surfaces):
+        self._sources[name] = surfaces
+
+    def get(self, name, size):
+        """ (str, int) -> list
+            Returns a list of the "name" source images smoothscaled to
+            size x size pixels.
+        """
+        key = (name, size)
+        if key in self._sprites:
+            # move to the most recently used end
+            sprites = self._sprites.pop(key)
+        else:
+            sprites = []
+            for surface in self._sources[name]:
+                sprites.append(pygame.transform.smoothscale(surface, (size, size)))
+            if len(self._sprites) >= self.capacity:
+                self._sprites.popitem(False)
+        self._sprites[key] = sprites
+        return sprites
+
+
+class PickBuffer(object):
+    # off-screen copy of the clickable parts of the view, where every
+    # pixel is coloured with the ID of the line or train drawn there
+    # instead of its real colour, so that finding what is under the
+    # mouse is a single pixel lookup. lines are drawn onto a base that
+    # is only redrawn when the lines change, and trains are drawn on
+    # top every frame after cleaning up where they were last frame
+    def __init__(self, width, height):
+        self.base = pygame.Surface((width, height), 0, 32)
+        self.surface = pygame.Surface((width, height), 0, 32)
+        self._entities = {}  # ID -> line or train
+        self._ids = {}  # line or train -> ID
+        self._dirtyRects = []
+
+    def clear(self):
+        # forget every ID, for when everything is about to be redrawn
+        self.base.fill((0, 0, 0))
+        self._entities = {}
+        self._ids = {}
+
+    def getColour(self, entity):
+        """ (object) -> tuple
+            Returns the colour that "entity" should be drawn with.
+            ID 0 (black) is left for empty space.
+        """
+        if entity not in self._ids:
+            entityID = len(self._entities)+1
+            self._ids[entity] = entityID
+            self._entities[entityID] = entity
+        entityID = self._ids[entity]
+        return ((entityID >> 16) & 255, (entityID >> 8) & 255, entityID & 255)
+
+    def startFrame(self, isBaseChanged):
+        # remove everything drawn over the base last frame
+        if isBaseChanged:
+            self.surface.blit(self.base, (0, 0))
+        else:
+            for rect in self._dirtyRects:
+                self.surface.blit(self.base, rect, rect)
+        self._dirtyRects = []
+
+    def markDirty(self, rect):
+        self._dirtyRects.append(rect)
+
+    def getEntity(self, point):
+        """ (tuple) -> object
+            Returns the line or train drawn at the view coordinates
+            "point", or None if there is nothing there.
+        """
+        colour = self.surface.get_at(point)
+        return self._entities.get((colour[0] << 16) | (colour[1] << 8) | colour[2])
+
+
+class RandomStreams(object):
+    # a random number generator for each part of the game (named in
+    # RANDOM_STREAMS), all made from one seed. the same seed always
+    # plays the same game, and using more random numbers in one part
+    # does not change what happens in the others
+    def __init__(self, seed=None):
+        if seed is None:
+            # take the seed from the random module, so that
+            # seeding it still repeats a game
+            seed = random.getrandbits(32)
+        self.seed = seed
+        for i in range(len(RANDOM_STREAMS)):
+            setattr(self, RANDOM_STREAMS[i], random.Random(seed*len(RANDOM_STREAMS)+i))
+
+
+class EntityList(object):
+    # holds trains or carriages in the order they were added, like a
+    # list, but finds and removes any of them without searching. an
+    # entity is only held once. entities are keyed by themselves and
+    # not their IDs, since a moving clone has the ID of its original.
+    # removing an entity leaves a hole in its place, and the holes are
+    # closed up the next time the order is needed, so that going
+    # through the entities is as fast as going through a list.
+    # entities can be added, removed or replaced while going through
+    # them, which goes through them as they were when it started. the
+    # list being gone through is only copied if it is changed, instead
+    # of every time it is gone through
+    def __init__(self, entities=()):
+        self._entities = []
+        self._indices = {}  # entity -> index in _entities
+        self._holes = 0
+        self._isShared = False  # whether _entities may be being gone through
+        for entity in entities:
+            self.append(entity)
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __iter__(self):
+        if self._holes > 0:
+            self._closeHoles()
+        self._isShared = True
+        return iter(self._entities)
+
+    def __reversed__(self):
+        if self._holes > 0:
+            self._closeHoles()
+        self._isShared = True
+        return reversed(self._entities)
+
+    def __contains__(self, entity):
+        return entity in self._indices
+
+    def _closeHoles(self):
+        entities = []
+        for entity in self._entities:
+            if entity is not _REMOVED:
+                self._indices[entity] = len(entities)
+                entities.append(entity)
+        self._entities = entities
+        self._holes = 0
+        self._isShared = False
+
+    def _unshare(self):
+        # copy the entities before changing them if they may be being
+        # gone through
+        if self._isShared:
+            self._entities = list(self._entities)
+            self._isShared = False
+
+    def append(self, entity):
+        if entity not in self._indices:
+            self._unshare()
+            self._indices[entity] = len(self._entities)
+            self._entities.append(entity)
+
+    def remove(self, entity):
+        self._unshare()
+        self._entities[self._indices.pop(entity)] = _REMOVED
+        self._holes = self._holes+1
+
+    def discard(self, entity):
+        # remove the entity if it is held
+        if entity in self._indices:
+            self.remove(entity)
+
+    def pop(self):
+        """ (None) -> object
+            Removes and returns the entity that was added last.
+        """
+        if self._holes > 0:
+            self._closeHoles()
+        self._unshare()
+        entity = self._entities.pop()
+        del self._indices[entity]
+        return entity
+
+    def clear(self):
+        self._entities = []
+        self._indices = {}
+        self._holes = 0
+        self._isShared = False
+
+    def getFirst(self):
+        if self._holes > 0:
+            self._closeHoles()
+        return self._entities[0]
+
+    def getLast(self):
+        if self._holes > 0:
+            self._closeHoles()
+        return self._entities[-1]
+
+    def replace(self, entity, newEntity):
+        # put "newEntity" in the place of "entity"
+        self._unshare()
+        index = self._indices.pop(entity)
+        self._entities[index] = newEntity
+        self._indices[newEntity] = index
+
+
 class World(object):
-    def __init__(self, mapSurface, stopSize=30, passengerSize=10):
+    def __init__(self, mapSurface, stopSize=30, passengerSize=10, clock=None, riverMask=None,
+                 randomStreams=None):
         self.stops = []
+        # index of stops by location, for finding stops near a point
+        self.stopGrid = SpatialGrid(STOP_DISTANCE)
+        # index of committed segments by their bounding boxes, holding
+        # [line, segment] pairs. _indexedSegments remembers what was
+        # inserted for each line so it can be taken out again
+        self.segmentGrid = SpatialGrid(STOP_DISTANCE)
+        self._indexedSegments = {}
         self.lines = []
-        self.trains = []
-        self.carriages = []
+        self.trains = EntityList()
+        self.carriages = EntityList()
         self.trainSpeed = 1
         self._map = mapSurface
+        if riverMask is None:
+            riverMask = RiverMask(mapSurface)
+        self.riverMask = riverMask
         self.stopSize = stopSize
         self.passengerSize = passengerSize
         self.width = mapSurface.get_width()
@@ -103,6 +524,11 @@ class World(object):
         self.totalTunnels = self.resources[TUNNEL]
         self.iconHitboxes = [None]*4
         self.passengersMoved = 0
+        # clock that the timers of every stop read from
+        self.clock = clock
+        if randomStreams is None:
+            randomStreams = RandomStreams()
+        self.randomStreams = randomStreams
 
     def addRandomStop(self, shape, stopSurfaces):
         """ (int, list) -> bool, bool
@@ -113,21 +539,21 @@ class World(object):
             maximum map area has been reached.
         """
         # makes shape in random valid location
+        randomStream = self.randomStreams.stops
         count = 0
-        x = random.randint(self.width/2-self.validStopDistanceX+self.passengerSize*6,
-                           self.width/2+self.validStopDistanceX-self.passengerSize*6)
-        y = random.randint(self.height/2-self.validStopDistanceY+self.stopSize*3,
-                           self.height/2+self.validStopDistanceY-self.stopSize*3)
+        x = randomStream.randint(self.width/2-self.validStopDistanceX+self.passengerSize*6,
+                                 self.width/2+self.validStopDistanceX-self.passengerSize*6)
+        y = randomStream.randint(self.height/2-self.validStopDistanceY+self.stopSize*3,
+                                 self.height/2+self.validStopDistanceY-self.stopSize*3)
         # try 15 times to generate a valid stop
-        while (not _isValidSpawn(x, y, self.stops, self._map)) and count < 15:
-            x = random.randint(self.width/2-self.validStopDistanceX+self.passengerSize*6,
-                               self.width/2+self.validStopDistanceX-self.passengerSize*6)
-            y = random.randint(self.height/2-self.validStopDistanceY+self.stopSize*3,
-                               self.height/2+self.validStopDistanceY-self.stopSize*3)
+        while (not _isValidSpawn(x, y, self.stopGrid, self.riverMask)) and count < 15:
+            x = randomStream.randint(self.width/2-self.validStopDistanceX+self.passengerSize*6,
+                                     self.width/2+self.validStopDistanceX-self.passengerSize*6)
+            y = randomStream.randint(self.height/2-self.validStopDistanceY+self.stopSize*3,
+                                     self.height/2+self.validStopDistanceY-self.stopSize*3)
             count = count+1
         if count < 15:
-            timer = Time.Time(Time.MODE_STOPWATCH, Time.FORMAT_TOTAL_SECONDS, 0)
-            self.stops.append(Stop(x, y, shape, stopSurfaces, timer))
+            self.addStop(x, y, shape, stopSurfaces)
             return False, False
         # if a stop isn't generated within 15 tries,
         # try to expand the generation area
@@ -143,7 +569,43 @@ class World(object):
                                               * (float(self.height)/self.width))
                 return True, False
 
-    def switchRandomStop(self, shapeRange, existingStops, worldSurface):
+    def addStop(self, x, y, shape, stopSurfaces):
+        """ (int, int, int, list) -> Stop
+            Creates a stop of the given shape at (x, y) without checking
+            if the location is valid. Returns the new stop.
+        """
+        timer = Time.Time(Time.MODE_STOPWATCH, Time.FORMAT_TOTAL_SECONDS, 0, self.clock)
+        stop = Stop(x, y, shape, stopSurfaces, timer)
+        self.stops.append(stop)
+        self.stopGrid.insert(stop, x, y, x, y)
+        return stop
+
+    def getStopsNear(self, x, y, radius):
+        """ (num, num, num) -> list
+            Returns the stops that are less than "radius" world pixels
+            away from the point (x, y).
+        """
+        stops = []
+        for stop in self.stopGrid.queryRadius(x, y, radius):
+            if stop.withinRadius(x, y, radius):
+                stops.append(stop)
+        return stops
+
+    def getNearestStop(self, x, y, radius):
+        """ (num, num, num) -> Stop
+            Returns the closest stop that is less than "radius" world
+            pixels away from the point (x, y), or None if there is none.
+        """
+        nearestStop = None
+        lowestDistance = radius
+        for stop in self.getStopsNear(x, y, radius):
+            distance = findDistance(stop.getPosition(), (x, y))
+            if distance < lowestDistance:
+                lowestDistance = distance
+                nearestStop = stop
+        return nearestStop
+
+    def switchRandomStop(self, shapeRange, existingStops):
         """ (int) -> int
             Picks a random stop (circle, triangle, or square) and
             changes the shape of the stop to a special one.
@@ -151,25 +613,30 @@ class World(object):
             was converted to as an int.
         """
         # try 10 times to get a random shape that isn't used
+        randomStream = self.randomStreams.switches
         count = 0
-        newShape = random.choice(shapeRange)
+        newShape = randomStream.choice(shapeRange)
         while newShape in existingStops and count < 10:
-            newShape = random.choice(shapeRange)
+            newShape = randomStream.choice(shapeRange)
             count = count+1
         if count == 10:
             return -1
         # try 10 times to find a non-special stop to switch
         count = 0
-        newStop = self.stops[random.randint(0, len(self.stops)-1)]
+        newStop = self.stops[randomStream.randint(0, len(self.stops)-1)]
         while newStop.shape > SQUARE and count < 10:
-            newStop = self.stops[random.randint(0, len(self.stops)-1)]
+            newStop = self.stops[randomStream.randint(0, len(self.stops)-1)]
             count = count+1
         if count == 10:
             return -1
         else:
             newStop.shape = newShape
+            # only the shapes on the lines through the stop changed, and
+            # those lines all meet at the stop, so they share routes
             for line in newStop.lines:
-                line.update(worldSurface, False)
+                line.updateStopNums()
+            if len(newStop.lines) > 0:
+                newStop.lines[0].updateRoutes()
             return newShape
 
     def createNewLine(self, mouseObject, stop):
@@ -190,42 +657,52 @@ class World(object):
         line.createMouseSegments(-1, mouseObject, None, stop)
         return newLine
 
-    def getClickedLine(self, colour):
-        """ (tuple) -> int
-            "colour" is a tuple of length 3 (R, G, B).
-            Returns the index of the line with the colour given, or
-            -1 if no line has that colour.
+    def commitLine(self, line):
+        # commit the changes made to a line while it was being edited
+        # and update the index of segments to match
+        line.update(self.riverMask, True)
+        self.updateTunnels()
+        self.indexSegments(line)
+
+    def indexSegments(self, line):
+        # replace the segments of the line in the index of
+        # segments with its committed segments
+        self._unindexSegments(line)
+        for segment in line.segments:
+            indexEntry = [line, segment]
+            self.segmentGrid.insert(indexEntry, *segment.bounds)
+            self._indexedSegments[line].append(indexEntry)
+
+    def _unindexSegments(self, line):
+        if line in self._indexedSegments:
+            for indexEntry in self._indexedSegments[line]:
+                self.segmentGrid.remove(indexEntry, *indexEntry[1].bounds)
+        self._indexedSegments[line] = []
+
+    def getSegmentFromWorld(self, mouseObject, line=None):
+        """ (MousePosition, Line) -> list
+            Returns [line index, segment index] of the committed segment
+            closest to the mouse, or -1 if no segment is within
+            SEGMENT_CLICK_DISTANCE. If "line" is given, only segments
+            of that line are considered.
         """
-        # there must be a check to see if the colour is in the line list first because
-        # the Tuple.index method throws an exception if it is not in it
-        if colour in COLOURS.get("lines"):
-            return COLOURS.get("lines").index(colour)
-        else:
-            return -1
-
-    def getSegmentFromWorld(self, mouseObject, offset):
-        # as opposed to getting a segment from a specific line
-        clickedSegments = []
-        for i in range(len(self.lines)):
-            for j in range(len(self.lines[i].segments)):
-                if self.lines[i].segments[j].rect.collidepoint(mouseObject.getView(offset)):
-                    clickedSegments.append([i, j])
-        if len(clickedSegments) > 1:
-            lowestDistance = [1000000, [-1, -1]]
-            for segment in clickedSegments:
-                distanceScore = (self.lines[segment[0]].segments[segment[1]]
-                                 .getDistanceScore(mouseObject.getWorld()))
-                if distanceScore < lowestDistance[0]:
-                    lowestDistance = [distanceScore, segment]
-            return lowestDistance[1]
-        elif len(clickedSegments) == 1:
-            return clickedSegments[0]
-        else:
+        mouseWorld = mouseObject.getWorld()
+        lowestDistance = [SEGMENT_CLICK_DISTANCE, None]
+        for indexEntry in self.segmentGrid.queryRadius(mouseWorld[0],
+                                                       mouseWorld[1],
+                                                       SEGMENT_CLICK_DISTANCE):
+            if line is not None and indexEntry[0] is not line:
+                continue
+            distance = indexEntry[1].getDistance(mouseWorld)
+            if distance < lowestDistance[0]:
+                lowestDistance = [distance, indexEntry]
+        if lowestDistance[1] is None:
             return -1
+        return [self.lines.index(lowestDistance[1][0]), lowestDistance[1][1].index]
 
-    def getLineByHitbox(self, mouseObject, offset):
+    def getLineByHitbox(self, mouseObject):
         # as opposed to getting the clicked line by colour
-        segment = self.getSegmentFromWorld(mouseObject, offset)
+        segment = self.getSegmentFromWorld(mouseObject)
         if segment != -1:
             return segment[0]
         else:
@@ -237,68 +714,62 @@ class World(object):
                 return i
         return -1
 
-    def getClickedTrainLine(self, colour):
-        # get the line that the clicked train is on
-        for i in range(len(self.lines)):
-            if colour == self.lines[i].BRIGHTER_COLOUR:
-                return i
-        return -1
-
-    def getClickedTrain(self, mouseView, line):
-        # get a train or carriage on a line
-        trains = self.lines[line].trains
-        for train in trains:
-            if train.rect.collidepoint(mouseView):
-                return train, "train"
-            for carriage in train.carriages:
-                if carriage.rect.collidepoint(mouseView):
-                    return carriage, "carriage"
-        for abandonedLine in self.lines[line].abandonedChildren:
-            for train in abandonedLine.trains:
-                if train.rect.collidepoint(mouseView):
-                    return train, "train"
-                for carriage in train.carriages:
-                    if carriage.rect.collidepoint(mouseView):
-                        return carriage, "carriage"
-        return -1
+    def updateTunnels(self):
+        # update the tunnels available from the tunnels used by every
+        # line, including segments that are still being edited
+        numTunnels = 0
+        for line in self.lines:
+            numTunnels = numTunnels+line.tunnelCount
+        self.resources[TUNNEL] = self.totalTunnels-numTunnels
 
     def removeLine(self, index):
         # remove a line and everything on it
+        self._unindexSegments(self.lines[index])
+        del self._indexedSegments[self.lines[index]]
         childLines = self.lines[index].abandonedChildren
         for i in range(len(childLines)-1, -1, -1):
-            for j in range(len(childLines[i].trains)-1, -1, -1):
-                for carriage in childLines[i].trains[j].carriages:
+            for train in reversed(childLines[i].trains):
+                for carriage in train.carriages:
                     self.resources[CARRIAGE] = self.resources[CARRIAGE]+1
                     self.carriages.remove(carriage)
-                    childLines[i].trains[j].carriages.remove(carriage)
+                    train.carriages.remove(carriage)
                     carriage.remove()
-                self.trains.remove(childLines[i].trains[j])
+                self.trains.remove(train)
                 self.resources[TRAIN] = self.resources[TRAIN]+1
-                childLines[i].trains[j].remove()
-                childLines[i].trains.pop(j)
+                train.remove()
+                childLines[i].trains.remove(train)
             self.lines[index].abandonedChildren.pop(i)
         self.lines.pop(index)
         self.resources[LINE] = self.resources[LINE]+1
+        self.updateTunnels()
 
 
 class Stop(object):
+    # pre-rendered overcrowding gauges shared by all stops, as
+    # (shape, size) -> list of GAUGE_LEVELS+1 frames that get
+    # rendered the first time they are needed
+    _GAUGE_FRAMES = collections.OrderedDict()
+    # stops, passengers, segments, trains and carriages have slots
+    # instead of attribute dicts, since large worlds have thousands of
+    # them. they compare and hash by identity
+    __slots__ = ["id", "_STOP_SURFACES", "X", "Y", "shape", "passengers", "timer",
+                 "usingTimer", "trains", "lines"]
+
     def __init__(self, x, y, shape, surfaces, timer):
+        self.id = next(_entityIds)
         self._STOP_SURFACES = surfaces
         self.X = x
         self.Y = y
         self.shape = shape
-        self.passengers = []
+        self.passengers = PassengerQueue(False)
         self.timer = timer
         self.usingTimer = False
         self.timer.toggleActive()
-        self.trains = []  # trains stopped at the stop
+        self.trains = EntityList()  # trains stopped at the stop
         self.lines = []  # lines that pass through this stop
 
-    def __eq__(self, other):
-        # overrided definition of Stop == Stop
-        # if the coordinates of both stops are equal, the
-        # stops are considered equal
-        return self.X == other.X and self.Y == other.Y
+    def __copy__(self):
+        return _copySlots(self, Stop.__slots__)
 
     def withinRadius(self, x, y, radius):
         """ (int, int, int) -> bool
@@ -313,64 +784,108 @@ class Stop(object):
         """
         return self.X, self.Y
 
-    def draw(self, targetSurface, size, passengerSize, offset):
-        """ (pygame.Surface, int, int, list) -> None
-            Draws the stop "self" onto "targetSurface", as well as any
-            passengers at that stop.
+    def draw(self, targetSurface, size, offset, loseDuration=LOSE_DURATION):
+        """ (pygame.Surface, int, list, num) -> pygame.Rect
+            Draws the stop "self" onto "targetSurface". Passengers at
+            the stop are drawn separately through addPassengerBlits().
             Offset is a list containing the scale for x and y as well
             as the translation for x and y required to transform world
-            coordinates into view coordinates.
+            coordinates into view coordinates. The overcrowding gauge
+            fills up after "loseDuration" seconds, which should be the
+            simulation's loseDuration parameter.
+            Returns the area of "targetSurface" that was drawn on.
         """
         # convert the world coordinates of the stop to view coordinates
         stopView = getViewCoords(self.X, self.Y, offset)
         stopView[0] = stopView[0]-size/2
         stopView[1] = stopView[1]-size/2
-        targetSurface.blit(self._STOP_SURFACES[self.shape], stopView)
+        drawnRect = targetSurface.blit(self._STOP_SURFACES[self.shape], stopView)
         if self.usingTimer:
-            self.timer.tick()
-            width = self._STOP_SURFACES[self.shape].get_width()*2
-            stop = pygame.Surface((width, width))
-            stop.blit(self._STOP_SURFACES[self.shape], (width/2-size/2, width/2-size/2))
+            # the timer is kept up to date by the game loop
+            fill = min(max(self.timer.time, 0)/float(loseDuration), 1)
+            gauge = self._getGauge(int(fill*GAUGE_LEVELS))
+            drawnRect.union_ip(targetSurface.blit(gauge,
+                                                  (stopView[0]-size/2-1,
+                                                   stopView[1]-size/2-1)))
+        return drawnRect
+
+    def addPassengerBlits(self, blitSequence, passengerSurfaces, size, passengerSize, offset):
+        """ (list, list, int, int, list) -> None
+            Adds (surface, position) pairs to "blitSequence" for every
+            passenger at the stop "self", so that the passengers of
+            every stop can be drawn with one Surface.blits() call.
+            "passengerSurfaces" has the surface of each shape.
+        """
+        # the passengers go to the side of the stop, in rows of 6
+        # (so if a 7th passenger spawns, it'll appear in another row)
+        stopView = getViewCoords(self.X, self.Y, offset)
+        left = stopView[0]-size/2+size*1.4-passengerSize/2
+        top = stopView[1]-size/2-passengerSize/2
+        shapes = self.passengers.getShapes()
+        for i in range(len(shapes)):
+            blitSequence.append((passengerSurfaces[shapes[i]],
+                                 (left+(i % 6)*passengerSize, top+(i/6)*passengerSize)))
+
+    def _getGauge(self, level):
+        """ (int) -> pygame.Surface
+            Returns the overcrowding gauge for the stop "self" filled
+            to level/GAUGE_LEVELS, with a one pixel border to fit the
+            outer ring.
+        """
+        stopSurface = self._STOP_SURFACES[self.shape]
+        size = stopSurface.get_width()
+        key = (self.shape, size)
+        if key in Stop._GAUGE_FRAMES:
+            # move to the most recently used end
+            frames = Stop._GAUGE_FRAMES.pop(key)
+        else:
+            frames = [None]*(GAUGE_LEVELS+1)
+            if len(Stop._GAUGE_FRAMES) >= GAUGE_CACHE_SIZE:
+                Stop._GAUGE_FRAMES.popitem(False)
+        Stop._GAUGE_FRAMES[key] = frames
+
+        if frames[level] is None:
+            fill = level/float(GAUGE_LEVELS)
+            width = size*2
+            # leave a pixel around the outside for the outer ring
+            gauge = pygame.Surface((width+2, width+2))
+            gauge.blit(stopSurface, (width/2-size/2+1, width/2-size/2+1))
             # draw the red fill the changes the stop colour
             # the pygame.draw.arc() function leaves some pixels empty which causes it to look
             # bad, but there is no other (easy and simple) way to do this
-            pie = pygame.Surface((width, width))
+            pie = pygame.Surface((width+2, width+2))
             pygame.draw.arc(pie,
                             (255, 45, 45),
-                            pie.get_rect(),
+                            (1, 1, width, width),
                             math.pi/2.0,
-                            math.pi/2.0+(2*math.pi*(max(self.timer.time, 0)/LOSE_DURATION)),
+                            math.pi/2.0+(2*math.pi*fill),
                             width/2)
-            stop.blit(pie, (0, 0), None, pygame.BLEND_MIN)
-            stop.set_colorkey((0, 0, 0))
-            targetSurface.blit(stop, (stopView[0]-size/2, stopView[1]-size/2))
+            gauge.blit(pie, (0, 0), None, pygame.BLEND_MIN)
             # draw the outer ring
-            pygame.gfxdraw.arc(targetSurface,
-                               int(stopView[0]+size/2),
-                               int(stopView[1]+size/2),
+            pygame.gfxdraw.arc(gauge,
+                               size/2*2+1,
+                               size/2*2+1,
                                width/2,
-                               max(int(-90-360*(max(self.timer.time, 0)/LOSE_DURATION)), -449),
+                               max(int(-90-360*fill), -449),
                                -90,
                                (255, 0, 0))
-        for i in range(len(self.passengers)):
-            # draw the passenger to the side of the stop, in rows of 6
-            # (so if a 7th passenger spawns, it'll appear in another row)
-            self.passengers[i].draw(targetSurface,
-                                    passengerSize,
-                                    stopView[0] + size*1.4 + (i % 6)*passengerSize,
-                                    stopView[1] + (i/6)*passengerSize)
-
-    def addRandomPassenger(self, shapes, passengerSurfaces):
-        """ (int, list) -> None
-            Creates a passenger of the given shape (given by an
-            integer 0-8) at this stop.
+            gauge.set_colorkey((0, 0, 0))
+            frames[level] = gauge
+        return frames[level]
+
+    def addRandomPassenger(self, shapes, randomStream=random):
+        """ (list, random.Random) -> None
+            Adds a passenger going to one of "shapes" (integers 0-8)
+            other than the shape of the stop, picked with "randomStream".
         """
         shapes = list(shapes)
         shapes.remove(self.shape)
-        self.passengers.append(Passenger(random.choice(shapes), passengerSurfaces))
+        self.passengers.add(randomStream.choice(shapes))
 
     def processTrain(self, train, trainsToMove):
         # load or unload passengers that can move
+        if len(trainsToMove) == 0:
+            return self.movePassenger(train, False)
         for carriage in train.carriages:
             if carriage.movingClone in trainsToMove:
                 return self.movePassenger(train, True)
@@ -379,99 +894,87 @@ class Stop(object):
         else:
             return self.movePassenger(train, False)
 
-    def isValidTransfer(self, path, transfer):
-        # if the transfer's line has already been visited,
-        # ignore it
-        for step in path:
-            if transfer[1] == step[1]:
-                return False
-        return True
-
-    def findPath(self, currentLine, passenger, path):
-        # recursively finds the first path to the target stop
-        # not the fastest path but it doesn't matter
-        # for a game like this
-        if passenger.SHAPE in currentLine.stopNums:
-            index = currentLine.stopNums.index(passenger.SHAPE)
-            path.append([index, currentLine])
-            return path
-        else:
-            for transfer in currentLine.transfers:
-                if self.isValidTransfer(path, transfer):
-                    newPath = list(path)
-                    newPath.append(transfer)
-                    foundPath = self.findPath(transfer[1], passenger, newPath)
-                    if foundPath != -1:
-                        return foundPath
-        return -1
-
     def findValidPassenger(self, train):
-        for i in range(len(self.passengers)):
-            # first, see if the stop it wants to go to
-            # is reachable by train without the train needing
-            # to reverse direction
-            foundPath = len(self.passengers[i].path) > 0
-            if (train.direction == 1
-                    and (self.passengers[i].SHAPE in train.line.stopNums[train.segmentNum:]
-                         or (foundPath
-                             and self.passengers[i].path[1][0] > train.segmentNum
-                             and train in self.passengers[i].path[0][1].trains))):
-                return i
-            elif (train.direction == -1
-                  and (self.passengers[i].SHAPE in train.line.stopNums[:train.segmentNum+1]
-                       or (foundPath
-                           and self.passengers[i].path[1][0] <= train.segmentNum
-                           and train in self.passengers[i].path[0][1].trains))):
-                return i
-            # then, check all lines directly accessible to the passenger/stop
-            if not foundPath:
-                for line in self.lines:
-                    if self.passengers[i].SHAPE in line.stopNums:
-                        foundPath = True  # do nothing, wait until the right train comes
-            # finally, if all else fails, find a path along the whole network
-            if not foundPath:
-                for line in self.lines:
-                    path = [[-1, line]]
-                    path = self.findPath(line, self.passengers[i], list(path))
-                    if path != -1:
-                        self.passengers[i].path = path
-                        if (train.direction == 1
-                                and self.passengers[i].path[1][0] > train.segmentNum):
-                            return i
-                        elif (train.direction == -1
-                              and self.passengers[i].path[1][0] <= train.segmentNum):
-                            return i
-        return -1
+        """ (Train) -> int or Passenger
+            Returns a passenger waiting at the stop "self" that "train"
+            can take to the stop it wants to go to, or to the transfer
+            on its route, without reversing direction. Returns None if
+            there is none. Passengers going straight to a shape are
+            returned as the shape (see PassengerQueue).
+        """
+        line = train.line
+        passengers = self.passengers
+        directMask = passengers.getDirectMask()
+        if directMask == 0 and not passengers.hasRouted():
+            return None
+        # first, see if the stop it wants to go to
+        # is reachable by train without the train needing
+        # to reverse direction
+        aheadMask = directMask & line.getShapesAhead(train.segmentNum, train.direction)
+        if aheadMask != 0:
+            return MASK_SHAPES[aheadMask][0]
+
+        # then, passengers going to shapes that no line through
+        # this stop goes to look up the first transfer to take
+        # in the routing table of each line at this stop
+        for stopLine in self.lines:
+            # do nothing for the rest, wait until the right train comes
+            directMask = directMask & ~stopLine.shapeMask
+        for shape in MASK_SHAPES[directMask]:
+            routeLine = None
+            for stopLine in self.lines:
+                if shape in stopLine.routes:
+                    routeLine = stopLine
+                    # take this train's line if it goes the right way
+                    if (stopLine is line
+                            and _isTransferAhead(train, stopLine.routes[shape][0])):
+                        break
+            if routeLine is not None:
+                passengers.routeDirect(shape, routeLine)
+
+        # finally, passengers with a route can take a train on the
+        # line they ride next if their transfer is ahead of it
+        if train in line.trains:
+            for passenger in passengers.getRouted(line):
+                if _isTransferAhead(train, passenger.path[1][0]):
+                    return passenger
+        return None
 
     def movePassenger(self, train, shouldUnload):
         # move a single passenger
-        index = -1
-        for i in range(len(train.passengers)):
-            if (self.shape == train.passengers[i].SHAPE
-                    or (len(train.passengers[i].path) > 0
-                        and train.passengers[i].path[1][1] in self.lines)):
-                index = i
-        if index > -1:
-            # if a passenger was found that can be moved off the train, move it
-            if len(train.passengers[index].path) > 0:
-                train.passengers[index].path.pop(0)
-                if train.passengers[index].path[-1][1] in self.lines:
-                    train.passengers[index].path = []
-                self.passengers.append(train.passengers.pop(index))
-                return 0
-            else:
-                train.passengers.pop(index)
-                return 1  # one passenger has been moved
-        elif shouldUnload:
+        riding = train.passengers
+        if riding.hasDirect(self.shape):
+            # a passenger has reached the stop it wanted to go to
+            riding.remove(self.shape)
+            return 1  # one passenger has been moved
+        if riding.hasRouted():
+            for line in self.lines:
+                routed = riding.getRouted(line)
+                if len(routed) > 0:
+                    # a passenger transfers to a line through this stop.
+                    # it keeps riding that line from here on, either
+                    # straight to its shape or to the next transfer, so
+                    # it is never routed back onto the train it left
+                    passenger = routed[-1]
+                    riding.remove(passenger)
+                    if (line.shapeMask & (1 << passenger.SHAPE)
+                            or passenger.SHAPE not in line.routes):
+                        self.passengers.add(passenger.SHAPE)
+                    else:
+                        passenger.path = [[-1, line], line.routes[passenger.SHAPE]]
+                        self.passengers.add(passenger)
+                    return 0
+        if shouldUnload:
             # if the train or carriage should be moved to another line, it
             # can't have any passengers on it, so unload move them off
-            self.passengers.append(train.passengers.pop())
+            self.passengers.add(riding.pop())
             return 0
-        index = self.findValidPassenger(train)
+        passenger = self.findValidPassenger(train)
         # if a passenger was found that can be moved onto the train, move it
-        if (index > -1
-                and len(train.passengers) < (len(train.carriages)*6)+6):
-            train.passengers.append(self.passengers.pop(index))
+        if (passenger is not None
+                and len(riding) < (len(train.carriages)*6)+6):
+            self.passengers.remove(passenger)
+            riding.add(passenger)
         else:
             # no passengers can be moved
             if train.setMoving(True):
@@ -480,16 +983,178 @@ class Stop(object):
 
 
 class Passenger(object):
-    def __init__(self, shape, surfaces):
-        self._PASSENGER_SURFACES = surfaces
+    # a passenger that has a route to transfer along. the path is
+    # [[-1, line to ride], [segment to transfer at the end of, line to
+    # transfer to]]. passengers without a route are only kept as the
+    # shape they are going to, see PassengerQueue
+    __slots__ = ["id", "SHAPE", "path"]
+
+    def __init__(self, shape, path):
+        self.id = next(_entityIds)
         self.SHAPE = shape
-        self.path = []
+        self.path = path
+
+
+class PassengerQueue(object):
+    # the passengers waiting at a stop, or riding a train and its
+    # carriages. most passengers only need the shape they are going
+    # to, so they are stored as just that: the number going straight
+    # to each shape is counted, so finding one that can move or
+    # removing it never has to look through them. passengers of the
+    # same shape look the same, so they are drawn grouped by shape.
+    # the few passengers with a route are also kept as Passengers,
+    # bucketed by the line they ride next (at a stop) or the line they
+    # transfer to (on a train). a passenger leaving its bucket has its
+    # place taken by the last passenger in it.
+    # everywhere passengers are handed around, an int is a passenger
+    # going straight to that shape and a Passenger has a route
+    __slots__ = ["_size", "_counts", "_directMask", "_routed", "_routedIndices", "_routeStep"]
+
+    def __init__(self, isRiding):
+        self._size = 0
+        self._counts = [0]*SHAPE_COUNT
+        self._directMask = 0  # bit "shape" is set if any passenger goes straight to it
+        self._routed = {}  # line -> bucket
+        self._routedIndices = {}  # Passenger -> index in its bucket
+        # the step of a routed passenger's path holding its bucket's line
+        if isRiding:
+            self._routeStep = 1
+        else:
+            self._routeStep = 0
+
+    def __len__(self):
+        return self._size
+
+    def __copy__(self):
+        clone = PassengerQueue(self._routeStep == 1)
+        clone._size = self._size
+        clone._counts = list(self._counts)
+        clone._directMask = self._directMask
+        for line in self._routed:
+            clone._routed[line] = list(self._routed[line])
+        clone._routedIndices = dict(self._routedIndices)
+        return clone
+
+    def getShapes(self):
+        """ (None) -> list
+            Returns the shape of every passenger in the order they are
+            drawn.
+        """
+        counts = list(self._counts)
+        for passenger in self.getRouted():
+            counts[passenger.SHAPE] = counts[passenger.SHAPE]+1
+        shapes = []
+        for shape in range(SHAPE_COUNT):
+            if counts[shape] > 0:
+                shapes.extend([shape]*counts[shape])
+        return shapes
+
+    def getDirectMask(self):
+        """ (None) -> int
+            Returns a bitmask with bit "shape" set for every shape that
+            a passenger without a route is going to.
+        """
+        return self._directMask
+
+    def hasDirect(self, shape):
+        return self._counts[shape] > 0
 
-    def draw(self, targetSurface, size, x, y):
-        centerX = x - size/2
-        centerY = y - size/2
-        targetSurface.blit(self._PASSENGER_SURFACES[self.SHAPE],
-                           (centerX, centerY))
+    def hasRouted(self):
+        return len(self._routed) > 0
+
+    def getRouted(self, line=None):
+        """ (Line) -> list or iterator
+            Returns the passengers with a route in the bucket of "line",
+            or an iterator over every passenger with a route if no line
+            is given. The queue must not be changed while they are
+            being used.
+        """
+        if line is None:
+            return itertools.chain.from_iterable(self._routed.itervalues())
+        return self._routed.get(line, [])
+
+    def add(self, passenger):
+        """ (int or Passenger) -> None
+            Adds a passenger going straight to the shape "passenger",
+            or a Passenger with a route.
+        """
+        if isinstance(passenger, Passenger):
+            line = passenger.path[self._routeStep][1]
+            if line in self._routed:
+                bucket = self._routed[line]
+            else:
+                bucket = []
+                self._routed[line] = bucket
+            self._routedIndices[passenger] = len(bucket)
+            bucket.append(passenger)
+        else:
+            self._counts[passenger] = self._counts[passenger]+1
+            self._directMask = self._directMask | (1 << passenger)
+        self._size = self._size+1
+
+    def routeDirect(self, shape, line):
+        """ (int, Line) -> None
+            Gives every passenger going straight to "shape" the route
+            to it that starts with riding "line". Only for passengers
+            waiting at a stop.
+        """
+        # paths are only ever replaced, so the passengers share one
+        path = [[-1, line], line.routes[shape]]
+        if line in self._routed:
+            bucket = self._routed[line]
+        else:
+            bucket = []
+            self._routed[line] = bucket
+        for i in range(self._counts[shape]):
+            passenger = Passenger(shape, path)
+            self._routedIndices[passenger] = len(bucket)
+            bucket.append(passenger)
+        self._counts[shape] = 0
+        self._directMask = self._directMask & ~(1 << shape)
+
+    def remove(self, passenger):
+        """ (int or Passenger) -> None
+            Removes a passenger going straight to the shape "passenger",
+            or the Passenger with a route.
+        """
+        if isinstance(passenger, Passenger):
+            line = passenger.path[self._routeStep][1]
+            bucket = self._routed[line]
+            index = self._routedIndices.pop(passenger)
+            last = bucket.pop()
+            if last is not passenger:
+                bucket[index] = last
+                self._routedIndices[last] = index
+            if len(bucket) == 0:
+                del self._routed[line]
+        else:
+            self._counts[passenger] = self._counts[passenger]-1
+            if self._counts[passenger] == 0:
+                self._directMask = self._directMask & ~(1 << passenger)
+        self._size = self._size-1
+
+    def pop(self):
+        """ (None) -> int or Passenger
+            Removes and returns the passenger drawn last.
+        """
+        shape = self.getShapes()[-1]
+        passenger = shape
+        if not self.hasDirect(shape):
+            # the one made last, so that unloading is repeatable
+            passenger = None
+            for routedPassenger in self.getRouted():
+                if (routedPassenger.SHAPE == shape
+                        and (passenger is None or routedPassenger.id > passenger.id)):
+                    passenger = routedPassenger
+        self.remove(passenger)
+        return passenger
+
+    def clear(self):
+        self._size = 0
+        self._counts = [0]*SHAPE_COUNT
+        self._directMask = 0
+        self._routed.clear()
+        self._routedIndices.clear()
 
 
 class Line(object):
@@ -515,60 +1180,59 @@ class Line(object):
         self.segments = []
         self.stopNums = []  # numeric values of the shape of stops on the line
         self.transfers = []  # for passenger pathfinding (along with stopNums)
+        # bitmasks of the shapes in stopNums (see updateShapeMasks())
+        self.shapeMask = 0
+        self._shapesAhead = {1: [], -1: []}
+        # first transfer to take to reach each shape not on this line,
+        # as {shape: [index of transfer stop, line to transfer to]}
+        self.routes = {}
 
         # temporary list used to edit the line before commiting changes
         self.tempSegments = []
-        self._newStops = []
-        self._removedStops = []
+        self.tunnelCount = 0  # number of segments in tempSegments that are tunnels
+        # stops at either end of a segment in tempSegments, for contains()
+        self._tempStops = set()
+        # stops added to and removed from the line during the edit
+        self._newStops = set()
+        self._removedStops = set()
         self._abandonedSegments = []
         self.mouseSegments = []
         self.isMoving = False  # if the mouse is moving the line
+        # counts commits and edits of tempSegments, so drawings of the
+        # line (like the pick buffer) know when they are stale
+        self.version = 0
 
-        self.trains = []
+        self.trains = EntityList()
 
     def draw(self, targetSurface, width, offset):
+        # returns a list of the areas of targetSurface drawn on
+        drawnRects = []
         for segment in self.tempSegments+self.segments:
             if segment.isAbandoned:
-                segment.draw(targetSurface, self.DARKER_COLOUR, width, offset)
+                drawnRects.append(segment.draw(targetSurface, self.DARKER_COLOUR, width, offset))
             else:
-                segment.draw(targetSurface, self._COLOUR, width, offset)
+                drawnRects.append(segment.draw(targetSurface, self._COLOUR, width, offset))
         if self.isMoving:
             for mouseSegment in self.mouseSegments:
-                mouseSegment.draw(targetSurface, self.BRIGHTER_COLOUR, offset)
+                drawnRects.append(mouseSegment.draw(targetSurface, self.BRIGHTER_COLOUR, offset))
+        return drawnRects
+
+    def drawPick(self, targetSurface, colour, width, offset):
+        # draw the clickable segments of the line in a single colour
+        # (for a PickBuffer). abandoned segments can't be clicked
+        for segment in self.tempSegments+self.segments:
+            if not segment.isAbandoned:
+                segment.draw(targetSurface, colour, width, offset)
 
     def _abandonSegment(self, segmentIndex):
+        self.version = self.version+1
         self.tempSegments[segmentIndex].isAbandoned = True
         self._abandonedSegments.append(self.tempSegments[segmentIndex])
 
-    def getClickedSegment(self, mouseView, mouseObject):
-        # determine which segment of the line is being clicked on
-        intersectingSegments = []
-        for i in range(len(self.segments)):
-            if self.segments[i].rect.collidepoint(mouseView):
-                intersectingSegments.append(i)
-        # if only one approximate rectangle is clicked,
-        # pick that segment. if multiple approximate rectangles
-        # are clicked, use a more precise detection:
-        if len(intersectingSegments) > 1:
-            # holds the lowest score and the index of
-            # the segment with that score
-            lowestDistance = [10000000, -1]
-            for i in range(len(intersectingSegments)):
-                distanceScore = (self.segments[intersectingSegments[i]]
-                                 .getDistanceScore(mouseObject.getWorld()))
-                if distanceScore < lowestDistance[0]:
-                    lowestDistance = [distanceScore, intersectingSegments[i]]
-            intersectingSegments[0] = lowestDistance[1]
-        if len(intersectingSegments) > 0:
-            # sometimes the rectangles pygame returns do not cover
-            # the full line, so make sure there is an intersection
-            # in the list before returning
-            return intersectingSegments[0]
-        else:
-            return -1
-
     def createMouseSegments(self, segment, mouseObject, stop1, stop2):
+        self.version = self.version+1
         self.tempSegments = list(self.segments)
+        self.indexTempSegments()
         if (segment == 0
                 and findDistance(mouseObject.getWorld(),
                                  stop1.getPosition()) < ENDPOINT_SEGMENT_DISTANCE):
@@ -594,19 +1258,18 @@ class Line(object):
                                                    -len(self.segments)+segment+1,
                                                    "before"))
 
-    def update(self, worldSurface, updateTransfers):
+    def update(self, riverMask, updateTransfers):
         # commit changes made during editing and fix values that changed
-        # updateTransfers = True: update everything, and update the lines that
-        # get marked as transfers from this line with updateTransfers = False
+        # updateTransfers = True: update everything, including the trains, the
+        # transfers of the lines that this line was added to or taken off at
+        # a stop, and the routes of every line connected to them
         # updateTransfers = False: only update the line, no trains, and
-        # do not continue to call update on lines that get marked as transfers
-        if len(self.segments) > 0:
-            if self in self.segments[0].firstPoint.lines:
-                self.segments[0].firstPoint.lines.remove(self)
-        for i in range(len(self.segments)):
-            if self in self.segments[i].lastPoint.lines:
-                self.segments[i].lastPoint.lines.remove(self)
-        self.transfers = []
+        # do not update any other line
+        self.version = self.version+1
+        previousSegments = set(self.segments)
+        previousStops = self._getStops()
+        previousTransfers = self.transfers
+        previousStopNums = self.stopNums
 
         if updateTransfers:
             self.updateTrainIndices()
@@ -616,48 +1279,170 @@ class Line(object):
             if self.tempSegments[i].isAbandoned:
                 self.tempSegments.pop(i)
         self.segments = list(self.tempSegments)
-        # fix indices and update the stop number list as well each stop
-        if len(self.segments) > 0:
-            self.stopNums = [self.segments[0].firstPoint.shape]
-            if self not in self.segments[0].firstPoint.lines:
-                self.segments[0].firstPoint.lines.append(self)
+        # fix indices, and only check for water under new segments,
+        # since the ones that were already committed have not moved
+        self.tunnelCount = 0
         for i in range(len(self.segments)):
             self.segments[i].index = i
-            self.tempSegments[i].index = i
-            self.segments[i].checkOverWater(worldSurface)
-            self.stopNums.append(self.segments[i].lastPoint.shape)
-            if self not in self.segments[i].lastPoint.lines:
-                self.segments[i].lastPoint.lines.append(self)
-        # update transfers
+            if self.segments[i] not in previousSegments:
+                self.segments[i].checkOverWater(riverMask)
+            if self.segments[i].isTunnel:
+                self.tunnelCount = self.tunnelCount+1
+        self.updateStopNums()
+        # only the stops that the line was added to or taken off
+        # need their list of lines changed
+        stops = self._getStops()
+        self._tempStops = set(stops)
+        changedStops = previousStops ^ stops
+        for stop in changedStops:
+            if stop in stops:
+                if self not in stop.lines:
+                    stop.lines.append(self)
+            elif self in stop.lines:
+                stop.lines.remove(self)
+        self.updateTransfers()
+        # a line that was picked up and put back down the same way
+        # changes no transfers and no routes
+        if (updateTransfers
+                and (len(changedStops) > 0
+                     or self.stopNums != previousStopNums
+                     or self.transfers != previousTransfers)):
+            # the transfers of other lines only changed at those stops
+            changedLines = set()
+            for stop in changedStops:
+                for line in stop.lines:
+                    if line is not self and line not in changedLines:
+                        changedLines.add(line)
+                        line.updateTransfers()
+            # lines that this line no longer meets are no longer
+            # connected to it, so their routes are rebuilt on their own
+            connectedLines = set([transfer[1] for transfer in self.transfers])
+            separatedLines = []
+            for transfer in previousTransfers:
+                if (transfer[1] not in connectedLines
+                        and transfer[1] not in separatedLines):
+                    separatedLines.append(transfer[1])
+            routedLines = set(self.updateRoutes())
+            for line in separatedLines:
+                if line not in routedLines:
+                    routedLines.update(line.updateRoutes())
+        # clear new stops
+        self._newStops.clear()
+        # clear removed stops
+        self._removedStops.clear()
+        # clear mouse segments
+        for i in range(len(self.mouseSegments)-1, -1, -1):
+            self.mouseSegments.pop(i)
+
+    def updateShapeMasks(self):
+        # rebuild the bitmask of every shape on the line, and for each
+        # segment index, the bitmask of the shapes a train reaches from
+        # there without reversing when going either way
+        forward = [0]*len(self.stopNums)
+        mask = 0
+        for i in range(len(self.stopNums)-1, -1, -1):
+            mask = mask | (1 << self.stopNums[i])
+            forward[i] = mask
+        backward = [0]*len(self.stopNums)
+        mask = 0
+        for i in range(len(self.stopNums)):
+            mask = mask | (1 << self.stopNums[i])
+            backward[i] = mask
+        self.shapeMask = mask
+        self._shapesAhead = {1: forward, -1: backward}
+
+    def getShapesAhead(self, segmentNum, direction):
+        """ (int, int) -> int
+            Returns the bitmask of the shapes a train on segment
+            "segmentNum" going in "direction" reaches without reversing.
+        """
+        shapesAhead = self._shapesAhead[direction]
+        if 0 <= segmentNum < len(shapesAhead):
+            return shapesAhead[segmentNum]
+        return 0
+
+    def _getStops(self):
+        # the set of stops on the committed segments of the line
+        stops = set()
+        for segment in self.segments:
+            stops.add(segment.firstPoint)
+            stops.add(segment.lastPoint)
+        return stops
+
+    def updateStopNums(self):
+        # rebuild the shapes of the stops along the committed segments,
+        # for when the line or the shape of one of its stops changed
+        self.stopNums = []
+        if len(self.segments) > 0:
+            self.stopNums = [self.segments[0].firstPoint.shape]
+        for segment in self.segments:
+            self.stopNums.append(segment.lastPoint.shape)
+        self.updateShapeMasks()
+
+    def updateTransfers(self):
+        # rebuild the transfers from the lines listed by each stop on the
+        # line. a stop lists each line once, so there are no duplicates
+        self.transfers = []
         if len(self.segments) > 0:
             for line in self.segments[0].firstPoint.lines:
-                if line is not self and [0, line] not in self.transfers:
+                if line is not self:
                     self.transfers.append([0, line])
-                    if updateTransfers:
-                        line.update(worldSurface, False)
         for i in range(len(self.segments)):
             for line in self.segments[i].lastPoint.lines:
-                if line is not self and [i+1, line] not in self.transfers:
+                if line is not self:
                     self.transfers.append([i+1, line])
-                    if updateTransfers:
-                        line.update(worldSurface, False)
-        # clear new stops
-        for i in range(len(self._newStops)-1, -1, -1):
-            self._newStops.pop(i)
-        # clear removed stops
-        for i in range(len(self._removedStops)-1, -1, -1):
-            self._removedStops.pop(i)
-        # clear mouse segments
-        for i in range(len(self.mouseSegments)-1, -1, -1):
-            self.mouseSegments.pop(i)
 
-    def contains(self, stop):
-        # see if a stop is within a line
-        inLine = False
+    def updateRoutes(self):
+        """ (None) -> list
+            Rebuilds the routing table of every line connected to this
+            one, and returns those lines.
+        """
+        network = [self]
+        visited = set(network)
+        queue = collections.deque([self])
+        while len(queue) > 0:
+            for transfer in queue.popleft().transfers:
+                if transfer[1] not in visited:
+                    visited.add(transfer[1])
+                    network.append(transfer[1])
+                    queue.append(transfer[1])
+        for line in network:
+            line._buildRoutes()
+        return network
+
+    def _buildRoutes(self):
+        # breadth first search over the transfers starting at this line,
+        # so that every shape is reached with the fewest transfers. every
+        # line found remembers the transfer from this line that led to it
+        self.routes = {}
+        visited = set([self])
+        queue = collections.deque()
+        for transfer in self.transfers:
+            if transfer[1] not in visited:
+                visited.add(transfer[1])
+                queue.append([transfer, transfer[1]])
+        while len(queue) > 0:
+            firstTransfer, line = queue.popleft()
+            for shape in line.stopNums:
+                if not self.shapeMask & (1 << shape) and shape not in self.routes:
+                    self.routes[shape] = firstTransfer
+            for transfer in line.transfers:
+                if transfer[1] not in visited:
+                    visited.add(transfer[1])
+                    queue.append([firstTransfer, transfer[1]])
+
+    def indexTempSegments(self):
+        # rebuild the set of stops in tempSegments, for when
+        # tempSegments was replaced instead of edited
+        self._tempStops = set()
         for segment in self.tempSegments:
-            if stop == segment.firstPoint or stop == segment.lastPoint:
-                inLine = True
-        return inLine
+            self._tempStops.add(segment.firstPoint)
+            self._tempStops.add(segment.lastPoint)
+
+    def contains(self, stop):
+        # see if a stop is within a line (including the segments
+        # that are abandoned but not yet committed)
+        return stop in self._tempStops
 
     def find(self, stop, source):
         # see if a stop is within the list source
@@ -668,7 +1453,9 @@ class Line(object):
                 segments.append(i)
         return segments
 
-    def processMouseSegments(self, stops, mouseObject, offset, worldSurface):
+    def processMouseSegments(self, stops, mouseObject, offset, riverMask):
+        # only the stops near the mouse can be added or removed, so
+        # "stops" does not have to be every stop in the world
         for mouseSegment in self.mouseSegments:
             mouseSegment.update(mouseObject.getView(offset), offset)
             for stop in stops:
@@ -682,7 +1469,7 @@ class Line(object):
                         and stop.withinRadius(*mouseWorld,
                                               radius=STOP_ADDITION_DISTANCE)):
                     # if the mouse segment meets the conditions for adding a stop, add one
-                    self._insertSegment(mouseSegment, stop, worldSurface)
+                    self._insertSegment(mouseSegment, stop, riverMask)
                 elif (self.contains(stop)
                       and (stop not in self._newStops)
                       and (stop not in self._removedStops)
@@ -748,7 +1535,7 @@ class Line(object):
             elif self.mouseSegments[0].direction == "after":
                 self._updateMouseSegment("before", matchedSegments[0], 0)
 
-        self._removedStops.append(stop)
+        self._removedStops.add(stop)
 
     def _updateMouseSegment(self, direction, matchedSegment, mouseIndex):
         # corrects the mouse segment after removal of stops
@@ -769,13 +1556,14 @@ class Line(object):
                 self.mouseSegments[mouseIndex].firstPoint = self.tempSegments[nextStop].lastPoint
                 self.mouseSegments[mouseIndex].index = nextStop
 
-    def _insertSegment(self, mouseSegment, stop, worldSurface):
+    def _insertSegment(self, mouseSegment, stop, riverMask):
+        segment = None
         if len(self.tempSegments) == 0:
             if stop != mouseSegment.firstPoint:
                 segment = Segment(mouseSegment.firstPoint,
                                   stop,
                                   0)
-                segment.checkOverWater(worldSurface)
+                segment.checkOverWater(riverMask)
                 self.tempSegments.append(segment)
                 mouseSegment.index = mouseSegment.index+1
         elif mouseSegment.direction == "before":
@@ -783,13 +1571,13 @@ class Line(object):
                 segment = Segment(stop,
                                   self.tempSegments[-1].lastPoint,
                                   -1)
-                segment.checkOverWater(worldSurface)
+                segment.checkOverWater(riverMask)
                 self.tempSegments.append(segment)
             else:
                 segment = Segment(stop,
                                   self.tempSegments[mouseSegment.index].firstPoint,
                                   mouseSegment.index-1)
-                segment.checkOverWater(worldSurface)
+                segment.checkOverWater(riverMask)
                 self.tempSegments.insert(mouseSegment.index,
                                          segment)
             mouseSegment.index = mouseSegment.index-1
@@ -798,19 +1586,25 @@ class Line(object):
                 segment = Segment(self.tempSegments[0].firstPoint,
                                   stop,
                                   0)
-                segment.checkOverWater(worldSurface)
+                segment.checkOverWater(riverMask)
                 self.tempSegments.insert(0,
                                          segment)
             else:
                 segment = Segment(self.tempSegments[mouseSegment.index].lastPoint,
                                   stop,
                                   mouseSegment.index+1)
-                segment.checkOverWater(worldSurface)
+                segment.checkOverWater(riverMask)
                 self.tempSegments.insert(mouseSegment.index+1,
                                          segment)
             mouseSegment.index = mouseSegment.index+1
+        if segment is not None:
+            self.version = self.version+1
+            self._tempStops.add(segment.firstPoint)
+            self._tempStops.add(segment.lastPoint)
+            if segment.isTunnel:
+                self.tunnelCount = self.tunnelCount+1
         mouseSegment.firstPoint = stop
-        self._newStops.append(stop)
+        self._newStops.add(stop)
 
     def updateTrainIndices(self):
         abandonedIndices = []
@@ -824,36 +1618,38 @@ class Line(object):
                 mouseIndices.append(len(self.segments)+mouseSegment.index)
             else:
                 mouseIndices.append(mouseSegment.index)
+        if len(mouseIndices) == 0:
+            mouseIndices.append(len(self.segments))  # when committed without the mouse
         # change in number of stops
         deltaLength = len(self._newStops)-len(self._removedStops)
-        for i in range(len(self.trains)-1, -1, -1):
+        for train in reversed(self.trains):
             # [true if any part is on an abandoned segment,
             # true if train head is on an abandoned segment]
             isOnAbandonedSegment = [False, False]
-            if (self.trains[i].segmentNum in abandonedIndices
-                    and self.trains[i].line == self):
+            if (train.segmentNum in abandonedIndices
+                    and train.line == self):
                 isOnAbandonedSegment = [True, True]
-            for carriage in self.trains[i].carriages:
+            for carriage in train.carriages:
                 if carriage.segmentNum in abandonedIndices and carriage.line == self:
                     isOnAbandonedSegment[0] = True
             if isOnAbandonedSegment[0]:
                 # if the segment the train was on got removed from
                 # this line, switch the train onto the abandoned line
-                self.createAbandonedChildren(self.trains[i], abandonedIndices)
+                self.createAbandonedChildren(train, abandonedIndices)
             # if the changes were after this train,
             # nothing needs to be done to indices
             # if the changes were all before this train,
             # add the delta of stops to the index
             if (not isOnAbandonedSegment[1]
-                    and (self.trains[i].segmentNum > max(mouseIndices)
-                         or self.trains[i].segmentNum > max(abandonedIndices))):
-                self.trains[i].segmentNum = self.trains[i].segmentNum+deltaLength
-            for carriage in self.trains[i].carriages:
+                    and (train.segmentNum > max(mouseIndices)
+                         or train.segmentNum > max(abandonedIndices))):
+                train.segmentNum = train.segmentNum+deltaLength
+            for carriage in train.carriages:
                 if (carriage.segmentNum > max(mouseIndices)
                         or carriage.segmentNum > max(abandonedIndices)):
                     carriage.segmentNum = carriage.segmentNum+deltaLength
             if isOnAbandonedSegment[1]:
-                self.trains.pop(i)
+                self.trains.remove(train)
 
     def createAbandonedChildren(self, train, indices):
         abandonedLine = Line(self.LINE_NUMBER)
@@ -882,14 +1678,19 @@ class Line(object):
 
 
 class Segment(object):
+    __slots__ = ["id", "firstPoint", "lastPoint", "isAbandoned", "isTunnel", "index",
+                 "_tunnelOverlay", "length", "angle", "reverseAngle", "bounds"]
+
     def __init__(self, stop1, stop2, index):
+        self.id = next(_entityIds)
         self.firstPoint = stop1
         self.lastPoint = stop2
-        # bounding box (for collision detection)
-        self.rect = None
         self.isAbandoned = False
         self.isTunnel = False
         self.index = index
+        # [(offset, interval, width), surface, view position]
+        # of the last tunnel overlay drawn, see drawTunnel()
+        self._tunnelOverlay = None
         self.calculateData()
 
     def calculateData(self):
@@ -899,72 +1700,110 @@ class Segment(object):
                                 self.lastPoint.X-self.firstPoint.X)
         self.reverseAngle = math.atan2(self.firstPoint.Y-self.lastPoint.Y,
                                        self.firstPoint.X-self.lastPoint.X)
-
-    def getDistanceScore(self, point):
-        # get a score calculated from a point to this segment that
-        # roughly represents distance. not an exact value, but just
-        # a score that will be lower when distance is lower and higher
-        # when distance is higher. since we only care about relative
-        # distance or approximate distance most of the time, this lazy
-        # calculation works
-
-        # calculation of score:
-        # first, find the distance from an endpoint of the segment
-        # to the point and add that to the distance from the other
-        # endpoint to the point. then, from that, subtract the
-        # length of the segment by itself to get the score
-        return (findDistance((self.firstPoint.X,
-                              self.firstPoint.Y),
-                             point)
-                + findDistance((self.lastPoint.X,
-                                self.lastPoint.Y),
-                               point)
-                - findDistance((self.firstPoint.X,
-                                self.firstPoint.Y),
-                               (self.lastPoint.X,
-                                self.lastPoint.Y)))
+        # world space bounding box (for collision detection)
+        # as (left, top, right, bottom)
+        self.bounds = (min(self.firstPoint.X, self.lastPoint.X),
+                       min(self.firstPoint.Y, self.lastPoint.Y),
+                       max(self.firstPoint.X, self.lastPoint.X),
+                       max(self.firstPoint.Y, self.lastPoint.Y))
+
+    def getDistance(self, point):
+        """ ((num, num)) -> float
+            Returns the shortest distance in world space from the point
+            to any point on the segment.
+        """
+        if self.length == 0:
+            return findDistance(self.firstPoint.getPosition(), point)
+        # project the point onto the segment, then clamp the
+        # projection to the endpoints of the segment
+        deltaX = self.lastPoint.X-self.firstPoint.X
+        deltaY = self.lastPoint.Y-self.firstPoint.Y
+        projection = (((point[0]-self.firstPoint.X)*deltaX
+                       + (point[1]-self.firstPoint.Y)*deltaY)
+                      / float(self.length**2))
+        projection = max(0, min(projection, 1))
+        return findDistance((self.firstPoint.X+projection*deltaX,
+                             self.firstPoint.Y+projection*deltaY),
+                            point)
 
     def draw(self, targetSurface, colour, width, offset):
         firstView = getViewCoords(self.firstPoint.X, self.firstPoint.Y, offset)
         lastView = getViewCoords(self.lastPoint.X, self.lastPoint.Y, offset)
-        self.rect = pygame.draw.line(targetSurface, colour, firstView, lastView, width)
+        return pygame.draw.line(targetSurface, colour, firstView, lastView, width)
 
-    def checkOverWater(self, worldSurface):
+    def checkOverWater(self, riverMask):
         # check a few points on the segment to see if they are over water
-        for step in self.getPointsAlongSegment(20):
-            if worldSurface.get_at((int(step[0]), int(step[1]))) == COLOURS.get("river"):
-                self.isTunnel = True
-                return True
-        self.isTunnel = False
-        return False
-
-    def getPointsAlongSegment(self, interval):
-        stepX = interval*math.cos(self.angle)
-        stepY = interval*math.sin(self.angle)
-        steps = [[self.firstPoint.X, self.firstPoint.Y]]
-        while findDistance(steps[0], steps[-1]) < self.length:
-            steps.append([steps[-1][0]+stepX, steps[-1][1]+stepY])
-        return steps[:-1]
-
-    def getPointsOverWater(self, interval, worldSurface):
-        # get points along  the segment with the given interval, then
+        self.isTunnel = len(self.getPointsOverWater(WATER_CHECK_INTERVAL, riverMask)) > 0
+        return self.isTunnel
+
+    def getWaterIntervals(self, riverMask):
+        # get [start, end] distances from the first point for
+        # each part of the segment that is over water
+        return riverMask.getWaterIntervals(self.firstPoint.X,
+                                           self.firstPoint.Y,
+                                           self.angle,
+                                           self.length)
+
+    def getFirstPointOverWater(self, riverMask):
+        """ (RiverMask) -> list or None
+            Returns the point closest to the first point of the segment
+            that is over water, checking every pixel along it, or None
+            if none of the segment is over water. Any segment that
+            checkOverWater() finds over water has one.
+        """
+        intervals = self.getWaterIntervals(riverMask)
+        if len(intervals) == 0:
+            return None
+        return [self.firstPoint.X+intervals[0][0]*math.cos(self.angle),
+                self.firstPoint.Y+intervals[0][0]*math.sin(self.angle)]
+
+    def getPointsOverWater(self, interval, riverMask):
+        # get points along the segment with the given interval, then
         # return the ones over water
-        points = self.getPointsAlongSegment(interval)
-        for i in range(len(points)-1, -1, -1):
-            if worldSurface.get_at((int(points[i][0]), int(points[i][1]))) != COLOURS.get("river"):
-                points.pop(i)
+        distances = numpy.arange(0, self.length, interval)
+        xs = self.firstPoint.X+distances*math.cos(self.angle)
+        ys = self.firstPoint.Y+distances*math.sin(self.angle)
+        points = []
+        for i in numpy.flatnonzero(riverMask.getWater(xs, ys)):
+            points.append([xs[i], ys[i]])
         return points
 
-    def drawTunnel(self, targetSurface, width, offset, worldSurface, interval):
-        colour = COLOURS.get("river")
-        steps = self.getPointsOverWater(interval, worldSurface)
+    def drawTunnel(self, targetSurface, width, offset, riverMask, interval):
+        # the circles only change when the camera does, so draw them
+        # onto their own surface once and reuse it until then
+        key = (offset[0][0], offset[0][1], offset[1][0], offset[1][1], interval, width)
+        if self._tunnelOverlay is None or self._tunnelOverlay[0] != key:
+            self._tunnelOverlay = [key]+self._renderTunnel(width, offset, riverMask, interval)
+        if self._tunnelOverlay[1] is None:
+            # none of the circles landed on water, so nothing was drawn.
+            # like pygame.draw, still return where it would have been
+            firstView = getViewCoords(self.firstPoint.X, self.firstPoint.Y, offset)
+            return pygame.Rect(int(firstView[0]), int(firstView[1]), 0, 0)
+        return targetSurface.blit(self._tunnelOverlay[1], self._tunnelOverlay[2])
+
+    def _renderTunnel(self, width, offset, riverMask, interval):
+        # draw the tunnel circles onto a new surface, returning the
+        # surface and where it goes in view space (or None if no part
+        # of the segment is over water)
+        steps = self.getPointsOverWater(interval, riverMask)
+        if len(steps) == 0:
+            return [None, None]
+        centers = []
         for step in steps:
             viewCoords = getViewCoords(step[0], step[1], offset)
-            pygame.draw.circle(targetSurface,
-                               colour,
-                               (int(viewCoords[0]),
-                                int(viewCoords[1])),
+            centers.append([int(viewCoords[0]), int(viewCoords[1])])
+        left = min(center[0] for center in centers)-width
+        top = min(center[1] for center in centers)-width
+        right = max(center[0] for center in centers)+width
+        bottom = max(center[1] for center in centers)+width
+        overlay = pygame.Surface((right-left+1, bottom-top+1))
+        overlay.set_colorkey((0, 0, 0))
+        for center in centers:
+            pygame.draw.circle(overlay,
+                               COLOURS.get("river"),
+                               (center[0]-left, center[1]-top),
                                width)
+        return [overlay, (left, top)]
 
 
 class MousePosition(object):
@@ -993,10 +1832,15 @@ class MousePosition(object):
 
 
 class MouseSegment(Segment):
+    __slots__ = ["direction"]
+
     def __init__(self, stop1, mouse, index, direction):
         Segment.__init__(self, stop1, mouse, index)
         self.direction = direction
 
+    def __copy__(self):
+        return _copySlots(self, Segment.__slots__+MouseSegment.__slots__)
+
     def calculateData(self):
         self.length = findDistance(self.firstPoint.getPosition(),
                                    self.lastPoint.getWorld())
@@ -1008,15 +1852,27 @@ class MouseSegment(Segment):
     def draw(self, targetSurface, colour, offset):
         firstView = getViewCoords(self.firstPoint.X, self.firstPoint.Y, offset)
         mouseView = getViewCoords(self.lastPoint.x, self.lastPoint.y, offset)
-        pygame.draw.aaline(targetSurface, colour, firstView, mouseView)
+        return pygame.draw.aaline(targetSurface, colour, firstView, mouseView)
 
     def update(self, mouse, offset):
         self.lastPoint.updateWithView(mouse, offset)
 
 
 class Train(object):
+    # rotated train and carriage sprites shared by all trains, as
+    # (colour, angle bucket, passenger size) -> [sprite, corner]
+    # where corner is the offset from the train's center to the
+    # top left of the sprite
+    _SPRITES = collections.OrderedDict()
+    # a train only has a tail once a carriage is attached, and
+    # segmentNum and _segmentDistance once it is on a line
+    __slots__ = ["id", "passengers", "carriages", "head", "tail", "_x", "_y", "direction",
+                 "_colour", "_angle", "_speed", "canMove", "isOnSegment", "line", "stop",
+                 "rect", "movingClone", "segmentNum", "_segmentDistance"]
+
     def __init__(self, x, y, speed):
-        self.passengers = []
+        self.id = next(_entityIds)
+        self.passengers = PassengerQueue(True)  # of the train and all its carriages
         self.carriages = []
         self.head = None
         self._x = x
@@ -1032,6 +1888,10 @@ class Train(object):
         self.rect = None
         self.movingClone = None
 
+    def __copy__(self):
+        # carriages have no slots of their own
+        return _copySlots(self, Train.__slots__)
+
     def getPosition(self):
         return self._x, self._y
 
@@ -1232,48 +2092,85 @@ class Train(object):
             tail = tail.tail
         return tail
 
-    def drawAllPassengers(self, targetSurface, rect, passengerSize, offset):
-        # rect[1] (from the draw() method) is a list of points that
-        # passengers would be drawn at if the train was centered
-        # around the origin, so rotate and translate the points
-        viewRect = copy.deepcopy(rect[1])
+    def addPassengerBlits(self, blitSequence, passengerSurfaces, slots, passengerSize):
+        # slots (from getPassengerSlots()) has the view coordinates of
+        # the passenger slots of the train, followed by the slots of
+        # each of its carriages. the first 6 passengers ride in the
+        # train and each carriage holds the next 6
+        corners = (slots.reshape(-1, 2)-passengerSize/2).tolist()
+        shapes = self.passengers.getShapes()
+        for i in range(min(len(shapes), len(corners))):
+            blitSequence.append((passengerSurfaces[shapes[i]], corners[i]))
+
+    def _getSprite(self, points, passengerSize):
+        """ (list, int) -> list
+            Returns [sprite, corner] for the train polygon "points"
+            (centered around the origin) rotated to the train's angle
+            and filled with the train's colour.
+        """
+        bucket = int(round(self._angle/(2*math.pi)*TRAIN_ANGLE_BUCKETS)) % TRAIN_ANGLE_BUCKETS
+        key = (tuple(self._colour), bucket, passengerSize)
+        if key in Train._SPRITES:
+            # move to the most recently used end
+            sprite = Train._SPRITES.pop(key)
+        else:
+            angle = bucket*2*math.pi/TRAIN_ANGLE_BUCKETS
+            rotated = []
+            for point in points:
+                rotated.append(self.rotatePoint(point, angle))
+            # leave a pixel around the polygon for antialiasing
+            left = int(math.floor(min([point[0] for point in rotated])))-1
+            top = int(math.floor(min([point[1] for point in rotated])))-1
+            right = int(math.ceil(max([point[0] for point in rotated])))+1
+            bottom = int(math.ceil(max([point[1] for point in rotated])))+1
+            for point in rotated:
+                point[0] = point[0]-left
+                point[1] = point[1]-top
+            surface = pygame.Surface((right-left+1, bottom-top+1), pygame.SRCALPHA, 32)
+            # transparent pixels have the train's colour so that the
+            # antialiased edges only fade out instead of darkening
+            surface.fill(tuple(self._colour)+(0,))
+            pygame.gfxdraw.aapolygon(surface, rotated, self._colour)
+            pygame.draw.polygon(surface, self._colour, rotated)
+            sprite = [surface, (left, top)]
+            if len(Train._SPRITES) >= TRAIN_SPRITE_CACHE_SIZE:
+                Train._SPRITES.popitem(False)
+        Train._SPRITES[key] = sprite
+        return sprite
+
+    def isClickable(self):
+        # only trains and carriages running on a line can be picked up,
+        # not ones that are being moved or waiting to be moved
+        return self.line is not None and self._colour == self.line.BRIGHTER_COLOUR
+
+    def getPolygon(self, points, offset):
+        """ (list, list) -> list
+            Returns the train polygon "points" (centered around the
+            origin) rotated and moved to where the train is in view
+            coordinates.
+        """
         centerView = getViewCoords(self._x, self._y, offset)
-        for i in range(len(viewRect)):
-            viewRect[i] = self.rotatePoint(viewRect[i], self._angle)
-            viewRect[i][0] = viewRect[i][0]+centerView[0]
-            viewRect[i][1] = viewRect[i][1]+centerView[1]
-
-        for i in range(len(self.passengers[:6])):
-            self.passengers[i].draw(targetSurface, passengerSize, *viewRect[i])
-
-        for i in range(len(self.carriages)):
-            viewRect = copy.deepcopy(rect[1])
-            centerView = getViewCoords(self.carriages[i]._x, self.carriages[i]._y, offset)
-            for j in range(len(viewRect)):
-                viewRect[j] = self.rotatePoint(viewRect[j], self.carriages[i]._angle)
-                viewRect[j][0] = viewRect[j][0]+centerView[0]
-                viewRect[j][1] = viewRect[j][1]+centerView[1]
-            for j in range(len(self.passengers[(6*(i+1)):(6*(i+2))])):
-                self.passengers[j].draw(targetSurface, passengerSize, *viewRect[j % 6])
+        polygon = []
+        for point in points:
+            point = self.rotatePoint(point, self._angle)
+            polygon.append([point[0]+centerView[0], point[1]+centerView[1]])
+        return polygon
 
     def draw(self, targetSurface, rect, passengerSize, offset):
-        # since rect is a multi-dimensional list, list() is not enough
         # rect[0] is a list of points for a correctly shaped rectangle
-        # centered around the origin, so rotate and translate it to the
-        # orientation we want
-        rect = copy.deepcopy(rect[0])
+        # centered around the origin, which is rotated to the
+        # orientation we want once and then reused
+        sprite, corner = self._getSprite(rect[0], passengerSize)
         centerView = getViewCoords(self._x, self._y, offset)
-        for i in range(len(rect)):
-            rect[i] = self.rotatePoint(rect[i], self._angle)
-            rect[i][0] = rect[i][0]+centerView[0]
-            rect[i][1] = rect[i][1]+centerView[1]
-        pygame.gfxdraw.aapolygon(targetSurface, rect, self._colour)
-        self.rect = pygame.draw.polygon(targetSurface,
-                                        self._colour,
-                                        rect)
+        self.rect = targetSurface.blit(sprite,
+                                       (int(round(centerView[0]))+corner[0],
+                                        int(round(centerView[1]))+corner[1]))
+        return self.rect
 
 
 class Carriage(Train):
+    __slots__ = []
+
     def __init__(self, x, y, speed):
         Train.__init__(self, x, y, speed)
         # carriage - follows a train/carriage and can be followed by a carriage
@@ -1284,14 +2181,14 @@ class Carriage(Train):
     def attachToNearestTrain(self):
         # find the closest train on the line the
         # carriage is on
-        lowestDistance = [10000000, -1]
-        for i in range(len(self.line.trains)):
-            distance = findDistance(self.line.trains[i].getPosition(),
+        lowestDistance = [10000000, None]
+        for train in self.line.trains:
+            distance = findDistance(train.getPosition(),
                                     self.getPosition())
             if distance < lowestDistance[0]:
-                lowestDistance = [distance, i]
-        if lowestDistance[1] != -1 and len(self.line.trains[lowestDistance[1]].carriages) < 4:
-            self.head = self.line.trains[lowestDistance[1]]
+                lowestDistance = [distance, train]
+        if lowestDistance[1] is not None and len(lowestDistance[1].carriages) < 4:
+            self.head = lowestDistance[1]
             self._speed = self.head._speed
             self.isOnSegment = True
         else:
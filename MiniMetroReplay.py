@@ -0,0 +1,145 @@
+###################################################################################################
+#
+# MiniMetroReplay.py
+# Records the input of a game of Mini Metro with the simulation tick it happened on, and plays it
+# back into a new game with the same seed to reach exactly the same world again
+#
+# Kevin Qiao - January 20, 2019
+#
+###################################################################################################
+
+import json
+import hashlib
+import StringIO
+import pygame
+import MiniMetroSave as Save
+
+VERSION = 1
+# only the events that the game reacts to are recorded
+RECORDED_EVENTS = [pygame.QUIT,
+                   pygame.KEYDOWN,
+                   pygame.MOUSEBUTTONDOWN,
+                   pygame.MOUSEMOTION,
+                   pygame.MOUSEBUTTONUP,
+                   pygame.USEREVENT]
+
+
+def getStateHash(simulation):
+    """ (Simulation) -> str
+        Returns a hash of everything saveSimulation() writes about the
+        simulation except its map, so two games can be checked to be
+        in exactly the same state.
+    """
+    stateFile = StringIO.StringIO()
+    Save.saveSimulation(simulation, stateFile, False)
+    return hashlib.md5(stateFile.getvalue()).hexdigest()
+
+
+def _packEvent(event):
+    # JSON has no tuples, so positions are stored as lists
+    attributes = {}
+    for name in event.dict:
+        value = event.dict[name]
+        if isinstance(value, tuple):
+            value = list(value)
+        attributes[name] = value
+    return [event.type, attributes]
+
+
+def _unpackEvent(packedEvent):
+    attributes = {}
+    for name in packedEvent[1]:
+        value = packedEvent[1][name]
+        if isinstance(value, list):
+            value = tuple(value)
+        attributes[str(name)] = value
+    return pygame.event.Event(packedEvent[0], attributes)
+
+
+class Recorder(object):
+    # writes a game to a file as one line of JSON per frame, holding
+    # how long the frame was, the events handled in it and how many
+    # ticks the simulation had run by the end of it. the last line is
+    # a hash of the final state, for Replay to check against
+    def __init__(self, path, seed):
+        self._file = open(path, "w")
+        self._write({"version": VERSION, "seed": seed})
+
+    def _write(self, data):
+        self._file.write(json.dumps(data)+"\n")
+
+    def recordFrame(self, frameTime, ticks, events):
+        """ (num, int, list) -> None
+            Records a frame that stepped the simulation by "frameTime"
+            seconds after handling "events", ending on tick "ticks".
+        """
+        packedEvents = []
+        for event in events:
+            if event.type in RECORDED_EVENTS:
+                packedEvents.append(_packEvent(event))
+        self._write({"time": frameTime, "ticks": ticks, "events": packedEvents})
+
+    def close(self, simulation):
+        self._write({"state": getStateHash(simulation)})
+        self._file.close()
+
+
+class Replay(object):
+    # reads a file written by Recorder and gives back each frame's
+    # events and length in turn
+    def __init__(self, path):
+        with open(path, "r") as replayFile:
+            lines = replayFile.readlines()
+        header = json.loads(lines[0])
+        if header.get("version") != VERSION:
+            raise ValueError("unsupported replay version: "+str(header.get("version")))
+        self.seed = header["seed"]
+        self._frames = [json.loads(line) for line in lines[1:]]
+        self._stateHash = None
+        # a game that crashed while recording has no final state
+        if len(self._frames) > 0 and "state" in self._frames[-1]:
+            self._stateHash = self._frames.pop()["state"]
+        self._frame = -1
+        self.frameTime = 0
+        self.isDiverged = False
+
+    def nextFrame(self):
+        """ (None) -> bool
+            Moves on to the next frame. Returns False once every frame
+            has been played.
+        """
+        self._frame = self._frame+1
+        if self._frame >= len(self._frames):
+            return False
+        self.frameTime = self._frames[self._frame]["time"]
+        return True
+
+    def getEvents(self):
+        """ (None) -> list
+            Returns the pygame events recorded in the current frame.
+        """
+        return [_unpackEvent(packedEvent) for packedEvent in self._frames[self._frame]["events"]]
+
+    def check(self, simulation):
+        # warn (once) at the first frame where the simulation is not on
+        # the tick it was on when recorded
+        ticks = self._frames[self._frame]["ticks"]
+        if not self.isDiverged and simulation.ticks != ticks:
+            self.isDiverged = True
+            print "Replay diverged on frame %d: tick %d instead of %d" % (self._frame,
+                                                                         simulation.ticks,
+                                                                         ticks)
+
+    def finish(self, simulation):
+        """ (Simulation) -> bool
+            Returns True if the simulation ended in exactly the state
+            that was recorded, and prints the result.
+        """
+        if self._stateHash is None:
+            print "Replay has no final state to check"
+            return False
+        if getStateHash(simulation) != self._stateHash:
+            print "Replay finished in a different state than it was recorded in"
+            return False
+        print "Replay finished in the recorded state"
+        return True
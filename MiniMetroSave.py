@@ -0,0 +1,678 @@
+###################################################################################################
+#
+# MiniMetroSave.py
+# Saves the full state of a Mini Metro simulation to a compact binary file and restores it,
+# including its timers and random number generators
+#
+# Kevin Qiao - January 20, 2019
+#
+###################################################################################################
+
+import array
+import struct
+import zlib
+import numpy
+import pygame
+import MiniMetroClasses as Game
+import MiniMetroSimulation as Sim
+import TimeClass as Time
+
+MAGIC = "MMSAVE"
+VERSION = 4
+
+# the objects of a world point at each other in every direction, so
+# each kind of object is saved as a table of rows, and every reference
+# to another object is its index in that object's table (-1 for None)
+TIME_ROW = struct.Struct("<BB?dddd")  # mode, format, active, elapsed, age, time, countdown
+STOP_ROW = struct.Struct("<IiiB?")    # id, x, y, shape, usingTimer
+SEGMENT_ROW = struct.Struct("<Iiii??")  # id, first stop, last stop, index, isAbandoned, isTunnel
+LINE_ROW = struct.Struct("<B?iii")     # line number, isAbandoned, parent line, tunnels, version
+PASSENGER_ROW = struct.Struct("<IBB")  # id, shape, number of steps in the path (routed only)
+VEHICLE_ROW = struct.Struct("<I?ddbBBBdd??iiiii?i?dii")
+# id, isCarriage, x, y, direction, colour, angle, speed, canMove, isOnSegment,
+# line, stop, movingClone, head, tail, has segmentNum, segmentNum,
+# has _segmentDistance, _segmentDistance, passenger queue, carriage list
+SIMULATION_ROW = struct.Struct("<????iqiidddd")
+# paused, isOver, doneScaling, pickingResource, resource, ticks,
+# view width, view height, offset
+WORLD_ROW = struct.Struct("<diiiiiiiiii")
+# trainSpeed, stopSize, passengerSize, validStopDistanceX/Y,
+# resources, totalTunnels, passengersMoved
+RANDOM_STATE_SIZE = 625  # words in the state of a random.Random's Mersenne Twister
+
+
+class _Writer(object):
+    def __init__(self):
+        self.parts = []
+
+    def pack(self, row, *values):
+        self.parts.append(row.pack(*values))
+
+    def packValues(self, fmt, *values):
+        self.parts.append(struct.pack("<"+fmt, *values))
+
+    def packList(self, values, fmt="i"):
+        # a count followed by every value
+        self.parts.append(struct.pack("<I%d%s" % (len(values), fmt), len(values), *values))
+
+    def packString(self, string):
+        self.packValues("I", len(string))
+        self.parts.append(string)
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def unpack(self, row):
+        values = row.unpack_from(self.data, self.position)
+        self.position = self.position+row.size
+        return values
+
+    def unpackValues(self, fmt):
+        values = struct.unpack_from("<"+fmt, self.data, self.position)
+        self.position = self.position+struct.calcsize("<"+fmt)
+        return values
+
+    def unpackList(self, fmt="i"):
+        count = self.unpackValues("I")[0]
+        return list(self.unpackValues("%d%s" % (count, fmt)))
+
+    def unpackString(self):
+        length = self.unpackValues("I")[0]
+        string = self.data[self.position:self.position+length]
+        self.position = self.position+length
+        return string
+
+
+class _Table(object):
+    # gives each object an index the first time it is added
+    def __init__(self):
+        self.items = []
+        self._indices = {}
+
+    def add(self, item):
+        # returns True if the item is new
+        if item is None or id(item) in self._indices:
+            return False
+        self._indices[id(item)] = len(self.items)
+        self.items.append(item)
+        return True
+
+    def getIndex(self, item):
+        if item is None:
+            return -1
+        return self._indices[id(item)]
+
+    def getIndices(self, items):
+        return [self._indices[id(item)] for item in items]
+
+
+def _getId(entity):
+    # sets of entities are saved in the order the entities were
+    # made, so that the same game is always saved the same way
+    return entity.id
+
+
+def _isUncommitted(line):
+    # a line that is being drawn for the first time has nothing to
+    # save, since lines being edited are saved as they were last committed
+    return line.isMoving and len(line.segments) == 0
+
+
+def _getSavedLines(world):
+    return [line for line in world.lines if not _isUncommitted(line)]
+
+
+def _collect(simulation):
+    # find every object reachable from the simulation, so that
+    # references to lines that were abandoned or trains that are
+    # only moving clones are saved too
+    world = simulation.world
+    tables = {"stop": _Table(),
+              "line": _Table(),
+              "segment": _Table(),
+              "vehicle": _Table(),
+              "passenger": _Table(),
+              "passengerQueue": _Table(),
+              "carriageList": _Table()}
+    queue = []
+
+    def add(kind, item):
+        if tables[kind].add(item):
+            queue.append((kind, item))
+
+    for stop in world.stops:
+        add("stop", stop)
+    for line in _getSavedLines(world):
+        add("line", line)
+    for vehicle in list(world.trains)+list(world.carriages)+list(simulation.trainsToMove):
+        add("vehicle", vehicle)
+    while len(queue) > 0:
+        kind, item = queue.pop()
+        if kind == "stop":
+            for passenger in sorted(item.passengers.getRouted(), key=_getId):
+                add("passenger", passenger)
+            for vehicle in item.trains:
+                add("vehicle", vehicle)
+            for line in item.lines:
+                add("line", line)
+        elif kind == "line":
+            for child in item.abandonedChildren:
+                add("line", child)
+            add("line", getattr(item, "parentLine", None))
+            for transfer in item.transfers:
+                add("line", transfer[1])
+            for shape in item.routes:
+                add("line", item.routes[shape][1])
+            if item.isMoving:
+                # the edit in progress is not saved
+                for segment in item.segments:
+                    add("segment", segment)
+            else:
+                for segment in (item.segments+item.tempSegments+item._abandonedSegments):
+                    add("segment", segment)
+                for stop in sorted(item._newStops | item._removedStops, key=_getId):
+                    add("stop", stop)
+            for vehicle in item.trains:
+                add("vehicle", vehicle)
+        elif kind == "segment":
+            add("stop", item.firstPoint)
+            add("stop", item.lastPoint)
+        elif kind == "vehicle":
+            add("line", item.line)
+            add("stop", item.stop)
+            add("vehicle", item.movingClone)
+            add("vehicle", item.head)
+            add("vehicle", getattr(item, "tail", None))
+            # moving clones share these with the original
+            add("passengerQueue", item.passengers)
+            add("carriageList", item.carriages)
+        elif kind == "passengerQueue":
+            for passenger in sorted(item.getRouted(), key=_getId):
+                add("passenger", passenger)
+        elif kind == "carriageList":
+            for carriage in item:
+                add("vehicle", carriage)
+        elif kind == "passenger":
+            for step in item.path:
+                add("line", step[1])
+    return tables
+
+
+def _packQueue(writer, queue, passengers):
+    # the shape of every passenger in order, then the ones with a route
+    writer.packString(array.array("B", queue.getShapes()).tostring())
+    writer.packList(passengers.getIndices(sorted(queue.getRouted(), key=_getId)))
+
+
+def _fillQueue(queue, shapes, routed):
+    # add the passengers of a queue read by _packQueue(), once the
+    # routed passengers have their paths
+    counts = [0]*Game.SHAPE_COUNT
+    for shape in shapes:
+        counts[shape] = counts[shape]+1
+    for passenger in routed:
+        counts[passenger.SHAPE] = counts[passenger.SHAPE]-1
+        queue.add(passenger)
+    for shape in range(len(counts)):
+        for i in range(counts[shape]):
+            queue.add(shape)
+
+
+def _packTime(writer, timer, clock):
+    # a time's start is saved as how long ago it was, so that it
+    # can be loaded with a clock that reads a different time
+    writer.pack(TIME_ROW,
+                timer.timeMode,
+                timer._displayFormat,
+                getattr(timer, "isActive", True),
+                getattr(timer, "_elapsed", 0),
+                clock.now()-timer._startTime,
+                timer.time,
+                getattr(timer, "countdownAmount", 0))
+
+
+def _unpackTime(reader, clock):
+    mode, displayFormat, isActive, elapsed, age, time, countdownAmount = reader.unpack(TIME_ROW)
+    timer = Time.Time(mode, displayFormat, countdownAmount, clock)
+    timer._startTime = clock.now()-age
+    timer.time = time
+    if mode != Time.MODE_CURRENT_TIME:
+        timer.isActive = isActive
+        timer._elapsed = elapsed
+    return timer
+
+
+def _packRandom(writer, generator):
+    version, state, gauss = generator.getstate()
+    writer.packValues("I%dI?d" % RANDOM_STATE_SIZE, version, *(state+(gauss is not None, gauss or 0)))
+
+
+def _unpackRandom(reader):
+    # returns a state for random.Random.setstate
+    state = reader.unpackValues("I%dI?d" % RANDOM_STATE_SIZE)
+    return (state[0], tuple(state[1:RANDOM_STATE_SIZE+1]), state[-1] if state[-2] else None)
+
+
+def saveSimulation(simulation, outputFile, includeMap=True):
+    """ (Simulation, file, bool) -> None
+        Writes everything in the simulation, its clock and the state of
+        its random number generators to a binary file. Lines that are
+        being edited are saved as they were last committed, as if the
+        edit was cancelled, and a line being drawn for the first time
+        is left out and its line given back. Leave out the map to
+        make the file much smaller when the same map surface will be
+        given to loadSimulation().
+    """
+    world = simulation.world
+    clock = simulation.clock
+    tables = _collect(simulation)
+    stops = tables["stop"]
+    lines = tables["line"]
+    segments = tables["segment"]
+    vehicles = tables["vehicle"]
+    passengers = tables["passenger"]
+    passengerQueues = tables["passengerQueue"]
+    carriageLists = tables["carriageList"]
+
+    writer = _Writer()
+    writer.packValues("6sI", MAGIC, VERSION)
+    writer.packValues("?d", isinstance(clock, Time.VirtualClock), clock.now())
+    writer.packValues("q", world.randomStreams.seed)
+    for name in Game.RANDOM_STREAMS:
+        _packRandom(writer, getattr(world.randomStreams, name))
+    writer.packValues("?II", includeMap, world.width, world.height)
+    if includeMap:
+        writer.packString(zlib.compress(pygame.image.tostring(simulation.worldSurface, "RGB")))
+    # the river is saved even without the map, since finding it
+    # from the map takes much longer than the rest of loading
+    writer.packValues("II", *world.riverMask.mask.shape)
+    writer.packString(zlib.compress(numpy.packbits(world.riverMask.mask).tostring()))
+
+    writer.pack(SIMULATION_ROW,
+                simulation.paused,
+                simulation.isOver,
+                simulation.doneScaling,
+                simulation.pickingResource,
+                simulation.resource,
+                simulation.ticks,
+                simulation.viewWidth,
+                simulation.viewHeight,
+                simulation.offset[0][0],
+                simulation.offset[0][1],
+                simulation.offset[1][0],
+                simulation.offset[1][1])
+    writer.packList(simulation.resourceOptions)
+    writer.packList(simulation.validStops)
+    writer.packValues("I", len(simulation.parameters))
+    for name in sorted(simulation.parameters):
+        writer.packString(name)
+        writer.packValues("d", simulation.parameters[name])
+    for timer in simulation.timers:
+        _packTime(writer, timer, clock)
+    writer.packList(vehicles.getIndices(simulation.trainsToMove))
+
+    savedLines = _getSavedLines(world)
+    writer.pack(WORLD_ROW,
+                world.trainSpeed,
+                world.stopSize,
+                world.passengerSize,
+                world.validStopDistanceX,
+                world.validStopDistanceY,
+                world.resources[0],
+                world.resources[1]+len(world.lines)-len(savedLines),
+                world.resources[2],
+                # found again from the saved lines when loading
+                world.resources[3],
+                world.totalTunnels,
+                world.passengersMoved)
+
+    writer.packValues("IIIIIII",
+                      len(stops.items),
+                      len(lines.items),
+                      len(segments.items),
+                      len(vehicles.items),
+                      len(passengers.items),
+                      len(passengerQueues.items),
+                      len(carriageLists.items))
+    for passenger in passengers.items:
+        writer.pack(PASSENGER_ROW, passenger.id, passenger.SHAPE, len(passenger.path))
+        for step in passenger.path:
+            writer.packValues("ii", step[0], lines.getIndex(step[1]))
+    for passengerQueue in passengerQueues.items:
+        _packQueue(writer, passengerQueue, passengers)
+    for carriageList in carriageLists.items:
+        writer.packList(vehicles.getIndices(carriageList))
+
+    for stop in stops.items:
+        writer.pack(STOP_ROW, stop.id, stop.X, stop.Y, stop.shape, stop.usingTimer)
+        _packTime(writer, stop.timer, clock)
+        _packQueue(writer, stop.passengers, passengers)
+        writer.packList(vehicles.getIndices(stop.trains))
+        writer.packList(lines.getIndices(stop.lines))
+
+    # the committed segments of a line being edited are only
+    # abandoned by the edit, which is not saved
+    editedSegments = set()
+    for line in lines.items:
+        if line.isMoving:
+            editedSegments.update(line.segments)
+    for segment in segments.items:
+        writer.pack(SEGMENT_ROW,
+                    segment.id,
+                    stops.getIndex(segment.firstPoint),
+                    stops.getIndex(segment.lastPoint),
+                    segment.index,
+                    segment.isAbandoned and segment not in editedSegments,
+                    segment.isTunnel)
+
+    for line in lines.items:
+        tempSegments = line.tempSegments
+        tunnelCount = line.tunnelCount
+        abandonedSegments = line._abandonedSegments
+        newStops = sorted(line._newStops, key=_getId)
+        removedStops = sorted(line._removedStops, key=_getId)
+        if line.isMoving:
+            # drop the edit that is in progress
+            tempSegments = line.segments
+            tunnelCount = 0
+            for segment in line.segments:
+                if segment.isTunnel:
+                    tunnelCount = tunnelCount+1
+            abandonedSegments = []
+            newStops = []
+            removedStops = []
+        writer.pack(LINE_ROW,
+                    line.LINE_NUMBER,
+                    line.isAbandoned,
+                    lines.getIndex(getattr(line, "parentLine", None)),
+                    tunnelCount,
+                    line.version)
+        writer.packList(lines.getIndices(line.abandonedChildren))
+        writer.packList(segments.getIndices(line.segments))
+        writer.packList(segments.getIndices(tempSegments))
+        writer.packList(segments.getIndices(abandonedSegments))
+        writer.packList(stops.getIndices(newStops))
+        writer.packList(stops.getIndices(removedStops))
+        writer.packList(line.stopNums)
+        transfers = []
+        for transfer in line.transfers:
+            transfers.extend([transfer[0], lines.getIndex(transfer[1])])
+        writer.packList(transfers)
+        routes = []
+        for shape in sorted(line.routes):
+            routes.extend([shape, line.routes[shape][0], lines.getIndex(line.routes[shape][1])])
+        writer.packList(routes)
+        writer.packList(vehicles.getIndices(line.trains))
+
+    for vehicle in vehicles.items:
+        writer.pack(VEHICLE_ROW,
+                    vehicle.id,
+                    isinstance(vehicle, Game.Carriage),
+                    vehicle._x,
+                    vehicle._y,
+                    vehicle.direction,
+                    vehicle._colour[0],
+                    vehicle._colour[1],
+                    vehicle._colour[2],
+                    vehicle._angle,
+                    vehicle._speed,
+                    vehicle.canMove,
+                    vehicle.isOnSegment,
+                    lines.getIndex(vehicle.line),
+                    stops.getIndex(vehicle.stop),
+                    vehicles.getIndex(vehicle.movingClone),
+                    vehicles.getIndex(vehicle.head),
+                    vehicles.getIndex(getattr(vehicle, "tail", None)),
+                    hasattr(vehicle, "segmentNum"),
+                    getattr(vehicle, "segmentNum", 0),
+                    hasattr(vehicle, "_segmentDistance"),
+                    getattr(vehicle, "_segmentDistance", 0),
+                    passengerQueues.getIndex(vehicle.passengers),
+                    carriageLists.getIndex(vehicle.carriages))
+
+    writer.packList(stops.getIndices(world.stops))
+    writer.packList(lines.getIndices(savedLines))
+    writer.packList(vehicles.getIndices(world.trains))
+    writer.packList(vehicles.getIndices(world.carriages))
+    outputFile.write("".join(writer.parts))
+
+
+def loadSimulation(inputFile, stopSurfaces=None, worldSurface=None, clock=None):
+    """ (file, list, pygame.Surface, object) -> Simulation
+        Reads a simulation written by saveSimulation(). "worldSurface"
+        is needed if the map was left out of the file, and replaces the
+        saved map otherwise. Unless a clock is given, a virtual clock
+        is restored as one and anything else uses real time. Every
+        random number generator continues exactly where it was when
+        saved.
+    """
+    reader = _Reader(inputFile.read())
+    magic, version = reader.unpackValues("6sI")
+    if magic != MAGIC:
+        raise ValueError("not a Mini Metro save file")
+    if version != VERSION:
+        raise ValueError("unsupported save file version: "+str(version))
+    isVirtual, now = reader.unpackValues("?d")
+    if clock is None:
+        if isVirtual:
+            clock = Time.VirtualClock(now)
+        else:
+            clock = Time.DEFAULT_CLOCK
+    randomStreams = Game.RandomStreams(reader.unpackValues("q")[0])
+    randomStates = [_unpackRandom(reader) for name in Game.RANDOM_STREAMS]
+    hasMap, width, height = reader.unpackValues("?II")
+    if hasMap:
+        mapData = zlib.decompress(reader.unpackString())
+        if worldSurface is None:
+            worldSurface = pygame.image.fromstring(mapData, (width, height), "RGB")
+    if worldSurface is None:
+        raise ValueError("the save file has no map, so a world surface has to be given")
+    maskShape = reader.unpackValues("II")
+    maskBits = numpy.fromstring(zlib.decompress(reader.unpackString()), numpy.uint8)
+    mask = numpy.unpackbits(maskBits)[:maskShape[0]*maskShape[1]].reshape(maskShape).view(bool)
+
+    (paused, isOver, doneScaling, pickingResource, resource, ticks,
+     viewWidth, viewHeight, scaleX, scaleY, translateX, translateY) = reader.unpack(SIMULATION_ROW)
+    resourceOptions = reader.unpackList()
+    validStops = reader.unpackList()
+    parameters = {}
+    for i in range(reader.unpackValues("I")[0]):
+        name = reader.unpackString()
+        parameters[name] = reader.unpackValues("d")[0]
+
+    simulation = Sim.Simulation(worldSurface, stopSurfaces,
+                                viewWidth, viewHeight, clock, parameters,
+                                Game.RiverMask(worldSurface, mask), randomStreams)
+    simulation.paused = paused
+    simulation.isOver = isOver
+    simulation.doneScaling = doneScaling
+    simulation.pickingResource = pickingResource
+    simulation.resource = resource
+    simulation.ticks = ticks
+    simulation.offset = [[scaleX, scaleY], [translateX, translateY]]
+    simulation.resourceOptions = resourceOptions
+    simulation.validStops = validStops
+    (simulation.newStopTimer,
+     simulation.newPassengerTimer,
+     simulation.passengerMoveTimer,
+     simulation.switchStopTimer,
+     simulation.gainResourcesTimer,
+     simulation.gameTimer) = [_unpackTime(reader, clock) for timer in simulation.timers]
+    simulation.timers = [simulation.newStopTimer, simulation.newPassengerTimer,
+                         simulation.passengerMoveTimer, simulation.switchStopTimer,
+                         simulation.gainResourcesTimer, simulation.gameTimer]
+    trainsToMove = reader.unpackList()
+
+    world = simulation.world
+    (world.trainSpeed,
+     world.stopSize,
+     world.passengerSize,
+     world.validStopDistanceX,
+     world.validStopDistanceY,
+     world.resources[0],
+     world.resources[1],
+     world.resources[2],
+     world.resources[3],
+     world.totalTunnels,
+     world.passengersMoved) = reader.unpack(WORLD_ROW)
+
+    (stopCount, lineCount, segmentCount, vehicleCount,
+     passengerCount, passengerQueueCount, carriageListCount) = reader.unpackValues("IIIIIII")
+    # every object is made first and filled in after, since
+    # any of them can refer to ones later in their tables
+    stops = [None]*stopCount
+    lines = [None]*lineCount
+    vehicles = [None]*vehicleCount
+
+    def getObject(table, index):
+        if index == -1:
+            return None
+        return table[index]
+
+    passengerRows = []
+    passengers = []
+    for i in range(passengerCount):
+        entityId, shape, pathLength = reader.unpack(PASSENGER_ROW)
+        passenger = Game.Passenger(shape, [])
+        passenger.id = entityId
+        passengers.append(passenger)
+        passengerRows.append(reader.unpackValues("ii"*pathLength))
+    # queues are filled in once the passengers have their paths
+    passengerQueues = []
+    queueRows = []
+    for i in range(passengerQueueCount):
+        passengerQueues.append(Game.PassengerQueue(True))
+        queueRows.append([array.array("B", reader.unpackString()), reader.unpackList()])
+    carriageLists = []
+    for i in range(carriageListCount):
+        carriageLists.append(reader.unpackList())
+
+    stopRows = []
+    stopQueueRows = []
+    for i in range(stopCount):
+        entityId, x, y, shape, usingTimer = reader.unpack(STOP_ROW)
+        stopTimer = _unpackTime(reader, clock)
+        # the stop toggles the timer it is made with, so give it its
+        # real timer afterwards
+        stops[i] = Game.Stop(x, y, shape, stopSurfaces,
+                             Time.Time(Time.MODE_STOPWATCH, Time.FORMAT_TOTAL_SECONDS, 0, clock))
+        stops[i].id = entityId
+        stops[i].timer = stopTimer
+        stops[i].usingTimer = usingTimer
+        stopQueueRows.append([array.array("B", reader.unpackString()), reader.unpackList()])
+        stopRows.append([reader.unpackList(), reader.unpackList()])
+
+    segments = []
+    for i in range(segmentCount):
+        entityId, firstStop, lastStop, index, isAbandoned, isTunnel = reader.unpack(SEGMENT_ROW)
+        segment = Game.Segment(stops[firstStop], stops[lastStop], index)
+        segment.id = entityId
+        segment.isAbandoned = isAbandoned
+        segment.isTunnel = isTunnel
+        segments.append(segment)
+
+    lineRows = []
+    for i in range(lineCount):
+        lineNumber, isAbandoned, parentLine, tunnelCount, lineVersion = reader.unpack(LINE_ROW)
+        lines[i] = Game.Line(lineNumber)
+        lines[i].isAbandoned = isAbandoned
+        lines[i].tunnelCount = tunnelCount
+        lines[i].version = lineVersion
+        children = reader.unpackList()
+        lines[i].segments = [segments[index] for index in reader.unpackList()]
+        lines[i].tempSegments = [segments[index] for index in reader.unpackList()]
+        lines[i]._abandonedSegments = [segments[index] for index in reader.unpackList()]
+        lines[i].indexTempSegments()
+        lines[i]._newStops = set([stops[index] for index in reader.unpackList()])
+        lines[i]._removedStops = set([stops[index] for index in reader.unpackList()])
+        lines[i].stopNums = reader.unpackList()
+        lines[i].updateShapeMasks()
+        lineRows.append([parentLine, children, reader.unpackList(), reader.unpackList(),
+                         reader.unpackList()])
+    for i in range(lineCount):
+        parentLine, children, transfers, routes, trains = lineRows[i]
+        if parentLine != -1:
+            lines[i].parentLine = lines[parentLine]
+        lines[i].abandonedChildren = [lines[index] for index in children]
+        for j in range(0, len(transfers), 2):
+            lines[i].transfers.append([transfers[j], lines[transfers[j+1]]])
+        for j in range(0, len(routes), 3):
+            lines[i].routes[routes[j]] = [routes[j+1], lines[routes[j+2]]]
+        lineRows[i] = trains
+    vehicleRows = []
+    for i in range(vehicleCount):
+        row = reader.unpack(VEHICLE_ROW)
+        (entityId, isCarriage, x, y, direction, red, green, blue, angle, speed, canMove, isOnSegment,
+         line, stop, movingClone, head, tail, hasSegmentNum, segmentNum,
+         hasSegmentDistance, segmentDistance, passengerQueue, carriageList) = row
+        if isCarriage:
+            vehicle = Game.Carriage(x, y, speed)
+        else:
+            vehicle = Game.Train(x, y, speed)
+            vehicle.tail = None
+        vehicle.id = entityId
+        vehicle.direction = direction
+        vehicle._colour = (red, green, blue)
+        vehicle._angle = angle
+        vehicle.canMove = canMove
+        vehicle.isOnSegment = isOnSegment
+        vehicle.line = getObject(lines, line)
+        vehicle.stop = getObject(stops, stop)
+        if hasSegmentNum:
+            vehicle.segmentNum = segmentNum
+        if hasSegmentDistance:
+            vehicle._segmentDistance = segmentDistance
+        vehicle.passengers = passengerQueues[passengerQueue]
+        vehicles[i] = vehicle
+        vehicleRows.append([movingClone, head, tail, carriageList])
+    for i in range(vehicleCount):
+        movingClone, head, tail, carriageList = vehicleRows[i]
+        vehicles[i].movingClone = getObject(vehicles, movingClone)
+        vehicles[i].head = getObject(vehicles, head)
+        if tail != -1 or isinstance(vehicles[i], Game.Carriage):
+            vehicles[i].tail = getObject(vehicles, tail)
+        vehicles[i].carriages = carriageLists[carriageList]
+    for carriageList in carriageLists:
+        carriageList[:] = [vehicles[index] for index in carriageList]
+    for i in range(passengerCount):
+        path = passengerRows[i]
+        for j in range(0, len(path), 2):
+            passengers[i].path.append([path[j], lines[path[j+1]]])
+    for i in range(passengerQueueCount):
+        shapes, routed = queueRows[i]
+        _fillQueue(passengerQueues[i], shapes, [passengers[index] for index in routed])
+    for i in range(stopCount):
+        shapes, routed = stopQueueRows[i]
+        _fillQueue(stops[i].passengers, shapes, [passengers[index] for index in routed])
+    for i in range(stopCount):
+        trains, stopLines = stopRows[i]
+        stops[i].trains = Game.EntityList([vehicles[index] for index in trains])
+        stops[i].lines = [lines[index] for index in stopLines]
+    for i in range(lineCount):
+        lines[i].trains = Game.EntityList([vehicles[index] for index in lineRows[i]])
+    simulation.trainsToMove = Game.EntityList([vehicles[index] for index in trainsToMove])
+
+    world.stops = [stops[index] for index in reader.unpackList()]
+    world.lines = [lines[index] for index in reader.unpackList()]
+    world.trains = Game.EntityList([vehicles[index] for index in reader.unpackList()])
+    world.carriages = Game.EntityList([vehicles[index] for index in reader.unpackList()])
+    world.stopGrid.clear()
+    for stop in world.stops:
+        world.stopGrid.insert(stop, stop.X, stop.Y, stop.X, stop.Y)
+    for line in world.lines:
+        world.indexSegments(line)
+    world.updateTunnels()
+    # entities made after loading must not reuse a loaded ID
+    lastId = -1
+    for entity in stops+segments+vehicles+passengers:
+        lastId = max(lastId, entity.id)
+    Game.reserveEntityIds(lastId)
+
+    # making the simulation places its first stops, so the random
+    # number generators are only put back once it is done
+    for i in range(len(Game.RANDOM_STREAMS)):
+        getattr(randomStreams, Game.RANDOM_STREAMS[i]).setstate(randomStates[i])
+    return simulation
@@ -0,0 +1,903 @@
+###################################################################################################
+#
+# MiniMetroSimulation.py
+# Headless simulation core for Mini Metro that runs a world without a display or audio
+#
+# Kevin Qiao - January 20, 2019
+#
+###################################################################################################
+
+import random
+import copy
+import sys
+import time
+import threading
+import Queue
+import collections
+import pygame
+import MiniMetroClasses as Game
+import TimeClass as Time
+
+RIVER_IMAGES = ["assets/maps/river1.png",
+                "assets/maps/river2.png",
+                "assets/maps/river3.png",
+                "assets/maps/river4.png"]
+
+# units are in world pixels
+WORLD_WIDTH = 1200
+WORLD_HEIGHT = 900
+# units are in view pixels
+VIEW_WIDTH = 800
+VIEW_HEIGHT = 600
+
+# events returned by Simulation.step() for the renderer to react to
+EVENT_AREA_EXPANDED = 0  # the area stops can spawn in grew
+EVENT_AREA_MAXIMUM = 1   # the area stops can spawn in reached its maximum size
+EVENT_RESOURCE = 2       # a resource was received and the player can pick another
+EVENT_GAME_OVER = 3      # a stop overcrowded for too long, data is the stop
+
+# phases of each step of a SimulationThread that Simulation.profiler times
+SIMULATION_PHASES = ["commands", "timers", "ticks", "snapshot"]
+
+# tuning values for the difficulty of a simulation. the curve values
+# multiply the result of the matching get...() function below, so 1.0
+# leaves a curve as it is. pass a dict with any of these changed to a
+# Simulation to try a different difficulty
+DEFAULT_PARAMETERS = {"newStopTime": 1.0,
+                      "newPassengerTime": 1.0,
+                      "newPassengerProbability": 1.0,
+                      "passengerMoveTime": 1.0,
+                      "gameTimerTime": 1.0,
+                      "switchStopTime": 1.0,
+                      "loseDuration": Game.LOSE_DURATION,
+                      "resourceGainDelay": Game.RESOURCE_GAIN_DELAY}
+
+# state of the simulation after a step, for the renderer to draw while
+# the simulation keeps running. lines, trains and carriages are
+# (original, frozen copy) pairs so that the original can still be
+# picked up, everything else is only frozen copies. movingTrain is the
+# clone of the train or carriage being dragged, or None
+Snapshot = collections.namedtuple("Snapshot", ["passengersMoved",
+                                               "resources",
+                                               "paused",
+                                               "pickingResource",
+                                               "lines",
+                                               "trains",
+                                               "carriages",
+                                               "trainsToMove",
+                                               "movingTrain",
+                                               "stops"])
+
+
+def interpolateQuadratic(time, maxTime, minOutput, maxOutput):
+    # interpolate between time range 0->maxTime, to the range minOutput->maxOutput
+    # using two parabolas
+    # get time in the interval [0, 1] as opposed to [0, maxTime]
+    normalizedTime = float(time)/maxTime
+    # these two functions make a nice in-out ease over [0, 1]
+    # y = 2x^2           {x < 0.5}
+    # y = -2(x-1)^2 + 1  {x >= 0.5}
+    if normalizedTime < 0.5:
+        output = 2*(normalizedTime**2)
+    elif normalizedTime >= 0.5:
+        output = -2*((normalizedTime-1)**2)+1
+    # map output to the desired output
+    if minOutput > maxOutput:
+        return minOutput-output*abs(maxOutput-minOutput)
+    return output*abs(maxOutput-minOutput)+minOutput
+
+
+def interpolateLinear(time, maxTime, minOutput, maxOutput):
+    # interpolate between the time range 0->maxTime to the range minOutput->maxOutput
+    # using a line
+    normalizedTime = float(time)/maxTime
+    output = minOutput+(maxOutput-minOutput)*normalizedTime
+    return output
+
+
+def getPassengerMoveTime(passengersMoved):
+    return max(interpolateLinear(passengersMoved, 900, 0.3, 0.07), 0.07)
+
+
+def getNewStopTime(passengersMoved):
+    return max(interpolateQuadratic(passengersMoved, 1000, 10, 2), 2)
+
+
+def getNewPassengerTime(passengersMoved):
+    return max(interpolateLinear(passengersMoved, 1000, 3, 1.5), 1.5)
+
+
+def getNewPassengerProbability(passengersMoved):
+    return min(interpolateLinear(passengersMoved, 1200, 30, 50), 50)
+
+
+def getGameTimerTime(passengersMoved):
+    return max(interpolateLinear(passengersMoved, 900, 1.0/70, 1.0/160), 1.0/160)
+
+
+def getSwitchStopTime(passengersMoved):
+    if passengersMoved < 400:
+        return 10000
+    else:
+        return max(interpolateLinear(passengersMoved-400, 600, 50, 10), 10)
+
+
+def calculateCameraOffset(cWidth, cHeight, world):
+    # calculate the scale and translation operations to move from
+    # world coordinates to screen coordinates
+    return [[cWidth/float(2*world.validStopDistanceX),
+             cHeight/float(2*world.validStopDistanceY)],
+            [world.width/2-world.validStopDistanceX,
+             world.height/2-world.validStopDistanceY]]
+
+
+def createWorldSurface(wWidth, wHeight, cHeight, river=None, randomStream=random):
+    """ (int, int, int, int, random.Random) -> pygame.Surface
+        Creates the world surface with a river placed on it. "river" is
+        the index of the river image to use, or None to pick one at
+        random. The river is placed with "randomStream". Does not need
+        a display to be set up.
+    """
+    worldSurface = pygame.Surface((wWidth, wHeight))
+    if river is None:
+        river = randomStream.randint(0, len(RIVER_IMAGES)-1)
+    riverImage = pygame.image.load(RIVER_IMAGES[river])
+    # top y value
+    riverY = randomStream.randint(wHeight/2-cHeight/3-riverImage.get_height(),
+                                  wHeight/2+cHeight/3-riverImage.get_height())
+    # leftmost x value
+    riverX = randomStream.randint(wWidth-riverImage.get_width(), 0)
+    worldSurface.blit(riverImage, (riverX, riverY))
+    return worldSurface
+
+
+class Simulation(object):
+    def __init__(self, worldSurface, stopSurfaces=None,
+                 viewWidth=VIEW_WIDTH, viewHeight=VIEW_HEIGHT, clock=None, parameters=None,
+                 riverMask=None, randomStreams=None):
+        # the surfaces are only handed to stops so that they can be
+        # drawn, a headless simulation can leave them as None
+        self._stopSurfaces = stopSurfaces
+        # every timer in the simulation reads from this clock, give it a
+        # Time.VirtualClock to run the simulation faster than real time
+        if clock is None:
+            clock = Time.DEFAULT_CLOCK
+        self.clock = clock
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        if parameters is not None:
+            for name in parameters:
+                if name not in DEFAULT_PARAMETERS:
+                    raise KeyError("unknown simulation parameter: "+name)
+            self.parameters.update(parameters)
+        # a Game.RiverMask of the world surface can be given if it is
+        # already known, to save finding the river again. everything
+        # random comes from randomStreams (a Game.RandomStreams)
+        self.world = Game.World(worldSurface, clock=clock, riverMask=riverMask,
+                                randomStreams=randomStreams)
+        self.randomStreams = self.world.randomStreams
+        self.worldSurface = worldSurface
+        self.viewWidth = viewWidth
+        self.viewHeight = viewHeight
+        self.validStops = [Game.CIRCLE, Game.TRIANGLE, Game.SQUARE]
+        # trains/carriages held until they can be legally moved: a moving
+        # clone is moved to its line, and anything else is removed
+        self.trainsToMove = Game.EntityList()
+        # what the player is dragging with the mouse, see startLineEdit(),
+        # startTrainMove() and startNewTrain()
+        self.movingLine = None  # line being edited
+        self.movingTrain = None  # train/carriage being moved to another line
+        self.newTrain = None  # new train/carriage being placed
+        self._mouse = None  # the mouse the segments of movingLine follow
+        self._segmentToFollow = 0  # mouse segment restricted by water
+        # [(version, isMoving, abandoned children), frozen copy] of
+        # every line in the last snapshot, see takeSnapshot()
+        self._frozenLines = {}
+
+        self.paused = False
+        self.isOver = False
+        self.doneScaling = False      # if the spawn area will no longer expand
+        self.pickingResource = False  # if the player is choosing a resource
+        self.resource = -1            # resource that was received
+        self.resourceOptions = []     # resources the player can pick from
+        self.ticks = 0                # number of fixed ticks simulated
+        # times each step when it is enabled, the thread running the
+        # simulation starts each frame
+        self.profiler = Time.FrameProfiler(SIMULATION_PHASES)
+
+        # offset is only used to space out carriages,
+        # the renderer replaces it with its camera offset
+        self.offset = calculateCameraOffset(viewWidth, viewHeight, self.world)
+
+        for shape in range(3):
+            # spawn a square, circle, and triangle before the game starts,
+            # trying as many times as needed
+            while len(self.world.stops) < shape+1:
+                self.world.addRandomStop(shape, self._stopSurfaces)
+
+        self.newStopTimer = Time.Time(Time.MODE_TIMER,
+                                      Time.FORMAT_TOTAL_SECONDS,
+                                      self.getCurve("newStopTime", getNewStopTime),
+                                      clock)
+        self.newPassengerTimer = Time.Time(Time.MODE_TIMER,
+                                           Time.FORMAT_TOTAL_SECONDS,
+                                           self.getCurve("newPassengerTime", getNewPassengerTime),
+                                           clock)
+        self.passengerMoveTimer = Time.Time(Time.MODE_TIMER,
+                                            Time.FORMAT_TOTAL_SECONDS,
+                                            self.getCurve("passengerMoveTime", getPassengerMoveTime),
+                                            clock)
+        self.switchStopTimer = Time.Time(Time.MODE_TIMER,
+                                         Time.FORMAT_TOTAL_SECONDS,
+                                         self.getCurve("switchStopTime", getSwitchStopTime),
+                                         clock)
+        self.gainResourcesTimer = Time.Time(Time.MODE_TIMER,
+                                            Time.FORMAT_TOTAL_SECONDS,
+                                            self.parameters["resourceGainDelay"],
+                                            clock)
+        self.gameTimer = Time.Time(Time.MODE_STOPWATCH,
+                                   Time.FORMAT_TOTAL_SECONDS,
+                                   0,
+                                   clock)
+        # also make a list that points to the individual timers
+        # for operations on all of them
+        self.timers = [self.newStopTimer, self.newPassengerTimer, self.passengerMoveTimer,
+                       self.switchStopTimer, self.gainResourcesTimer, self.gameTimer]
+
+    def getCurve(self, name, curve):
+        """ (str, function) -> num
+            Returns the value of the difficulty curve function "curve"
+            at the current number of passengers moved, scaled by the
+            parameter "name".
+        """
+        return self.parameters[name]*curve(self.world.passengersMoved)
+
+    def togglePaused(self):
+        self.paused = not self.paused
+        for timer in self.timers:
+            timer.toggleActive()
+        for stop in self.world.stops:
+            if stop.usingTimer:
+                stop.timer.toggleActive()
+        return self.paused
+
+    def chooseResource(self, resource):
+        # give the player the resource they picked from the options
+        # and resume the game
+        if not self.pickingResource or resource not in self.resourceOptions:
+            return
+        self.pickingResource = False
+        self.resourceOptions = []
+        if self.paused:
+            self.togglePaused()
+        self._gainResource(resource)
+
+    def _gainResource(self, resource):
+        world = self.world
+        world.resources[resource] = world.resources[resource]+1
+        if resource == Game.TUNNEL:
+            world.totalTunnels = world.totalTunnels+1
+
+    def addLine(self, stops):
+        """ (list) -> Line
+            Creates and commits a line through the given stops in order,
+            without going through the mouse editing process.
+            Returns the new line, or None if there are no lines left or
+            fewer than two stops were given.
+        """
+        world = self.world
+        if world.resources[Game.LINE] <= 0 or len(stops) < 2:
+            return None
+        availableLines = [0, 1, 2, 3, 4, 5, 6]
+        for line in world.lines:
+            availableLines.remove(line.LINE_NUMBER)
+        line = Game.Line(availableLines[0])
+        world.lines.insert(availableLines[0], line)
+        for i in range(len(stops)-1):
+            segment = Game.Segment(stops[i], stops[i+1], i)
+            segment.checkOverWater(world.riverMask)
+            line.tempSegments.append(segment)
+        world.commitLine(line)
+        world.resources[Game.LINE] = world.resources[Game.LINE]-1
+        return line
+
+    def addTrain(self, line, segmentNum=0):
+        """ (Line, int) -> Train
+            Places a new train in the middle of the given segment of a
+            line. Returns the train, or None if it could not be placed.
+        """
+        world = self.world
+        if world.resources[Game.TRAIN] <= 0:
+            return None
+        segment = line.segments[segmentNum]
+        train = Game.Train((segment.firstPoint.X+segment.lastPoint.X)/2.0,
+                           (segment.firstPoint.Y+segment.lastPoint.Y)/2.0,
+                           speed=world.trainSpeed)
+        train.snapToLine(line, segmentNum)
+        if not train.isOnSegment:
+            return None
+        train.placeOnLine()
+        world.trains.append(train)
+        world.resources[Game.TRAIN] = world.resources[Game.TRAIN]-1
+        return train
+
+    def addCarriage(self, line):
+        """ (Line) -> Carriage
+            Attaches a new carriage to the first train on the given
+            line. Returns the carriage, or None if it could not be
+            attached.
+        """
+        world = self.world
+        if world.resources[Game.CARRIAGE] <= 0 or len(line.trains) == 0:
+            return None
+        carriage = Game.Carriage(*line.trains.getFirst().getPosition(), speed=world.trainSpeed)
+        carriage.snapToLine(line)
+        if not carriage.isOnSegment:
+            return None
+        carriage.placeOnLine(True, self.offset, world.passengerSize)
+        world.carriages.append(carriage)
+        world.resources[Game.CARRIAGE] = world.resources[Game.CARRIAGE]-1
+        return carriage
+
+    def startLineEdit(self, line, mouse):
+        """ (Line, MousePosition) -> None
+            Starts dragging the committed segment of "line" closest to
+            "mouse", which the mouse segments of the line follow from
+            then on.
+        """
+        world = self.world
+        if line not in world.lines:
+            return
+        segment = world.getSegmentFromWorld(mouse, line)
+        if segment == -1:
+            return
+        segment = segment[1]
+        line.isMoving = True
+        # create mouse segments and abandon segments on the track
+        line.createMouseSegments(segment,
+                                 mouse,
+                                 line.segments[segment].firstPoint,
+                                 line.segments[segment].lastPoint)
+        self.movingLine = line
+        self._mouse = mouse
+        self._segmentToFollow = 0
+
+    def startNewLine(self, mouse):
+        # start drawing a new line from the stop under the mouse
+        world = self.world
+        stop = world.getNearestStop(mouse.x, mouse.y, Game.ENDPOINT_SEGMENT_DISTANCE)
+        if stop is None or world.resources[Game.LINE] <= 0:
+            return
+        index = world.createNewLine(mouse, stop)
+        if index == -1:
+            return
+        world.resources[Game.LINE] = world.resources[Game.LINE]-1
+        self.movingLine = world.lines[index]
+        self._mouse = mouse
+        self._segmentToFollow = 0
+
+    def startTrainMove(self, train):
+        # pick up a train or carriage that is running on a line
+        world = self.world
+        if ((train not in world.trains and train not in world.carriages)
+                or not train.isClickable()):
+            return
+        train.startMouseMove()
+        self.movingTrain = train
+
+    def startNewTrain(self, resource, mouse):
+        """ (int, MousePosition) -> None
+            Takes a new train or carriage ("resource" is Game.TRAIN or
+            Game.CARRIAGE) for the player to place on a line.
+        """
+        world = self.world
+        if world.resources[resource] <= 0:
+            return
+        if resource == Game.CARRIAGE:
+            train = Game.Carriage(*mouse.getWorld(), speed=world.trainSpeed)
+            world.carriages.append(train)
+        else:
+            train = Game.Train(*mouse.getWorld(), speed=world.trainSpeed)
+            world.trains.append(train)
+        world.resources[resource] = world.resources[resource]-1
+        self.newTrain = train
+
+    def dragTo(self, mouse):
+        # move whatever is being dragged to the mouse
+        if self.movingLine is not None:
+            self._dragLine(mouse)
+        elif self.movingTrain is not None:
+            self._snapToMouse(self.movingTrain.movingClone, mouse)
+        elif self.newTrain is not None:
+            self._snapToMouse(self.newTrain, mouse)
+
+    def _dragLine(self, newMouse):
+        world = self.world
+        line = self.movingLine
+        mouse = self._mouse
+        mouse.updateWithWorld(newMouse.getWorld())
+        # only stops close enough to be added or removed matter
+        nearbyStops = world.getStopsNear(mouse.x,
+                                         mouse.y,
+                                         max(Game.STOP_ADDITION_DISTANCE,
+                                             Game.STOP_REMOVAL_DISTANCE))
+        # if there are not enough tunnels for the segments being edited
+        # to go over the water, stop them at the water
+        waterPoint = None
+        if world.resources[Game.TUNNEL]-len(line.mouseSegments) < 0:
+            mouseSegments = line.mouseSegments
+            for mouseSegment in mouseSegments:
+                mouseSegment.calculateData()
+            if len(mouseSegments) == 1:
+                if mouseSegments[0].checkOverWater(world.riverMask):
+                    waterPoint = mouseSegments[0].getFirstPointOverWater(world.riverMask)
+            else:
+                isFirstOverWater = mouseSegments[0].checkOverWater(world.riverMask)
+                isSecondOverWater = mouseSegments[1].checkOverWater(world.riverMask)
+                if isFirstOverWater and not isSecondOverWater:
+                    self._segmentToFollow = 1
+                elif isSecondOverWater and not isFirstOverWater:
+                    self._segmentToFollow = 0
+                elif isFirstOverWater and isSecondOverWater:
+                    waterPoint = mouseSegments[self._segmentToFollow].getFirstPointOverWater(world.riverMask)
+        if waterPoint is not None:
+            mouse.updateWithWorld(waterPoint)
+        else:
+            line.processMouseSegments(nearbyStops, mouse, self.offset, world.riverMask)
+        world.updateTunnels()
+
+    def _snapToMouse(self, train, mouse):
+        # move a train or carriage that is not running to the mouse,
+        # snapping it to the line under the mouse if there is one
+        world = self.world
+        train.updateMouse(mouse)
+        train.unsnapFromLine()
+        segment = world.getSegmentFromWorld(mouse)
+        if segment == -1:
+            return
+        if isinstance(train, Game.Carriage):
+            train.snapToLine(world.lines[segment[0]])
+        else:
+            train.snapToLine(world.lines[segment[0]], segment[1])
+
+    def finishDrag(self, isOverIcon):
+        """ (bool) -> None
+            Drops whatever is being dragged. "isOverIcon" is if the
+            mouse was let go over a resource icon, which takes a train
+            or carriage that was moved off its line.
+        """
+        world = self.world
+        if self.movingLine is not None:
+            # commit changes made by the line being edited
+            line = self.movingLine
+            self.movingLine = None
+            self._mouse = None
+            line.isMoving = False
+            if len(line.mouseSegments) > 1:
+                line.tempSegments.insert(line.mouseSegments[0].index+1,
+                                         Game.Segment(line.mouseSegments[0].firstPoint,
+                                                      line.mouseSegments[1].firstPoint,
+                                                      line.mouseSegments[1].index))
+            world.commitLine(line)
+            self._removeEmptyLines()
+        elif self.movingTrain is not None:
+            # queue an operation to move the train
+            train = self.movingTrain
+            self.movingTrain = None
+            if train.movingClone.isOnSegment:
+                self.trainsToMove.append(train.movingClone)
+            elif isOverIcon:
+                self.trainsToMove.append(train)
+            else:
+                train.stopMouseMove()
+        elif self.newTrain is not None:
+            # put the new train or carriage on the line it was placed on
+            train = self.newTrain
+            self.newTrain = None
+            if isinstance(train, Game.Carriage):
+                resource = Game.CARRIAGE
+                trains = world.carriages
+            else:
+                resource = Game.TRAIN
+                trains = world.trains
+            if not train.isOnSegment:
+                trains.remove(train)
+                world.resources[resource] = world.resources[resource]+1
+            elif resource == Game.CARRIAGE:
+                train.placeOnLine(True, self.offset, world.passengerSize)
+            else:
+                train.placeOnLine()
+
+    def _removeEmptyLines(self):
+        # if a line has no segments, completely remove
+        # everything and return resources to the player
+        world = self.world
+        for i in range(len(world.lines)-1, -1, -1):
+            if len(world.lines[i].segments) == 0 and not world.lines[i].isMoving:
+                world.removeLine(i)
+
+    def step(self, dt=None):
+        """ (num) -> list
+            Runs every timer and as many fixed ticks of train movement
+            as the time passed since the last step allows.
+            If "dt" is given, the simulation's virtual clock is moved
+            forward by "dt" seconds first. Leave it as None when the
+            clock follows real time.
+            Returns a list of [event, data] pairs that happened during
+            the step, using the EVENT_ constants.
+        """
+        if dt is not None:
+            self.clock.advance(dt)
+        events = []
+        world = self.world
+
+        self.newStopTimer.tick()
+        # if the timer to create a new stop has ended
+        if self.newStopTimer.checkTimer(not self.doneScaling,
+                                        self.getCurve("newStopTime", getNewStopTime)):
+            stop = self.randomStreams.stops.randint(0, 99)
+            if stop < 55:  # 55% chance of making a circle stop
+                stopInfo = world.addRandomStop(Game.CIRCLE, self._stopSurfaces)
+            elif stop < 90:  # 90-55 = 35% chance for triangles
+                stopInfo = world.addRandomStop(Game.TRIANGLE, self._stopSurfaces)
+            elif stop < 100:  # 100-90 = 10% chance for squares
+                stopInfo = world.addRandomStop(Game.SQUARE, self._stopSurfaces)
+            if stopInfo[0]:  # the game area was expanded
+                events.append([EVENT_AREA_EXPANDED, None])
+            # the game area did not expand because it is done expanding
+            elif stopInfo[1] and not self.doneScaling:
+                events.append([EVENT_AREA_MAXIMUM, None])
+                self.doneScaling = True
+
+        self.switchStopTimer.tick()
+        # if the timer to switch a common stop to a unique stop
+        # has finished, restart and switch a stop
+        if self.switchStopTimer.checkTimer(True):
+            newShape = world.switchRandomStop(range(Game.SQUARE+1, Game.STAR+1),
+                                              self.validStops)
+            # if a shape was switched and the new shape hasn't already
+            # been generated
+            if newShape != -1 and newShape not in self.validStops:
+                # add the stop to the list of stops that passengers
+                # can go to
+                self.validStops.append(newShape)
+
+        self.gainResourcesTimer.tick()
+        # if the timer to give the player resources has ended,
+        # give the player a random resource and let them choose
+        # another one between two valid options
+        if self.gainResourcesTimer.checkTimer(True) and not self.pickingResource:
+            if not self.paused:
+                self.togglePaused()
+            options = [0, 1, 2, 3]
+            if world.resources[Game.LINE]+len(world.lines) > 6:
+                options.remove(Game.LINE)
+            self.resource = self.randomStreams.resources.choice(options)
+            self._gainResource(self.resource)
+            self.pickingResource = True
+            if world.resources[Game.LINE]+len(world.lines) > 6 and Game.LINE in options:
+                options.remove(Game.LINE)
+            else:
+                options.remove(self.resource)
+            if len(options) > 2:
+                options.remove(self.randomStreams.resources.choice(options))
+            self.resourceOptions = options
+            events.append([EVENT_RESOURCE, self.resource])
+
+        self.newPassengerTimer.tick()
+        # if the passenger spawn timer has finished,
+        # restart it and add some passengers
+        if self.newPassengerTimer.checkTimer(True, self.getCurve("newPassengerTime", getNewPassengerTime)):
+            newPassengerProbability = self.getCurve("newPassengerProbability", getNewPassengerProbability)
+            randomStream = self.randomStreams.passengers
+            for stop in world.stops:
+                # random chance for each stop to get a passenger
+                if randomStream.randint(0, 99) < newPassengerProbability:
+                    stop.addRandomPassenger(self.validStops, randomStream)
+
+        self.passengerMoveTimer.tick()
+        # timer that synchronizes and adds delay to all movements to/from stops
+        if self.passengerMoveTimer.checkTimer(True, self.getCurve("passengerMoveTime", getPassengerMoveTime)):
+            self._movePassengers(events)
+
+        self.gameTimer.tick()
+        timeElapsed = self.gameTimer.time
+        tickTime = self.getCurve("gameTimerTime", getGameTimerTime)
+        self.gameTimer.restart(timeElapsed % tickTime)
+        self.profiler.mark("timers")
+        # run the actual moving elements controlled by the game at a certain speed
+        # independent of the speed the screen refreshes
+        for tick in range(int(timeElapsed/tickTime)):
+            self._tick()
+        self.profiler.mark("ticks")
+        return events
+
+    def takeSnapshot(self):
+        """ (None) -> Snapshot
+            Returns copies of everything the renderer needs from the
+            simulation that change as it runs.
+        """
+        world = self.world
+        # lines only change when they are edited or committed, so they
+        # are only copied again when that happens
+        lines = []
+        frozenLines = {}
+        for line in world.lines:
+            key = (line.version, line.isMoving, len(line.abandonedChildren))
+            frozenLine = self._frozenLines.get(line)
+            if frozenLine is None or frozenLine[0] != key or line.isMoving:
+                frozenLine = [key, _freezeLine(line)]
+            frozenLines[line] = frozenLine
+            lines.append((line, frozenLine[1]))
+        self._frozenLines = frozenLines
+        trains = []
+        for train in world.trains:
+            trains.append((train, _freezeTrain(train)))
+        carriages = []
+        for carriage in world.carriages:
+            carriages.append((carriage, _freezeTrain(carriage)))
+        trainsToMove = []
+        for train in self.trainsToMove:
+            trainsToMove.append(_freezeTrain(train))
+        movingTrain = None
+        if self.movingTrain is not None:
+            movingTrain = _freezeTrain(self.movingTrain.movingClone)
+        stops = []
+        for stop in world.stops:
+            stops.append(_freezeStop(stop))
+        return Snapshot(world.passengersMoved,
+                        tuple(world.resources),
+                        self.paused,
+                        self.pickingResource,
+                        tuple(lines),
+                        tuple(trains),
+                        tuple(carriages),
+                        tuple(trainsToMove),
+                        movingTrain,
+                        tuple(stops))
+
+    def run(self, duration, dt=1.0/60):
+        """ (num, num) -> list
+            Steps a simulation using a virtual clock forward by
+            "duration" seconds of game time in steps of "dt" seconds,
+            stopping early if the game is lost.
+            Returns every event that happened.
+        """
+        events = []
+        elapsed = 0
+        while elapsed < duration and not self.isOver:
+            events.extend(self.step(dt))
+            elapsed = elapsed+dt
+        return events
+
+    def _movePassengers(self, events):
+        world = self.world
+        for stop in world.stops:
+            # a train that can not move anyone leaves stop.trains, which
+            # an EntityList allows while going through it
+            for train in stop.trains:
+                world.passengersMoved = (world.passengersMoved
+                                         + stop.processTrain(train, self.trainsToMove))
+            # start counting up with timers on stops if they are overcrowing
+            if len(stop.passengers) > 6:
+                if not stop.usingTimer:
+                    stop.usingTimer = True
+                    if not stop.timer.isActive:
+                        stop.timer.toggleActive()
+                if stop.timer.timeMode != Time.MODE_STOPWATCH:
+                    stop.timer.tick()
+                    stop.timer = Time.Time(Time.MODE_STOPWATCH,
+                                           Time.FORMAT_TOTAL_SECONDS,
+                                           stop.timer.time,
+                                           self.clock)
+            # the stop is no longer overcrowding, so start making the timer
+            # go back down
+            else:
+                if stop.usingTimer and stop.timer.timeMode == Time.MODE_STOPWATCH:
+                    stop.timer.tick()
+                    stop.timer = Time.Time(Time.MODE_TIMER,
+                                           Time.FORMAT_TOTAL_SECONDS,
+                                           stop.timer.time,
+                                           self.clock)
+                if stop.timer.checkTimer(False):
+                    stop.timer = Time.Time(Time.MODE_STOPWATCH,
+                                           Time.FORMAT_TOTAL_SECONDS,
+                                           0,
+                                           self.clock)
+                    stop.usingTimer = False
+                    if stop.timer.isActive:
+                        stop.timer.toggleActive()
+            if stop.usingTimer:
+                # keep the timer up to date for the overcrowding gauge
+                stop.timer.tick()
+            # if the timer has counted past the threshold to lose the game
+            if stop.timer.time > self.parameters["loseDuration"] and not self.isOver:
+                if not self.paused:
+                    self.togglePaused()
+                self.isOver = True
+                events.append([EVENT_GAME_OVER, stop])
+
+    def _tick(self):
+        # one fixed tick of train and carriage movement
+        world = self.world
+        trainsToMove = self.trainsToMove
+        offset = self.offset
+        self.ticks = self.ticks+1
+        # on most ticks nothing is waiting to be moved
+        isMovePending = len(trainsToMove) > 0
+        for train in reversed(world.trains):
+            # move trains
+            if train.canMove:
+                train.move(offset, world.passengerSize)
+            # if there are no passengers on the train and the train
+            # is queued to move, move it
+            if isMovePending and len(train.passengers) == 0:
+                # if the moving clone is queued, that means it needs to
+                # be moved into another line
+                if train.movingClone in trainsToMove:
+                    trainsToMove.remove(train.movingClone)
+                    if train.stop is not None:
+                        train.stop.trains.discard(train)
+                    world.trains.replace(train, train.moveLines(offset, world.passengerSize))
+                # if the train itself is queued, that means it needs
+                # to be removed from the world
+                elif train in trainsToMove:
+                    trainsToMove.remove(train)
+                    train.stop.trains.discard(train)
+                    for carriage in train.carriages:
+                        world.carriages.remove(carriage)
+                        world.resources[Game.CARRIAGE] = world.resources[Game.CARRIAGE]+1
+                    train.line.trains.remove(train)
+                    train.remove()
+                    world.resources[Game.TRAIN] = world.resources[Game.TRAIN]+1
+                    world.trains.remove(train)
+        for carriage in reversed(world.carriages):
+            # if the number of passengers on the train is low enough
+            # to take out a carriage (a carriage taken off as the tail
+            # of another one in this loop has no head):
+            if (isMovePending
+                    and carriage.head is not None
+                    and (len(carriage.findFirst().passengers)
+                         <= len(carriage.findFirst().carriages)*6)):
+                # move it to another line
+                if carriage.movingClone in trainsToMove:
+                    trainsToMove.remove(carriage.movingClone)
+                    # find the last carriage to move off
+                    tail = carriage.findLast()
+                    train = carriage.movingClone.head  # destination train
+                    tail.moveLines(train, len(train.carriages), offset, world.passengerSize)
+                    carriage.stopMouseMove()
+                # remove it
+                elif carriage in trainsToMove:
+                    trainsToMove.remove(carriage)
+                    tail = carriage.findLast()
+                    carriage.stopMouseMove()
+                    world.carriages.remove(tail)
+                    tail.findFirst().carriages.remove(tail)
+                    tail.remove()
+                    world.resources[Game.CARRIAGE] = world.resources[Game.CARRIAGE]+1
+
+        for line in world.lines:
+            # remove abandoned segments that are split off lines
+            # if there are no trains or carriages on them
+            for i in range(len(line.abandonedChildren)-1, -1, -1):
+                isClear = True
+                if len(line.abandonedChildren[i].trains) > 0:
+                    isClear = False
+                for train in line.trains:
+                    for carriage in train.carriages:
+                        if carriage.line == line.abandonedChildren[i]:
+                            isClear = False
+                if isClear:
+                    line.abandonedChildren.pop(i)
+
+
+def _freezeTrain(train):
+    # copy a train or carriage, and the lists of it that the
+    # simulation changes, so that drawing it is not affected by
+    # the simulation moving it at the same time
+    frozen = copy.copy(train)
+    frozen.passengers = copy.copy(train.passengers)
+    frozen.carriages = []
+    for carriage in train.carriages:
+        frozen.carriages.append(_freezeTrain(carriage))
+    return frozen
+
+
+def _freezeLine(line):
+    # copy the lists of segments of a line that change while it is
+    # edited, and where the mouse is for its mouse segments. the
+    # segments themselves are shared, drawing only reads their stops
+    # and flags
+    frozen = copy.copy(line)
+    frozen.segments = list(line.segments)
+    frozen.tempSegments = list(line.tempSegments)
+    frozen.mouseSegments = []
+    for mouseSegment in line.mouseSegments:
+        frozenSegment = copy.copy(mouseSegment)
+        frozenSegment.lastPoint = copy.copy(mouseSegment.lastPoint)
+        frozen.mouseSegments.append(frozenSegment)
+    frozen.abandonedChildren = []
+    for childLine in line.abandonedChildren:
+        frozen.abandonedChildren.append(_freezeLine(childLine))
+    return frozen
+
+
+def _freezeStop(stop):
+    frozen = copy.copy(stop)
+    frozen.passengers = copy.copy(stop.passengers)
+    frozen.timer = copy.copy(stop.timer)
+    return frozen
+
+
+class SimulationThread(threading.Thread):
+    # runs a simulation on its own thread, so that slow frames do not
+    # hold back the simulation and bursts of simulation ticks do not
+    # hold back the frame rate.
+    # after every step a new Snapshot is published for the renderer,
+    # and events go back to the renderer through a queue. everything
+    # that changes the simulation from another thread, like the
+    # player's input, has to be sent as a command to run between steps
+    def __init__(self, simulation, stepTime=1.0/120):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.simulation = simulation
+        self.stepTime = stepTime  # seconds to wait between steps
+        self.snapshot = simulation.takeSnapshot()
+        self._commands = Queue.Queue()
+        self._events = Queue.Queue()
+        self._isRunning = True
+        self._error = None
+
+    def send(self, command, *args):
+        """ (function, ...) -> None
+            Queues "command" to be called with "args" on the simulation
+            thread before the next step.
+        """
+        self._commands.put((command, args))
+
+    def getEvents(self):
+        """ (None) -> list
+            Returns every [event, data] pair the simulation has made
+            since the last call. Errors from the simulation thread are
+            raised here.
+        """
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        events = []
+        while not self._events.empty():
+            events.append(self._events.get())
+        return events
+
+    def stop(self):
+        self._isRunning = False
+        if self.is_alive():
+            self.join()
+
+    def runStep(self, dt=None):
+        """ (num) -> bool
+            Runs the queued commands and one step of the simulation
+            (see Simulation.step for "dt"), then publishes a new
+            snapshot. Called by the thread itself, or every frame by
+            the caller if the thread is never started.
+            Returns False if the simulation raised an error.
+        """
+        profiler = self.simulation.profiler
+        profiler.startFrame()
+        try:
+            while not self._commands.empty():
+                command, args = self._commands.get()
+                command(*args)
+            profiler.mark("commands")
+            events = self.simulation.step(dt)
+            self.snapshot = self.simulation.takeSnapshot()
+            profiler.mark("snapshot")
+        except Exception:
+            self._error = sys.exc_info()
+            return False
+        for event in events:
+            self._events.put(event)
+        return True
+
+    def run(self):
+        while self._isRunning and self.runStep():
+            time.sleep(self.stepTime)
@@ -0,0 +1,233 @@
+###################################################################################################
+#
+# MiniMetroSweep.py
+# Plays many seeded headless games of Mini Metro with a simple built-in player across every core,
+# to compare how different difficulty parameters change how long games last
+#
+# Kevin Qiao - January 20, 2019
+#
+###################################################################################################
+
+import time
+import itertools
+import argparse
+import multiprocessing
+import numpy
+import MiniMetroClasses as Game
+import MiniMetroSimulation as Sim
+import TimeClass as Time
+
+PLAYER_THINK_TIME = 1.0  # seconds of game time between each of the player's decisions
+
+
+class AutoPlayer(object):
+    # a greedy player that only uses Simulation's methods: it runs a
+    # new line from the network out through stops no line goes to,
+    # puts a train on every line, adds carriages to the line with the
+    # most waiting passengers and picks resources that it is short on
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self._thinkTime = 0
+
+    def update(self, dt, events):
+        """ (num, list) -> None
+            Reacts to the events from the last step of "dt" seconds,
+            and makes decisions every PLAYER_THINK_TIME seconds.
+        """
+        simulation = self.simulation
+        for event in events:
+            if event[0] == Sim.EVENT_RESOURCE:
+                simulation.chooseResource(self._pickResource())
+        self._thinkTime = self._thinkTime+dt
+        if self._thinkTime < PLAYER_THINK_TIME or simulation.pickingResource:
+            return
+        self._thinkTime = 0
+
+        world = simulation.world
+        unconnected = []
+        for stop in world.stops:
+            if len(stop.lines) == 0:
+                unconnected.append(stop)
+        if len(unconnected) > 0 and world.resources[Game.LINE] > 0:
+            self._addLine(unconnected)
+
+        for line in world.lines:
+            if len(line.trains) == 0 and world.resources[Game.TRAIN] > 0:
+                simulation.addTrain(line, len(line.segments)/2)
+
+        if world.resources[Game.CARRIAGE] > 0:
+            busiestLine = None
+            mostWaiting = 0
+            for line in world.lines:
+                waiting = 0
+                for segment in line.segments:
+                    waiting = waiting+len(segment.firstPoint.passengers)
+                if waiting > mostWaiting and len(line.trains) > 0:
+                    busiestLine = line
+                    mostWaiting = waiting
+            if busiestLine is not None:
+                simulation.addCarriage(busiestLine)
+
+    def _addLine(self, unconnected):
+        # start from the connected stop closest to the unconnected
+        # stops (so passengers can transfer), then keep going to
+        # the nearest stop that isn't on a line yet
+        world = self.simulation.world
+        target = unconnected[0].getPosition()
+        current = None
+        for stop in world.stops:
+            if len(stop.lines) > 0 and (current is None
+                                        or (Game.findDistance(stop.getPosition(), target)
+                                            < Game.findDistance(current.getPosition(), target))):
+                current = stop
+        remaining = list(unconnected)
+        if current is None:
+            current = remaining.pop(0)
+        stops = [current]
+        while len(remaining) > 0 and len(stops) < 5:
+            nearest = min(remaining,
+                          key=lambda stop: Game.findDistance(stop.getPosition(), current.getPosition()))
+            remaining.remove(nearest)
+            stops.append(nearest)
+            current = nearest
+        if len(stops) > 1:
+            self.simulation.addLine(stops)
+
+    def _pickResource(self):
+        world = self.simulation.world
+        options = self.simulation.resourceOptions
+        for resource in [Game.LINE, Game.TRAIN, Game.CARRIAGE, Game.TUNNEL]:
+            if resource in options and world.resources[resource] == 0:
+                return resource
+        return options[0]
+
+
+def playGame((seed, parameters, duration, dt)):
+    """ ((int, dict, num, num)) -> dict
+        Plays one headless game with the built-in player, for at most
+        "duration" seconds of game time in steps of "dt" seconds.
+        Returns the seed, parameters, how long the game lasted, how
+        many passengers were moved and if the game was lost.
+        Takes a single tuple so it can be used with Pool.map.
+    """
+    randomStreams = Game.RandomStreams(seed)
+    clock = Time.VirtualClock()
+    simulation = Sim.Simulation(Sim.createWorldSurface(Sim.WORLD_WIDTH,
+                                                       Sim.WORLD_HEIGHT,
+                                                       Sim.VIEW_HEIGHT,
+                                                       randomStream=randomStreams.map),
+                                clock=clock,
+                                parameters=parameters,
+                                randomStreams=randomStreams)
+    player = AutoPlayer(simulation)
+    while clock.now() < duration and not simulation.isOver:
+        player.update(dt, simulation.step(dt))
+    return {"seed": seed,
+            "parameters": parameters,
+            "survivalTime": clock.now(),
+            "passengersMoved": simulation.world.passengersMoved,
+            "isOver": simulation.isOver}
+
+
+def summarize(values):
+    """ (list) -> dict
+        Returns the mean, standard deviation and percentiles of a list
+        of numbers.
+    """
+    values = numpy.array(values, dtype=float)
+    return {"mean": float(values.mean()),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "p10": float(numpy.percentile(values, 10)),
+            "median": float(numpy.median(values)),
+            "p90": float(numpy.percentile(values, 90)),
+            "max": float(values.max())}
+
+
+def runSweep(parameterSets, games, duration, dt=1.0/20, processes=None, firstSeed=0):
+    """ (list, int, num, num, int, int) -> list
+        Plays "games" games (seeded firstSeed, firstSeed+1, ...) for
+        every dict of parameters in "parameterSets", spread over
+        "processes" processes (every core if None).
+        Returns a list with one dict per parameter set, containing the
+        parameters, the summarized survival times and passengers moved,
+        and the fraction of games that were lost.
+    """
+    jobs = []
+    for i in range(len(parameterSets)):
+        for seed in range(firstSeed, firstSeed+games):
+            jobs.append((seed, parameterSets[i], duration, dt))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        # small chunks so the slowest games do not leave cores idle at the end
+        results = pool.map(playGame, jobs, max(1, len(jobs)/(processes*16)))
+    finally:
+        pool.close()
+        pool.join()
+
+    summaries = []
+    for i in range(len(parameterSets)):
+        setResults = results[i*games:(i+1)*games]
+        lost = 0
+        for result in setResults:
+            if result["isOver"]:
+                lost = lost+1
+        summaries.append({"parameters": parameterSets[i],
+                          "games": games,
+                          "lost": lost/float(games),
+                          "survivalTime": summarize([result["survivalTime"] for result in setResults]),
+                          "passengersMoved": summarize([result["passengersMoved"] for result in setResults])})
+    return summaries
+
+
+def getParameterSets(variations):
+    """ (list) -> list
+        "variations" is a list of strings like "newStopTime=0.8,1,1.2".
+        Returns a parameter dict for every combination of the values.
+    """
+    names = []
+    values = []
+    for variation in variations:
+        name, options = variation.split("=")
+        if name not in Sim.DEFAULT_PARAMETERS:
+            raise KeyError("unknown simulation parameter: "+name)
+        names.append(name)
+        values.append([float(option) for option in options.split(",")])
+    parameterSets = []
+    for combination in itertools.product(*values):
+        parameterSets.append(dict(zip(names, combination)))
+    return parameterSets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play many headless games of Mini Metro across "
+                                                 "every core and summarize how long they last.")
+    parser.add_argument("variations", nargs="*",
+                        help="parameters to vary, like newStopTime=0.8,1,1.2 "
+                             "(one of: "+", ".join(sorted(Sim.DEFAULT_PARAMETERS))+")")
+    parser.add_argument("--games", type=int, default=100, help="games per parameter set")
+    parser.add_argument("--duration", type=float, default=600, help="longest game in seconds")
+    parser.add_argument("--dt", type=float, default=1.0/20, help="seconds of game time per step")
+    parser.add_argument("--processes", type=int, default=None, help="defaults to every core")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    arguments = parser.parse_args()
+
+    parameterSets = getParameterSets(arguments.variations)
+    startTime = time.time()
+    summaries = runSweep(parameterSets, arguments.games, arguments.duration,
+                         arguments.dt, arguments.processes, arguments.seed)
+    print "%d games in %.1f seconds" % (len(parameterSets)*arguments.games, time.time()-startTime)
+    for summary in summaries:
+        print
+        print summary["parameters"] or "default parameters"
+        print "  lost %.0f%%" % (summary["lost"]*100)
+        for name in ["survivalTime", "passengersMoved"]:
+            print "  %-16s mean %7.1f  std %6.1f  p10 %7.1f  median %7.1f  p90 %7.1f" % (
+                name,
+                summary[name]["mean"],
+                summary[name]["std"],
+                summary[name]["p10"],
+                summary[name]["median"],
+                summary[name]["p90"])
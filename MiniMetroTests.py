@@ -0,0 +1,305 @@
+###################################################################################################
+#
+# MiniMetroTests.py
+# Regression tests for the game logic, run with "python MiniMetroTests.py"
+#
+# Kevin Qiao - January 22, 2019
+#
+###################################################################################################
+
+import os
+# the tests never open a window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import unittest
+import StringIO
+import pygame
+import MiniMetroClasses as Game
+import MiniMetroSimulation as Sim
+import MiniMetroSave as Save
+import TimeClass as Time
+
+MAX_STEPS = 10  # more than enough passenger moves for a train to leave a stop
+
+
+def createWorld():
+    surface = pygame.Surface((1000, 600))
+    surface.fill((255, 255, 255))
+    return Game.World(surface)
+
+
+def addLine(world, lineNumber, stops):
+    """ (World, int, list) -> Line
+        Adds a line through "stops" in order to the world.
+    """
+    line = Game.Line(lineNumber)
+    for i in range(len(stops)-1):
+        segment = Game.Segment(stops[i], stops[i+1], i)
+        segment.checkOverWater(world.riverMask)
+        line.tempSegments.append(segment)
+    world.lines.append(line)
+    world.commitLine(line)
+    return line
+
+
+def stopTrainAt(world, line, segmentNum, direction):
+    """ (World, Line, int, int) -> Train
+        Places a train on "line" that has just reached the stop at the
+        end of segment "segmentNum" going in "direction".
+    """
+    segment = line.segments[segmentNum]
+    if direction == 1:
+        stop = segment.firstPoint
+    else:
+        stop = segment.lastPoint
+    train = Game.Train(stop.X, stop.Y, world.trainSpeed)
+    train.line = line
+    train.segmentNum = segmentNum
+    train.direction = direction
+    train.stop = stop
+    train.isOnSegment = True
+    train._segmentDistance = 0
+    line.trains.append(train)
+    world.trains.append(train)
+    stop.trains.append(train)
+    return train
+
+
+class TransferTest(unittest.TestCase):
+    # L1 = A, T, B, S, C, L2 = T, D, S and L3 = D, E, with only E
+    # being a star. a passenger to the star rides L1 to transfer to
+    # L2 at T, but a train going from S to T passes another stop on
+    # L2 first
+    def setUp(self):
+        self.world = createWorld()
+        addStop = self.world.addStop
+        self.A = addStop(100, 100, Game.CIRCLE, None)
+        self.T = addStop(200, 100, Game.CIRCLE, None)
+        self.B = addStop(300, 100, Game.TRIANGLE, None)
+        self.S = addStop(400, 100, Game.CIRCLE, None)
+        self.C = addStop(500, 100, Game.TRIANGLE, None)
+        self.D = addStop(300, 300, Game.SQUARE, None)
+        self.E = addStop(300, 500, Game.STAR, None)
+        self.L1 = addLine(self.world, 0, [self.A, self.T, self.B, self.S, self.C])
+        self.L2 = addLine(self.world, 1, [self.T, self.D, self.S])
+        self.L3 = addLine(self.world, 2, [self.D, self.E])
+
+    def runStop(self, stop, train):
+        # move passengers until the train leaves the stop
+        for i in range(MAX_STEPS):
+            stop.processTrain(train, Game.EntityList())
+            if train not in stop.trains:
+                return i+1
+        self.fail("the train never left the stop")
+
+    def testTransferAtEarlierStop(self):
+        # the train stops at S on its way to T
+        train = stopTrainAt(self.world, self.L1, 2, -1)
+        route = self.L1.routes[Game.STAR]
+        self.assertEqual(route[1], self.L2)
+        train.passengers.add(Game.Passenger(Game.STAR, [[-1, self.L1], route]))
+
+        self.runStop(self.S, train)
+        self.assertEqual(len(train.passengers), 0)
+        # the passenger waits at S for L2, and not for the train it got off
+        routed = self.S.passengers.getRouted(self.L2)
+        self.assertEqual(len(routed), 1)
+        self.assertEqual(routed[0].path[1], self.L2.routes[Game.STAR])
+        self.assertEqual(self.S.passengers.getDirectMask(), 0)
+
+    def testContinueOnTransferLine(self):
+        # after getting off at S, the passenger takes L2 to D and
+        # changes to L3 there, which goes straight to the star
+        train = stopTrainAt(self.world, self.L1, 2, -1)
+        train.passengers.add(Game.Passenger(Game.STAR, [[-1, self.L1], self.L1.routes[Game.STAR]]))
+        self.runStop(self.S, train)
+
+        train = stopTrainAt(self.world, self.L2, 1, -1)
+        self.runStop(self.S, train)
+        self.assertEqual(len(self.S.passengers), 0)
+        self.assertEqual(len(train.passengers.getRouted(self.L3)), 1)
+
+        # the train goes on to D
+        train.segmentNum = 0
+        train.stop = self.D
+        self.D.trains.append(train)
+        self.runStop(self.D, train)
+        self.assertEqual(len(train.passengers), 0)
+        self.assertTrue(self.D.passengers.hasDirect(Game.STAR))
+
+
+class EntityListTest(unittest.TestCase):
+    def testRemoveWhileIterating(self):
+        entities = Game.EntityList(range(6))
+        seen = []
+        for entity in reversed(entities):
+            seen.append(entity)
+            if entity == 4:
+                # remove one already seen, one not seen yet and add one
+                entities.remove(5)
+                entities.remove(1)
+                entities.append(6)
+                self.assertEqual(list(entities), [0, 2, 3, 4, 6])
+        # the entities are gone through as they were at the start
+        self.assertEqual(seen, [5, 4, 3, 2, 1, 0])
+        self.assertEqual(list(entities), [0, 2, 3, 4, 6])
+        self.assertEqual(entities.pop(), 6)
+        self.assertEqual([entities.getFirst(), entities.getLast()], [0, 4])
+
+
+class PassengerQueueTest(unittest.TestCase):
+    def testRemoveFromBucket(self):
+        line = Game.Line(0)
+        queue = Game.PassengerQueue(False)
+        routed = [Game.Passenger(Game.STAR, [[-1, line], [0, None]]) for i in range(3)]
+        for passenger in routed:
+            queue.add(passenger)
+        queue.add(Game.CIRCLE)
+        queue.remove(routed[0])
+        self.assertEqual(sorted(queue.getRouted(line)), sorted(routed[1:]))
+        self.assertEqual(queue.getShapes(), [Game.CIRCLE, Game.STAR, Game.STAR])
+        # the last passenger drawn is a routed one, the one made last
+        self.assertIs(queue.pop(), routed[2])
+        queue.remove(routed[1])
+        self.assertFalse(queue.hasRouted())
+        self.assertEqual(list(queue.getRouted()), [])
+        self.assertEqual(len(queue), 1)
+
+
+class WaterTest(unittest.TestCase):
+    # a thin river running down the map at x = 205
+    def setUp(self):
+        surface = pygame.Surface((400, 200))
+        surface.fill((255, 255, 255))
+        pygame.draw.rect(surface, Game.COLOURS.get("river"), (205, 0, 4, 200))
+        self.world = Game.World(surface)
+
+    def createSegment(self, x1, x2):
+        return Game.Segment(self.world.addStop(x1, 100, Game.CIRCLE, None),
+                            self.world.addStop(x2, 100, Game.CIRCLE, None),
+                            0)
+
+    def testWaterBetweenChecks(self):
+        # the river is crossed between two of the points checked
+        segment = self.createSegment(100, 300)
+        self.assertFalse(segment.checkOverWater(self.world.riverMask))
+        self.assertFalse(segment.isTunnel)
+
+    def testFirstPointOverWater(self):
+        segment = self.createSegment(105, 300)
+        self.assertTrue(segment.checkOverWater(self.world.riverMask))
+        point = segment.getFirstPointOverWater(self.world.riverMask)
+        self.assertEqual([int(point[0]), int(point[1])], [205, 100])
+        segment = self.createSegment(100, 200)
+        self.assertIsNone(segment.getFirstPointOverWater(self.world.riverMask))
+
+    def testDrawTunnelMissingWater(self):
+        # circles drawn every 30 pixels from x = 105 all miss the river,
+        # which the check every 20 pixels finds at x = 205
+        segment = self.createSegment(105, 300)
+        self.assertTrue(segment.checkOverWater(self.world.riverMask))
+        display = pygame.Surface((400, 200))
+        rect = segment.drawTunnel(display, 7, [[1, 1], [0, 0]], self.world.riverMask, 30)
+        self.assertEqual(rect.size, (0, 0))
+        self.assertEqual(rect.topleft, (105, 100))
+
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        surface = pygame.Surface((Sim.WORLD_WIDTH, Sim.WORLD_HEIGHT))
+        surface.fill((255, 255, 255))
+        self.simulation = Sim.Simulation(surface,
+                                         clock=Time.VirtualClock(),
+                                         randomStreams=Game.RandomStreams(0))
+        world = self.simulation.world
+        self.stops = [world.addStop(100+i*150, 300, i % 3, None) for i in range(5)]
+        self.line = addLine(world, 0, self.stops[:4])
+        world.resources[Game.LINE] = world.resources[Game.LINE]-1
+
+    def saveAndLoad(self):
+        saveFile = StringIO.StringIO()
+        Save.saveSimulation(self.simulation, saveFile)
+        return Save.loadSimulation(StringIO.StringIO(saveFile.getvalue()))
+
+    def testSaveDuringEdit(self):
+        world = self.simulation.world
+        segmentIds = [segment.id for segment in self.line.segments]
+        resources = list(world.resources)
+        # drag the middle of the second segment out to the last stop,
+        # and start drawing a new line
+        mouse = Game.MousePosition(Game.getViewCoords(400, 300, self.simulation.offset),
+                                   self.simulation.offset)
+        self.line.isMoving = True
+        self.line.createMouseSegments(1, mouse, self.stops[1], self.stops[2])
+        self.line._insertSegment(self.line.mouseSegments[0], self.stops[4], world.riverMask)
+        world.createNewLine(Game.MousePosition(Game.getViewCoords(700, 300, self.simulation.offset),
+                                               self.simulation.offset),
+                            self.stops[4])
+        world.resources[Game.LINE] = world.resources[Game.LINE]-1
+        world.updateTunnels()
+
+        loaded = self.saveAndLoad().world
+        # the edit is cancelled and the new line left out
+        self.assertEqual(len(loaded.lines), 1)
+        line = loaded.lines[0]
+        self.assertEqual([segment.id for segment in line.segments], segmentIds)
+        self.assertEqual(line.tempSegments, line.segments)
+        for segment in line.segments:
+            self.assertFalse(segment.isAbandoned)
+        self.assertEqual(line._abandonedSegments, [])
+        self.assertEqual(len(line._newStops)+len(line._removedStops), 0)
+        self.assertEqual(loaded.resources, resources)
+
+        # and the loaded line can be committed without changing it
+        loaded.commitLine(line)
+        self.assertEqual([segment.id for segment in line.segments], segmentIds)
+
+
+class DragTest(unittest.TestCase):
+    def setUp(self):
+        surface = pygame.Surface((Sim.WORLD_WIDTH, Sim.WORLD_HEIGHT))
+        surface.fill((255, 255, 255))
+        self.simulation = Sim.Simulation(surface,
+                                         clock=Time.VirtualClock(),
+                                         randomStreams=Game.RandomStreams(0))
+        world = self.simulation.world
+        self.stops = [world.addStop(100+i*150, 300, i % 3, None) for i in range(3)]
+
+    def getMouse(self, stop):
+        offset = self.simulation.offset
+        return Game.MousePosition(Game.getViewCoords(stop.X, stop.Y, offset), offset)
+
+    def testDrawLine(self):
+        simulation = self.simulation
+        world = simulation.world
+        lines = world.resources[Game.LINE]
+        simulation.startNewLine(self.getMouse(self.stops[0]))
+        simulation.dragTo(self.getMouse(self.stops[1]))
+        snapshot = simulation.takeSnapshot()
+        simulation.dragTo(self.getMouse(self.stops[2]))
+        # the line in the snapshot stays where the mouse was
+        line, frozenLine = snapshot.lines[0]
+        self.assertTrue(frozenLine.isMoving)
+        self.assertEqual(len(frozenLine.tempSegments), 1)
+        self.assertEqual(len(line.tempSegments), 2)
+
+        simulation.finishDrag(False)
+        self.assertIsNone(simulation.movingLine)
+        self.assertEqual([segment.lastPoint for segment in line.segments], self.stops[1:])
+        self.assertEqual(world.resources[Game.LINE], lines-1)
+        self.assertFalse(simulation.takeSnapshot().lines[0][1].isMoving)
+
+    def testEmptyLineRemoved(self):
+        # letting go without reaching another stop gives the line back
+        simulation = self.simulation
+        world = simulation.world
+        lines = world.resources[Game.LINE]
+        simulation.startNewLine(self.getMouse(self.stops[0]))
+        self.assertEqual(len(world.lines), 1)
+        simulation.finishDrag(False)
+        self.assertEqual(world.lines, [])
+        self.assertEqual(world.resources[Game.LINE], lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
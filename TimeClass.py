@@ -7,8 +7,12 @@
 #
 #########################################################################################
 
+import sys
 import time
 import math
+import ctypes
+import ctypes.util
+import numpy
 
 FORMAT_TOTAL_SECONDS = 1
 FORMAT_HH_MM_SS = 0
@@ -16,20 +20,100 @@ FORMAT_HH_MM_SS = 0
 SECONDS_PER_DAY = 86400
 SECONDS_PER_HOUR = 3600
 
+PROFILER_FRAMES = 300  # number of frames a FrameProfiler remembers
+# edges of the buckets in a FrameProfiler histogram, in milliseconds
+PROFILER_HISTOGRAM_EDGES = [0, 0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, 133, float("inf")]
+
 MODE_CURRENT_TIME = 0
 MODE_STOPWATCH = 1
 MODE_TIMER = 2
 
 
+# id of the monotonic clock in <time.h>, which differs between platforms
+CLOCK_MONOTONIC = 6 if sys.platform == "darwin" else 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("seconds", ctypes.c_long), ("nanoseconds", ctypes.c_long)]
+
+
+def _getMonotonicSource():
+    """ (None) -> function, bool
+        Returns a function giving the time in seconds from a clock that
+        never goes backwards, and whether it really is monotonic.
+        Python 2 has no time.monotonic, so clock_gettime is called
+        through ctypes instead. Where that doesn't work (Windows, older
+        macOS) this falls back to time.time, which jumps whenever the
+        time of day is changed.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic, True
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clockGettime = libc.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time, False
+    clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        # a new timespec each call, since the game and the simulation
+        # thread can both read the clock at once
+        timespec = _Timespec()
+        if clockGettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return timespec.seconds+timespec.nanoseconds*1e-9
+
+    try:
+        monotonic()
+    except OSError:
+        return time.time, False
+    return monotonic, True
+
+
+class RealClock(object):
+    # clock that follows the real passage of time. it never goes
+    # backwards when isMonotonic is True, otherwise it is the time of
+    # day and moves with any change to the system clock
+    def __init__(self):
+        self._source, self.isMonotonic = _getMonotonicSource()
+
+    def now(self):
+        return self._source()
+
+
+class VirtualClock(object):
+    # clock that only moves when it is told to, so that timers
+    # can run faster (or slower) than real time
+    def __init__(self, startingTime=0):
+        self._time = startingTime
+
+    def now(self):
+        return self._time
+
+    def advance(self, seconds):
+        # move the clock forward by an amount of seconds
+        self._time = self._time+seconds
+
+
+# clock used by any time that isn't given one
+DEFAULT_CLOCK = RealClock()
+
+
 class Time(object):
     def __init__(self,
                  timeMode=MODE_CURRENT_TIME,
                  displayFormat=FORMAT_HH_MM_SS,
-                 startingTime=0):
+                 startingTime=0,
+                 clock=None):
         self._displayFormat = displayFormat
         self.timeMode = timeMode
+        # stopwatches and timers read the clock, the current
+        # time always comes from the real time of day
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        self.clock = clock
 
-        self._startTime = time.time()
+        self._startTime = self.clock.now()
 
         if self.timeMode == MODE_CURRENT_TIME:
             self.time = time.time()
@@ -112,10 +196,10 @@ class Time(object):
             if self.timeMode == MODE_CURRENT_TIME:
                 self.time = time.time()
             elif self.timeMode == MODE_STOPWATCH:
-                self.time = self._elapsed + time.time()-self._startTime
+                self.time = self._elapsed + self.clock.now()-self._startTime
             elif self.timeMode == MODE_TIMER:
                 self.time = (self.countdownAmount
-                             - (self._elapsed+(time.time()-self._startTime)))
+                             - (self._elapsed+(self.clock.now()-self._startTime)))
 
     def checkTimer(self, shouldRestart, startTime=None):
         # see if a timer has reached 0, restart it if specified
@@ -141,14 +225,14 @@ class Time(object):
                 self._elapsed = 0
             else:
                 self._elapsed = self.countdownAmount-startTime
-            self._startTime = time.time()
+            self._startTime = self.clock.now()
             self.time = self.countdownAmount
         elif self.timeMode == MODE_STOPWATCH:
             if startTime is None:
                 self._elapsed = 0
             else:
                 self._elapsed = startTime
-            self._startTime = time.time()
+            self._startTime = self.clock.now()
             self.time = 0
 
     def toggleActive(self):
@@ -156,7 +240,105 @@ class Time(object):
         if self.timeMode != MODE_CURRENT_TIME:
             if self.isActive:
                 self.tick()
-                self._elapsed = self._elapsed+(time.time()-self._startTime)
+                self._elapsed = self._elapsed+(self.clock.now()-self._startTime)
             else:
-                self._startTime = time.time()
+                self._startTime = self.clock.now()
         self.isActive = not self.isActive
+
+
+class FrameProfiler(object):
+    # times the phases of each frame of a loop into ring buffers that
+    # hold the last PROFILER_FRAMES frames, to find which phase makes
+    # frames slow. nothing is timed until it is enabled, so it can be
+    # left in the loop
+    def __init__(self, phases, frames=PROFILER_FRAMES, clock=None):
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        self.clock = clock
+        self.phases = list(phases)
+        self.isEnabled = False
+        self._phaseIndices = {}
+        for i in range(len(self.phases)):
+            self._phaseIndices[self.phases[i]] = i
+        # seconds spent in each phase, one column per frame
+        self._times = numpy.zeros((len(self.phases), frames))
+        self._current = [0.0]*len(self.phases)  # the frame being timed
+        self._frame = 0   # column the next finished frame goes in
+        self._frames = 0  # number of columns that hold a frame
+        self._lastTime = None
+
+    def toggle(self):
+        # start or stop timing, forgetting the frame that was
+        # being timed when it stopped
+        self.isEnabled = not self.isEnabled
+        self._lastTime = None
+        return self.isEnabled
+
+    def startFrame(self):
+        # finish the frame being timed and start the next one
+        if not self.isEnabled:
+            return
+        if self._lastTime is not None:
+            self._times[:, self._frame] = self._current
+            self._frame = (self._frame+1) % self._times.shape[1]
+            self._frames = min(self._frames+1, self._times.shape[1])
+        self._current = [0.0]*len(self.phases)
+        self._lastTime = self.clock.now()
+
+    def mark(self, phase):
+        # adds the time since the last mark (or the start of the
+        # frame) to the phase with the name "phase"
+        if not self.isEnabled or self._lastTime is None:
+            return
+        now = self.clock.now()
+        index = self._phaseIndices[phase]
+        self._current[index] = self._current[index]+now-self._lastTime
+        self._lastTime = now
+
+    def getStatistics(self):
+        """ (None) -> list
+            Returns [phase, p50, p95, p99, max] for every phase over the
+            frames in the ring buffers, in milliseconds.
+        """
+        statistics = []
+        if self._frames == 0:
+            for phase in self.phases:
+                statistics.append([phase, 0.0, 0.0, 0.0, 0.0])
+            return statistics
+        times = self._times[:, :self._frames]*1000
+        percentiles = numpy.percentile(times, [50, 95, 99], axis=1)
+        maximums = times.max(axis=1)
+        for i in range(len(self.phases)):
+            statistics.append([self.phases[i],
+                               float(percentiles[0][i]),
+                               float(percentiles[1][i]),
+                               float(percentiles[2][i]),
+                               float(maximums[i])])
+        return statistics
+
+    def getHistograms(self):
+        """ (None) -> dict
+            Returns the number of frames that each phase took in each
+            bucket of PROFILER_HISTOGRAM_EDGES, as {phase: counts}.
+        """
+        times = self._times[:, :self._frames]*1000
+        histograms = {}
+        for i in range(len(self.phases)):
+            histograms[self.phases[i]] = [int(count) for count in
+                                          numpy.histogram(times[i], PROFILER_HISTOGRAM_EDGES)[0]]
+        return histograms
+
+    def dump(self, outputFile, title):
+        # write the statistics and histograms as a table to a file
+        outputFile.write("%s (last %d frames, times in ms)\n" % (title, self._frames))
+        outputFile.write("%-20s %8s %8s %8s %8s" % ("phase", "p50", "p95", "p99", "max"))
+        for edge in PROFILER_HISTOGRAM_EDGES[1:]:
+            outputFile.write(" %7s" % ("<"+str(edge)))
+        outputFile.write("\n")
+        histograms = self.getHistograms()
+        for phase, p50, p95, p99, maximum in self.getStatistics():
+            outputFile.write("%-20s %8.3f %8.3f %8.3f %8.3f" % (phase, p50, p95, p99, maximum))
+            for count in histograms[phase]:
+                outputFile.write(" %7d" % count)
+            outputFile.write("\n")
+        outputFile.write("\n")